@@ -0,0 +1,168 @@
+'''Admission Control.
+
+Server refuses new work when it is over one of limits:
+connections per link type, event loop lag, queued bytes,
+and bandwidth.
+'''
+#
+# Copyright (c) 2006 Pyny Project.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHORS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# $Id: $
+#
+
+import asyncio
+from time import monotonic
+
+from . import config
+
+__version__ = '$Revision: $'
+__all__ = ['Admission']
+
+linktypes = ('Search', 'Transfer', 'BbsSearch')
+
+
+class Admission:
+    '''Admission Control.
+
+    Counters are admitted and rejected[reason].
+    Link type is checked for an admitted session,
+    so the session is not counted twice against connections.
+
+    Sample:
+    >>> a = Admission()
+    >>> a.limits = dict(a.limits, connections=1)
+    >>> a.check()
+    >>> a.admit()
+    >>> a.check()
+    'connections'
+    >>> a.release()
+    >>> a.admit()
+    >>> a.check('Search')
+    >>> a.admitted, a.rejected
+    (2, {'connections': 1})
+    '''
+
+    def __init__(self):
+        self.limits = {
+            'connections': config.max_connections,
+            'lag': config.max_loop_lag,
+            'queued': config.max_queued_bytes,
+            'bandwidth': config.bandwidth_limit,
+        }
+        self.linktype_limits = dict(config.max_links)
+        self.connections = 0
+        self.links = dict.fromkeys(linktypes, 0)
+        self.lag = 0.0
+        self.queued = 0
+        self.traffic_bytes = 0
+        self.traffic_since = monotonic()
+        self.rate = 0.0
+        self.admitted = 0
+        self.rejected = {}
+
+    def reason(self, linktype=None):
+        '''Reason to reject, or None.
+
+        Session of linktype is admitted already, it is not counted.
+        '''
+        limits = self.limits
+        connections = self.connections
+        if linktype:
+            connections -= 1
+        if limits['connections'] and (connections >= limits['connections']):
+            return 'connections'
+        if limits['lag'] and (self.lag > limits['lag']):
+            return 'lag'
+        if limits['queued'] and (self.queued > limits['queued']):
+            return 'queued'
+        if limits['bandwidth'] and (self.rate > limits['bandwidth']):
+            return 'bandwidth'
+        if linktype:
+            limit = self.linktype_limits.get(linktype, 0)
+            if limit and (self.links.get(linktype, 0) >= limit):
+                return linktype
+        return None
+
+    def check(self, linktype=None):
+        '''Check admission, and count rejection.
+        '''
+        reason = self.reason(linktype)
+        if reason is not None:
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        return reason
+
+    def admit(self):
+        self.connections += 1
+        self.admitted += 1
+
+    def release(self):
+        self.connections -= 1
+
+    def link(self, linktype, count=1):
+        '''Count link type of session, count=-1 when it is closed.
+        '''
+        self.links[linktype] = self.links.get(linktype, 0) + count
+
+    def traffic(self, size):
+        self.traffic_bytes += size
+
+    def update(self, queued=0, lag=0.0):
+        '''Update queued bytes, loop lag, and bandwidth rate.
+        '''
+        now = monotonic()
+        elapsed = now - self.traffic_since
+        if elapsed > 0:
+            self.rate = self.traffic_bytes / elapsed
+        self.traffic_bytes = 0
+        self.traffic_since = now
+        self.queued = queued
+        self.lag = lag
+
+    async def monitor(self, sessions, interval=None):
+        '''Measure event loop lag and queues of sessions.
+        '''
+        if interval is None:
+            interval = config.admission_interval
+        while True:
+            begin = monotonic()
+            await asyncio.sleep(interval)
+            lag = max(monotonic() - begin - interval, 0.0)
+            queued = 0
+            for session in list(sessions):
+                queued += session.queued()
+            self.update(queued, lag)
+
+
+# End of Admission
+
+
+def _test():
+    import doctest
+    from pyny import admission
+    return doctest.testmod(admission)
+
+
+if __name__ == '__main__':
+    _test()
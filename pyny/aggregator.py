@@ -0,0 +1,240 @@
+'''Search Response Aggregator.
+
+Responses of one search come by many routes, and they have the same keys.
+Keys of responses are merged by query_id as they come, one key is kept
+for (hash, sharing address), the one of the longest timer.
+Caller reads new and refreshed keys by batches from async generator,
+so the first keys are shown before all routes answer.
+Search is removed from aggregator when its results end, and searches
+nobody reads are removed config.search_timeout seconds after start.
+'''
+#
+# Copyright (c) 2006 Pyny Project.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHORS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# $Id: $
+#
+
+import asyncio
+from time import monotonic
+
+from . import config
+from .metrics import registry
+
+__version__ = '$Revision: $'
+__all__ = ['Search', 'ResponseAggregator']
+
+merged = registry.counter('pyny_search_keys_total', 'Keys of search responses', ('result', ))
+
+
+class Search:
+    '''Keys of one search.
+
+    Sample:
+    >>> from pyny.nykey import NyKeyInformation
+    >>> def key(address, timer):
+    ...     k = NyKeyInformation()
+    ...     k.hash, k.sharing_address, k.timer = 'fcc3b22beb4c242c', address, timer
+    ...     return k
+    >>> s = Search(300)
+    >>> s.merge([key('192.168.1.1', 100), key('192.168.1.2', 100)])
+    2
+    >>> s.merge([key('192.168.1.1', 50), key('192.168.1.1', 200)])
+    1
+    >>> sorted((k.sharing_address, k.timer) for k in s.keys.values())
+    [('192.168.1.1', 200), ('192.168.1.2', 100)]
+    '''
+
+    def __init__(self, query_id, owner=None):
+        self.query_id = query_id
+        self.owner = owner  # ResponseAggregator which has this search
+        self.deadline = monotonic() + config.search_timeout
+        self.keys = {}  # (hash, sharing address) -> keyinfo
+        self.pending = {}  # keys not read yet
+        self.event = None
+        self.closed = False
+
+    def __len__(self):
+        return len(self.keys)
+
+    def merge(self, keys):
+        '''Merge keys, and returns number of new or refreshed ones.
+        '''
+        changed = 0
+        for keyinfo in keys:
+            key = (keyinfo.hash, keyinfo.sharing_address)
+            old = self.keys.get(key)
+            if (old is not None) and (old.timer >= keyinfo.timer):
+                merged.labels('duplicate').inc()
+                continue
+            merged.labels('new' if old is None else 'refreshed').inc()
+            self.keys[key] = keyinfo
+            self.pending[key] = keyinfo
+            changed += 1
+        if changed and (self.event is not None):
+            self.event.set()
+        return changed
+
+    def close(self):
+        self.closed = True
+        if self.event is not None:
+            self.event.set()
+
+    async def results(self, timeout=None):
+        '''Yield lists of new and refreshed keys until timeout or close().
+        '''
+        if timeout is None:
+            timeout = config.search_timeout
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        self.deadline = monotonic() + timeout
+        if self.event is None:
+            self.event = asyncio.Event()
+        try:
+            while True:
+                if not self.pending:
+                    if self.closed:
+                        return
+                    self.event.clear()
+                    try:
+                        await asyncio.wait_for(self.event.wait(), deadline - loop.time())
+                    except asyncio.TimeoutError:
+                        return
+                    if not self.pending:
+                        continue
+                keys = list(self.pending.values())
+                self.pending = {}
+                yield keys
+        finally:
+            if self.owner is not None:
+                self.owner.remove(self)
+
+
+# End of Search
+
+
+class ResponseAggregator:
+    '''Searches by query_id.
+
+    Set on_response as DiffusionEngine.on_response,
+    or register it as handler of NyQuery.
+
+    Sample:
+    >>> import asyncio
+    >>> from pyny.nycommand import NyQuery
+    >>> from pyny.nykey import NyKeyInformation
+    >>> def response(*addresses):
+    ...     q = NyQuery()
+    ...     q.is_response, q.query_id, q.keyinfo = True, 300, []
+    ...     for address in addresses:
+    ...         k = NyKeyInformation()
+    ...         k.hash, k.sharing_address, k.timer = 'fcc3b22beb4c242c', address, 100
+    ...         q.keyinfo.append(k)
+    ...     return q
+    >>> a = ResponseAggregator()
+    >>> async def search():
+    ...     s = a.start(300)
+    ...     loop = asyncio.get_running_loop()
+    ...     loop.call_soon(a.on_response, None, response('192.168.1.1'))
+    ...     loop.call_later(0.01, a.on_response, None, response('192.168.1.1', '192.168.1.2'))
+    ...     loop.call_later(0.02, a.stop, 300)
+    ...     return [[k.sharing_address for k in keys] async for keys in s.results(timeout=1)]
+    >>> asyncio.run(search())
+    [['192.168.1.1'], ['192.168.1.2']]
+    >>> len(a)
+    0
+
+    Search is removed at timeout of its results:
+    >>> async def timeout():
+    ...     s = a.start(301)
+    ...     return [keys async for keys in s.results(timeout=0.01)], len(a)
+    >>> asyncio.run(timeout())
+    ([], 0)
+
+    Search nobody reads is removed after its deadline:
+    >>> s = a.start(302)
+    >>> a.expire(now=s.deadline)
+    >>> len(a), s.closed
+    (0, True)
+    '''
+
+    def __init__(self):
+        self.searches = {}  # query_id -> Search
+        registry.gauge('pyny_searches', 'Searches waiting for responses',
+                       func=lambda: len(self.searches))
+
+    def __len__(self):
+        return len(self.searches)
+
+    def start(self, query_id):
+        '''Search of query_id which collects responses.
+        '''
+        self.expire()
+        search = self.searches.get(query_id)
+        if search is None:
+            search = Search(query_id, self)
+            self.searches[query_id] = search
+        return search
+
+    def stop(self, query_id):
+        search = self.searches.pop(query_id, None)
+        if search is not None:
+            search.close()
+
+    def remove(self, search):
+        '''Remove search whose results ended.
+        '''
+        if self.searches.get(search.query_id) is search:
+            del self.searches[search.query_id]
+        search.closed = True
+
+    def expire(self, now=None):
+        '''Stop searches after their deadline, which nobody reads.
+        '''
+        if now is None:
+            now = monotonic()
+        for query_id in [i for i, search in self.searches.items() if search.deadline <= now]:
+            self.stop(query_id)
+
+    def on_response(self, session, query):
+        '''Handler of NyQuery, responses of searches are merged.
+        '''
+        if not query.is_response:
+            return
+        search = self.searches.get(query.query_id)
+        if search is not None:
+            search.merge(query.keyinfo)
+
+
+# End of ResponseAggregator
+
+
+def _test():
+    import doctest
+    from pyny import aggregator
+    return doctest.testmod(aggregator)
+
+
+if __name__ == '__main__':
+    _test()
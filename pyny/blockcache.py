@@ -0,0 +1,364 @@
+'''Block Cache.
+
+Cache file is array of fixed size slots, it is mapped by mmap.
+Slot: <Slot Header><NyFileResponse.cache_block()>
+Slot Header: <State><Data Length><CRC32><Sequence>
+
+Slot is written as: header is made invalid, record is written,
+then header is made valid with CRC32 of record.
+CRC32 is checked when slot is used first after open,
+so half written slots are dropped after crash.
+'''
+#
+# Copyright (c) 2006 Pyny Project.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHORS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# $Id: $
+#
+
+import os
+import mmap
+import struct
+import zlib
+from threading import Lock
+
+from . import config
+from .nycommand import NyFileResponse
+
+__version__ = '$Revision: $'
+__all__ = ['Block', 'BlockCache']
+
+slot_header = struct.Struct('<IIIIQ8x')
+record_header_size = NyFileResponse.header_size
+data_size = NyFileResponse.data_limit
+record_size = record_header_size + data_size
+slot_size = slot_header.size + record_size
+
+free = 0
+valid = 0x4B4C4250  # 'PBLK'
+
+unchecked = 0
+checked = 1
+
+
+def _hashkey(hash):
+    if isinstance(hash, str):
+        hash = hash.encode('latin-1')
+    return hash[:16] + b'\0' * (16 - len(hash))
+
+
+class Block:
+    '''Pinned block of BlockCache.
+
+    Slot is not reused until release(), or the end of with statement,
+    which gives memoryview of block data in mapping.
+    '''
+
+    def __init__(self, cache, slot, data):
+        self.cache = cache
+        self.slot = slot
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __bytes__(self):
+        return bytes(self.data)
+
+    def __enter__(self):
+        return self.data
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def release(self):
+        if self.data is not None:
+            self.data.release()
+            self.data = None
+            self.cache.unpin(self.slot)
+
+
+# End of Block
+
+
+class BlockCache:
+    '''Block Cache.
+
+    Blocks are found by (hash, block_begin).
+    get() returns Block, its slot is pinned until it is released.
+    Slots are reused in CLOCK order, pinned slots are skipped.
+
+    Sample:
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'blocks.dat')
+    >>> cache = BlockCache(path, slots=2)
+    >>> cache.open()
+    >>> cache.put('fcc3b22beb4c242c', 0, b'abc')
+    0
+    >>> cache.put('fcc3b22beb4c242c', 1, b'def')
+    1
+    >>> with cache.get('fcc3b22beb4c242c', 0) as data:
+    ...     bytes(data)
+    b'abc'
+    >>> cache.put('fcc3b22beb4c242c', 2, b'ghi')
+    1
+    >>> cache.get('fcc3b22beb4c242c', 1) is None
+    True
+
+    Pinned slots are not reused:
+    >>> block = cache.get('fcc3b22beb4c242c', 2)
+    >>> cache.put('fcc3b22beb4c242c', 2, b'jkl')
+    0
+    >>> bytes(block), len(cache.free)
+    (b'ghi', 0)
+    >>> block.release()
+    >>> len(cache.free)
+    1
+    >>> cache.put('fcc3b22beb4c242c', 2, b'mno')
+    0
+    >>> cache.close()
+    >>> cache = BlockCache(path, slots=2)
+    >>> cache.open()
+    >>> sorted(cache.index.values()), cache.free
+    ([0], [1])
+    >>> response = cache.response('fcc3b22beb4c242c', 2)
+    >>> response.block_begin, response.hash, response.file_data
+    (2, 'fcc3b22beb4c242c', 'mno')
+    >>> cache.close()
+    '''
+
+    def __init__(self, path=None, size=None, slots=None):
+        if path is None:
+            path = config.blockcache
+        if slots is None:
+            if size is None:
+                size = config.blockcache_size
+            slots = max(size // slot_size, 1)
+        self.path = path
+        self.slots = slots
+        self.lock = Lock()
+        self.file = None
+        self.map = None
+        self.index = {}  # (hash, block_begin) -> slot
+        self.keys = [None] * slots  # slot -> (hash, block_begin)
+        self.state = bytearray(slots)  # unchecked, checked
+        self.referred = bytearray(slots)
+        self.pins = [0] * slots
+        self.dropped = bytearray(slots)  # pinned slots to be freed by unpin()
+        self.free = []
+        self.hand = 0
+        self.sequence = 0
+
+    def open(self):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        if not os.path.exists(self.path):
+            open(self.path, 'wb').close()
+        self.file = open(self.path, 'r+b')
+        if os.path.getsize(self.path) != self.slots * slot_size:
+            self.file.truncate(self.slots * slot_size)
+        self.map = mmap.mmap(self.file.fileno(), self.slots * slot_size)
+        for slot in range(self.slots - 1, -1, -1):
+            offset = slot * slot_size
+            state, length, crc, reserved, sequence = slot_header.unpack_from(self.map, offset)
+            if (state != valid) or (length > data_size):
+                self.free.append(slot)
+                continue
+            begin = offset + slot_header.size
+            key = (bytes(self.map[begin + 8:begin + 24]), struct.unpack_from('<I', self.map, begin + 4)[0])
+            self.index[key] = slot
+            self.keys[slot] = key
+            self.sequence = max(self.sequence, sequence)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+            self.file.close()
+            self.file = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return (_hashkey(key[0]), key[1]) in self.index
+
+    def _allocate(self):
+        if self.free:
+            return self.free.pop()
+        for i in range(2 * self.slots):
+            slot = self.hand
+            self.hand = (self.hand + 1) % self.slots
+            if self.pins[slot]:
+                continue
+            if self.referred[slot]:
+                self.referred[slot] = 0
+                continue
+            self._drop(slot)
+            return self.free.pop()
+        return None
+
+    def _drop(self, slot):
+        key = self.keys[slot]
+        if key is not None:
+            del self.index[key]
+            self.keys[slot] = None
+        if self.pins[slot]:
+            self.dropped[slot] = 1
+            return
+        slot_header.pack_into(self.map, slot * slot_size, free, 0, 0, 0, 0)
+        self.free.append(slot)
+
+    def put(self, hash, block_begin, data, task_id=0):
+        '''Store block, and returns its slot,
+        or None if all slots are pinned.
+        '''
+        if isinstance(data, str):
+            data = data.encode('latin-1')
+        data = data[:data_size]
+        key = (_hashkey(hash), block_begin)
+        with self.lock:
+            slot = self.index.get(key)
+            if (slot is not None) and self.pins[slot]:
+                self._drop(slot)
+                slot = None
+            if slot is None:
+                slot = self._allocate()
+                if slot is None:
+                    return None
+            offset = slot * slot_size
+            slot_header.pack_into(self.map, offset, free, 0, 0, 0, 0)
+            begin = offset + slot_header.size
+            struct.pack_into('<II16s', self.map, begin, task_id, block_begin, key[0])
+            self.map[begin + record_header_size:begin + record_header_size + len(data)] = data
+            end = begin + record_size
+            self.map[begin + record_header_size + len(data):end] = bytes(data_size - len(data))
+            self.sequence += 1
+            crc = zlib.crc32(self.map[begin:begin + record_header_size + len(data)])
+            slot_header.pack_into(self.map, offset, valid, len(data), crc, 0, self.sequence)
+            self.index[key] = slot
+            self.keys[slot] = key
+            self.state[slot] = checked
+            self.referred[slot] = 0
+            return slot
+
+    def put_response(self, response):
+        return self.put(response.hash, response.block_begin, response.file_data, response.task_id)
+
+    def find(self, hash, block_begin):
+        '''Slot of block, or None.
+
+        Slot may be reused by put(), pin() keeps it.
+        '''
+        with self.lock:
+            return self._find(hash, block_begin)
+
+    def _find(self, hash, block_begin):
+        key = (_hashkey(hash), block_begin)
+        slot = self.index.get(key)
+        if slot is None:
+            return None
+        if (self.state[slot] == unchecked) and not self._check(slot):
+            self._drop(slot)
+            return None
+        self.referred[slot] = 1
+        return slot
+
+    def pin(self, hash, block_begin):
+        '''Slot of block, or None.
+
+        Slot is not reused until unpin(slot).
+        '''
+        with self.lock:
+            slot = self._find(hash, block_begin)
+            if slot is not None:
+                self.pins[slot] += 1
+            return slot
+
+    def unpin(self, slot):
+        with self.lock:
+            self.pins[slot] -= 1
+            if (not self.pins[slot]) and self.dropped[slot]:
+                self.dropped[slot] = 0
+                slot_header.pack_into(self.map, slot * slot_size, free, 0, 0, 0, 0)
+                self.free.append(slot)
+
+    def _check(self, slot):
+        offset = slot * slot_size
+        state, length, crc, reserved, sequence = slot_header.unpack_from(self.map, offset)
+        begin = offset + slot_header.size
+        if (state != valid) or (zlib.crc32(self.map[begin:begin + record_header_size + length]) != crc):
+            return False
+        self.state[slot] = checked
+        return True
+
+    def length(self, slot):
+        return slot_header.unpack_from(self.map, slot * slot_size)[1]
+
+    def data_offset(self, slot):
+        '''File offset of block data of slot.
+        '''
+        return slot * slot_size + slot_header.size + record_header_size
+
+    def get(self, hash, block_begin):
+        '''Pinned Block, or None.
+        '''
+        slot = self.pin(hash, block_begin)
+        if slot is None:
+            return None
+        begin = self.data_offset(slot)
+        return Block(self, slot, memoryview(self.map)[begin:begin + self.length(slot)])
+
+    def response(self, hash, block_begin):
+        '''NyFileResponse of cached block, or None.
+        '''
+        slot = self.pin(hash, block_begin)
+        if slot is None:
+            return None
+        try:
+            begin = slot * slot_size + slot_header.size
+            task_id, block_begin, hash = struct.unpack_from('<II16s', self.map, begin)
+            response = NyFileResponse()
+            response.task_id = task_id
+            response.block_begin = block_begin
+            response.hash = hash.decode('latin-1')
+            data = self.map[begin + record_header_size:begin + record_header_size + self.length(slot)]
+            response.file_data = data.decode('latin-1')
+            return response
+        finally:
+            self.unpin(slot)
+
+
+# End of BlockCache
+
+
+def _test():
+    import doctest
+    from pyny import blockcache
+    return doctest.testmod(blockcache)
+
+
+if __name__ == '__main__':
+    _test()
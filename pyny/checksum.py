@@ -48,11 +48,15 @@ def sum32(data):
     Sample:
     >>> sum32('abc')
     294
+    >>> sum32(b'abc')
+    294
     '''
-    sum = 0
-    for c in data:
-        sum += ord(c)
-    return int(sum & 0xFFFFFFFF)
+    if isinstance(data, str):
+        try:
+            data = data.encode('latin-1')
+        except UnicodeEncodeError:
+            data = map(ord, data)
+    return sum(data) & 0xFFFFFFFF
 
 
 def _test():
@@ -0,0 +1,350 @@
+'''Conditional Diffusion Conditions.
+
+NyConditionalDiffusionRequest asks to be told keys which match keyword
+and sign. Words of all keywords are compiled into one Aho-Corasick
+automaton, so a file name is scanned once for all conditions.
+
+New words wait in pending, found by their first two characters,
+until the automaton is built again with them in a thread, as a new
+generation. It is built when pending words are more than a quarter of
+compiled ones, so building costs a few times of all words in total.
+Words of removed conditions stay in automaton, but match nothing,
+until the next generation.
+'''
+#
+# Copyright (c) 2006 Pyny Project.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHORS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# $Id: $
+#
+
+import asyncio
+from array import array
+from collections import deque
+
+from . import config
+from .keyindex import normalize
+from .metrics import registry
+
+__version__ = '$Revision: $'
+__all__ = ['Automaton', 'ConditionRegistry']
+
+matched = registry.counter('pyny_condition_matches_total', 'Keys matched to conditions')
+
+
+class Automaton:
+    '''Aho-Corasick Automaton.
+
+    Transitions are one dict of state << 21 | character -> state.
+
+    Sample:
+    >>> a = Automaton([('he', 1), ('she', 2), ('his', 3), ('hers', 4)])
+    >>> sorted(a.scan('ushers'))
+    [1, 2, 4]
+    '''
+
+    def __init__(self, patterns):
+        goto = {}
+        out = {}
+        children = [[]]
+        for word, pid in patterns:
+            state = 0
+            for ch in word:
+                key = state << 21 | ord(ch)
+                next = goto.get(key)
+                if next is None:
+                    next = len(children)
+                    children.append([])
+                    children[state].append((ord(ch), next))
+                    goto[key] = next
+                state = next
+            out.setdefault(state, []).append(pid)
+        fail = array('I', bytes(4 * len(children)))
+        queue = deque(next for ch, next in children[0])
+        while queue:
+            state = queue.popleft()
+            for ch, next in children[state]:
+                queue.append(next)
+                f = fail[state]
+                while f and ((f << 21 | ch) not in goto):
+                    f = fail[f]
+                f = goto.get(f << 21 | ch, 0)
+                fail[next] = f
+                if f in out:
+                    out.setdefault(next, []).extend(out[f])
+        self.goto = goto
+        self.fail = fail
+        self.out = dict((state, tuple(pids)) for state, pids in out.items())
+        self.states = len(children)
+
+    def scan(self, text):
+        '''Set of pattern ids found in text.
+        '''
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        found = set()
+        state = 0
+        for ch in text:
+            c = ord(ch)
+            while True:
+                next = goto.get(state << 21 | c)
+                if next is not None:
+                    state = next
+                    break
+                if not state:
+                    break
+                state = fail[state]
+            pids = out.get(state)
+            if pids:
+                found.update(pids)
+        return found
+
+
+# End of Automaton
+
+
+class ConditionRegistry:
+    '''Active Conditions.
+
+    Conditions are keyed by (owner, query_id), owner is the session which
+    sent the request. Key matches when its file name has all words of
+    keyword, and its sharing_sign is sign if sign is given.
+    attach(store) calls on_match(owner, query_id, keyinfo) for new keys
+    of key store, on_keys(keys) does it for keys of other stores.
+
+    Sample:
+    >>> from pyny.nycommand import NyConditionalDiffusionRequest
+    >>> from pyny.nykey import NyKeyInformation
+    >>> r = ConditionRegistry()
+    >>> for i, keyword in enumerate(('winny manual', 'python', '')):
+    ...     c = NyConditionalDiffusionRequest()
+    ...     c.keyword, c.query_id = keyword, i
+    ...     c.sign = 'Xyz' if i == 2 else ''
+    ...     r.add('peer', c)
+    >>> k = NyKeyInformation()
+    >>> k.file_name, k.sharing_sign = 'Winny Manual.pdf', 'Xyz'
+    >>> sorted(r.match(k))
+    [('peer', 0), ('peer', 2)]
+    >>> r.rebuild()
+    >>> r.remove('peer', 0)
+    >>> r.match(k)
+    [('peer', 2)]
+    >>> r.generation, r.pending
+    (1, {})
+
+    Words removed while automaton is built are stale in the new one:
+    >>> r.building, r.build_next = True, r.next
+    >>> r.remove('peer', 1)
+    >>> r.building = False
+    >>> r._swap([('python', 1)], Automaton([('python', 1)]), r.generation, r.build_stale)
+    >>> r.stale, r.generation
+    (1, 2)
+    '''
+
+    def __init__(self, on_match=None):
+        self.on_match = on_match
+        self.conditions = {}  # (owner, query_id) -> (pattern ids, sign)
+        self.patterns = {}  # word -> pattern id
+        self.words = {}  # pattern id -> word
+        self.users = {}  # pattern id -> set of conditions
+        self.signs = {}  # sign -> set of conditions without words
+        self.pending = {}  # word -> pattern id, not in automaton
+        self.prefixes = {}  # first two characters -> {word: pattern id} of pending
+        self.automaton = Automaton([])
+        self.compiled = 0  # words in automaton
+        self.stale = 0  # words of removed conditions in automaton
+        self.generation = 0
+        self.building = False
+        self.build_next = 0  # pattern ids below it are in automaton being built
+        self.build_stale = 0  # words removed while automaton is built
+        self.next = 0
+        registry.gauge('pyny_conditions', 'Active conditions', func=lambda: len(self.conditions))
+
+    def __len__(self):
+        return len(self.conditions)
+
+    def attach(self, store):
+        store.listeners.append(self.on_key)
+
+    def on_key(self, keyinfo, added):
+        if added and (self.on_match is not None):
+            for owner, query_id in self.match(keyinfo):
+                self.on_match(owner, query_id, keyinfo)
+
+    def on_keys(self, keys):
+        for keyinfo in keys:
+            self.on_key(keyinfo, True)
+
+    def on_request(self, session, command):
+        '''Handler of NyConditionalDiffusionRequest.
+        '''
+        self.add(session, command)
+
+    def add(self, owner, command):
+        key = (owner, command.query_id)
+        if key in self.conditions:
+            self.remove(*key)
+        pids = []
+        for word in set(normalize(command.keyword).split()):
+            pid = self.patterns.get(word)
+            if pid is None:
+                pid = self.next
+                self.next += 1
+                self.patterns[word] = pid
+                self.words[pid] = word
+                self.users[pid] = set()
+                self._pend(word, pid)
+            self.users[pid].add(key)
+            pids.append(pid)
+        self.conditions[key] = (tuple(pids), command.sign)
+        if not pids:
+            self.signs.setdefault(command.sign, set()).add(key)
+        if self._outgrown():
+            self.rebuild_later()
+
+    def _outgrown(self):
+        return len(self.pending) > max(config.condition_pending, self.compiled // 4)
+
+    def _pend(self, word, pid):
+        self.pending[word] = pid
+        self.prefixes.setdefault(word[:2], {})[word] = pid
+
+    def _unpend(self, word):
+        pid = self.pending.pop(word, None)
+        if pid is not None:
+            words = self.prefixes[word[:2]]
+            del words[word]
+            if not words:
+                del self.prefixes[word[:2]]
+        return pid
+
+    def remove(self, owner, query_id):
+        key = (owner, query_id)
+        item = self.conditions.pop(key, None)
+        if item is None:
+            return
+        pids, sign = item
+        for pid in pids:
+            users = self.users[pid]
+            users.discard(key)
+            if not users:
+                word = self.words.pop(pid)
+                del self.users[pid]
+                del self.patterns[word]
+                if self._unpend(word) is None:
+                    self.stale += 1
+                if self.building and (pid < self.build_next):
+                    self.build_stale += 1
+        if not pids:
+            self.signs[sign].discard(key)
+            if not self.signs[sign]:
+                del self.signs[sign]
+        if self.stale * 2 > max(self.compiled, config.condition_pending):
+            self.rebuild_later()
+
+    def remove_owner(self, owner):
+        for key in [i for i in self.conditions if i[0] == owner]:
+            self.remove(*key)
+
+    def match(self, keyinfo):
+        '''Conditions which keyinfo matches.
+        '''
+        text = normalize(keyinfo.file_name)
+        found = self.automaton.scan(text)
+        if self.pending:
+            prefixes = self.prefixes
+            for i in range(len(text)):
+                for prefix in (text[i], text[i:i + 2]):
+                    words = prefixes.get(prefix)
+                    if words:
+                        for word, pid in words.items():
+                            if text.startswith(word, i):
+                                found.add(pid)
+        result = []
+        for pid in found:
+            for key in self.users.get(pid, ()):
+                pids, sign = self.conditions[key]
+                if (pids[0] == pid) and found.issuperset(pids) and \
+                   ((not sign) or (sign == keyinfo.sharing_sign)):
+                    result.append(key)
+        result.extend(self.signs.get(keyinfo.sharing_sign, ()))
+        matched.inc(len(result))
+        return result
+
+    def _swap(self, patterns, automaton, generation, stale=0):
+        if generation != self.generation:
+            return  # built from older patterns than automaton
+        self.automaton = automaton
+        self.compiled = len(patterns)
+        self.stale = stale
+        self.generation += 1
+        for word, pid in patterns:
+            if self.pending.get(word) == pid:
+                self._unpend(word)
+
+    def rebuild(self):
+        '''Build automaton of all words now.
+        '''
+        patterns = list(self.patterns.items())
+        self._swap(patterns, Automaton(patterns), self.generation)
+
+    def rebuild_later(self):
+        '''Build automaton in a thread, conditions are matched meanwhile.
+        '''
+        if self.building:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.rebuild()
+            return
+        self.building = True
+        self.build_next = self.next
+        self.build_stale = 0
+        generation = self.generation
+        patterns = list(self.patterns.items())
+        future = loop.run_in_executor(None, Automaton, patterns)
+
+        def done(future):
+            self.building = False
+            if not future.cancelled() and future.exception() is None:
+                self._swap(patterns, future.result(), generation, self.build_stale)
+            if self._outgrown():
+                self.rebuild_later()
+
+        future.add_done_callback(done)
+
+
+# End of ConditionRegistry
+
+
+def _test():
+    import doctest
+    from pyny import conditions
+    return doctest.testmod(conditions)
+
+
+if __name__ == '__main__':
+    _test()
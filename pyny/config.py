@@ -33,3 +33,107 @@ __version__ = '$Revision: 15 $'
 port = 3776
 address = '0.0.0.0'
 dnsname = ''
+nodecache = 'cache/nodes.dat'
+nodecache_interval = 600  # seconds between saves of node cache
+noderef = 'Noderef.txt'  # @hash node strings added at start, one per line
+
+# Connection scheduler
+speed = 120  # KB/s, line speed of this node
+upstream_target = 2
+downstream_target = 5
+forward_target = 10  # forward links are made by downloads, only shed
+schedule_interval = 10  # seconds
+candidate_scan = 4096  # nodes checked per schedule
+dial_workers = 8
+dial_batch = 16
+dial_timeout = 10  # seconds
+dial_retry = 60  # seconds before a failed node is dialled again, doubled per failure
+dial_retry_max = 3600  # seconds
+
+# Server
+server_backlog = 1024
+server_workers = 0  # executor threads for large commands, 0 is off
+server_offload_size = 0x10000  # bytes
+handshake_timeout = 30  # seconds
+
+# Admission control, 0 is no limit
+max_connections = 10000
+max_links = {'Search': 0, 'Transfer': 0, 'BbsSearch': 0}
+max_loop_lag = 0.5  # seconds
+max_queued_bytes = 256 * 0x100000
+bandwidth_limit = 0  # bytes/s
+admission_interval = 1  # seconds
+
+# Supervisor
+server_processes = 0  # worker processes, 0 is number of CPUs
+supervisor_interval = 1  # seconds
+ipc_address = ('127.0.0.1', 0)
+
+# Offload to process pool
+offload_threshold = 0x40000  # bytes, 0 is off
+offload_workers = 0  # 0 is number of CPUs
+
+# Metrics endpoint, 0 is off
+metrics_port = 0
+metrics_address = '127.0.0.1'
+
+# Probes
+probe_rate = 100  # one of probe_rate calls is measured
+probe_dump = 'log/probe.collapsed'
+
+# Block cache
+blockcache = 'cache/blocks.dat'
+blockcache_size = 0x40000000  # bytes
+
+# Links without RC4, cached blocks are sent by sendfile
+raw_peers = ()  # IP addresses
+sendfile = True
+
+# Download
+download_window = 8  # requests in flight per source
+download_timeout = 30  # seconds
+download_endgame_copies = 2  # sources per block in end game
+download_retries = 2  # downloads again when MD5 of file is wrong
+
+# Upload
+upload_peer_slots = 2  # blocks in progress per peer
+upload_peer_buffer = 0x40000  # bytes, peer is skipped while its send buffer is over it
+
+# Verification
+verify_workers = 2
+verify_batch = 64  # jobs per batch
+
+# Key store
+keystore_size = 2000000  # keys
+keystore_tick = 1  # seconds, resolution of key timers
+keytable_compact_step = 4096  # rows moved into new string blob per change of key table
+
+# Key cache, keys saved for restart
+keycache = 'cache/keys.dat'
+keycache_interval = 600  # seconds between saves
+keycache_warm = 500  # keys taken into key store per step after restart
+keycache_warm_interval = 0.1  # seconds between steps
+keycache_save_step = 250  # keys packed and written per step of save
+keycache_save_pause = 0.01  # seconds between steps of save
+
+# Keyword index
+name_encoding = 'cp932'  # encoding of file names and keywords
+
+# Conditional diffusion
+condition_pending = 1000  # new words checked one by one until automaton is built again
+
+# Query filter, drops queries seen before
+query_seen_time = 120  # seconds
+query_filter_recent = 16384  # query ids kept exactly
+query_filter_bits = 0x100000  # bits of a Bloom filter bucket
+query_filter_hashes = 4
+query_filter_buckets = 4
+
+# Diffusion
+diffusion_hops = 8  # via nodes, queries which have more are not forwarded
+diffusion_peer_batch = 256  # queries written to one link per loop iteration
+diffusion_peer_buffer = 0x40000  # bytes, link is skipped while its send buffer is over it
+diffusion_links_interval = 1  # seconds, upstream and downstream are read from manager again
+
+# Search
+search_timeout = 60  # seconds to wait for responses
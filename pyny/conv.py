@@ -39,6 +39,9 @@ __all__ = [
     'packet_to_int',
     'packet_to_address',
     'address_to_packet',
+    'address_to_int',
+    'parse_address',
+    'int_to_address',
 ]
 
 
@@ -147,6 +150,52 @@ def address_to_packet(address):
     return ''.join(bin)
 
 
+def address_to_int(address):
+    '''Convert IP address to 32 bit integer.
+
+    Sample:
+    >>> address_to_int('192.168.1.10')
+    3232235786
+    '''
+    octet = address.split('.')
+    if len(octet) != 4:
+        raise CommandError('NyCommand: Bad address format')
+    n = 0
+    for i in octet:
+        i = int(i)
+        if i > 0xFF:
+            raise CommandError('NyCommand: Bad address format')
+        n = (n << 8) | i
+    return n
+
+
+def parse_address(address):
+    '''IPv4 address as 32 bit integer, or None if it is not IPv4 address,
+    such as host name of DDNS node.
+
+    Sample:
+    >>> parse_address('192.168.1.10'), parse_address('example.com')
+    (3232235786, None)
+    '''
+    try:
+        n = address_to_int(address)
+    except (CommandError, ValueError, AttributeError):
+        return None
+    if not (0 <= n <= 0xFFFFFFFF):
+        return None
+    return n
+
+
+def int_to_address(n):
+    '''Convert 32 bit integer to IP address.
+
+    Sample:
+    >>> int_to_address(3232235786)
+    '192.168.1.10'
+    '''
+    return '%d.%d.%d.%d' % ((n >> 24) & 0xFF, (n >> 16) & 0xFF, (n >> 8) & 0xFF, n & 0xFF)
+
+
 def _test():
     import doctest
     from pyny import conv
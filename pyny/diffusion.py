@@ -0,0 +1,266 @@
+'''Query Diffusion.
+
+NyQuery which is not a response is forwarded along its direction,
+to upstream links, or to downstream links if is_downstream_query.
+Diffusion queries also go to links which sent NyDiffusionRequest.
+This node is appended to via nodes of forwarded queries, and queries
+which have been through config.diffusion_hops nodes are not forwarded.
+
+Queries are queued and sent at the next loop iteration.
+Each query is packed once for all links,
+and packets to one link are crypted and written at once.
+'''
+#
+# Copyright (c) 2006 Pyny Project.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHORS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# $Id: $
+#
+
+import asyncio
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config
+from .keystore import KeyStore
+from .identity import local
+from .metrics import registry
+from .nycommand import NyQuery, ViaNode
+
+__version__ = '$Revision: $'
+__all__ = ['DiffusionEngine']
+
+forwarded = registry.counter('pyny_queries_forwarded_total', 'Queries forwarded to links',
+                             ('direction', ))
+dropped = registry.counter('pyny_queries_not_forwarded_total', 'Queries not forwarded to links',
+                           ('reason', ))
+
+
+class DiffusionEngine:
+    '''Query Diffusion Engine.
+
+    Register on_query as handler of NyQuery,
+    on_request as handler of NyDiffusionRequest,
+    and drop as close listener of server.
+    Links are sessions of server whose nodes are in upstream or
+    downstream of manager. Keys of queries are put into store if given.
+    Responses are given to on_response(session, query) if it is set,
+    such as aggregator.ResponseAggregator.on_response.
+    Keys put into store of other process are given to on_keys(keys)
+    if it is set, since listeners of that store are not called here.
+
+    Sample:
+    >>> from pyny.node import strnode
+    >>> from pyny.nodelist import NodeManager
+    >>> class Session:
+    ...     def __init__(self, name):
+    ...         self.node, self.closed, self.sent = strnode(name), False, []
+    ...     def queued(self):
+    ...         return 0
+    ...     def send_packets(self, packets, code):
+    ...         self.sent.append([NyQuery(i) for i in packets])
+    >>> class Server:
+    ...     sessions = [Session('192.168.1.%d:4000' % i) for i in range(1, 5)]
+    >>> up1, up2, down1, down2 = Server.sessions
+    >>> manager = NodeManager()
+    >>> manager.update(add=[up1.node, up2.node], listname='upstream')
+    >>> manager.update(add=[down1.node, down2.node], listname='downstream')
+    >>> engine = DiffusionEngine(Server, manager)
+    >>> engine.address = '192.168.1.10'
+    >>> def query(query_id, downstream, *vianode):
+    ...     q = NyQuery()
+    ...     q.is_response = q.is_bbs_query = False
+    ...     q.is_diffusion_query, q.is_downstream_query = True, downstream
+    ...     q.query_id, q.vianode = query_id, list(vianode)
+    ...     return q
+    >>> engine.on_query(down2, query(300, True, ViaNode('192.168.1.4', 4000)))
+    >>> [str(i) for i in down1.sent[0][0].vianode]
+    ['192.168.1.4:4000', '192.168.1.10:3776']
+    >>> up1.sent, down2.sent
+    ([], [])
+
+    Queries of one loop iteration are written at once:
+    >>> import asyncio
+    >>> async def burst():
+    ...     for i in range(3):
+    ...         engine.forward(down1, query(i, False))
+    ...     await asyncio.sleep(0)
+    >>> asyncio.run(burst())
+    >>> [[i.query_id for i in packets] for packets in up1.sent]
+    [[0, 1, 2]]
+    '''
+
+    def __init__(self, server, manager, store=None):
+        self.server = server
+        self.manager = manager
+        self.store = store
+        self.on_response = None
+        self.on_keys = None
+        self.address = None  # address in via nodes, local.best_address() by default
+        self.queue = []  # (session, query)
+        self.requested = set()  # sessions which sent NyDiffusionRequest
+        self.scheduled = False
+        self.members = None  # direction -> names of nodes
+        self.members_time = 0
+        self.store_pool = None  # puts keys into store of other process
+        self.count = 0
+        self.since = monotonic()
+        self.rate = 0.0
+        registry.gauge('pyny_queries_forwarded_per_second', 'Queries forwarded per second',
+                       func=self.throughput)
+
+    def on_query(self, session, query):
+        '''Handler of NyQuery.
+        '''
+        if query.is_response:
+            if self.on_response is not None:
+                self.on_response(session, query)
+            return
+        if (self.store is not None) and query.keyinfo:
+            source = None
+            if session.node is not None:
+                source = session.node.key()
+            if isinstance(self.store, KeyStore):
+                self.store.put_many(query.keyinfo, source)
+            else:
+                # proxy of store in manager process, it is not waited on loop
+                if self.store_pool is None:
+                    self.store_pool = ThreadPoolExecutor(max_workers=1)
+                self.store_pool.submit(self.store.put_many, query.keyinfo, source)
+                if self.on_keys is not None:
+                    self.on_keys(query.keyinfo)
+        self.forward(session, query)
+
+    def on_request(self, session, command):
+        '''Handler of NyDiffusionRequest.
+        '''
+        self.requested.add(session)
+
+    def drop(self, session):
+        self.requested.discard(session)
+
+    def forward(self, session, query):
+        '''Send query to links at the next loop iteration.
+
+        session is where query came from, None if it is made here.
+        '''
+        if len(query.vianode) >= config.diffusion_hops:
+            dropped.labels('hops').inc()
+            return
+        self.queue.append((session, query))
+        if self.scheduled:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        self.scheduled = True
+        loop.call_soon(self.flush)
+
+    def _members(self):
+        '''Names of upstream and downstream nodes.
+
+        They are read from manager every config.diffusion_links_interval
+        seconds, manager may be proxy of other process.
+        '''
+        now = monotonic()
+        if (self.members is None) or (now - self.members_time >= config.diffusion_links_interval):
+            self.members = dict((direction, set(str(i) for i in self.manager.snapshot(direction)))
+                                for direction in ('upstream', 'downstream'))
+            self.members_time = now
+        return self.members
+
+    def _links(self):
+        '''Sessions of upstream and downstream nodes.
+        '''
+        members = self._members()
+        links = {'upstream': [], 'downstream': []}
+        for session in self.server.sessions:
+            if (session.node is None) or session.closed:
+                continue
+            name = str(session.node)
+            for direction, names in members.items():
+                if name in names:
+                    links[direction].append(session)
+        return links
+
+    def flush(self):
+        '''Send queued queries.
+        '''
+        self.scheduled = False
+        queue, self.queue = self.queue, []
+        if not queue:
+            return
+        links = self._links()
+        requested = [i for i in self.requested if not i.closed]
+        via = ViaNode(self.address or local.best_address(), config.port)
+        packets = {}  # session -> packets
+        for origin, query in queue:
+            direction = 'downstream' if query.is_downstream_query else 'upstream'
+            targets = links[direction]
+            if query.is_diffusion_query and requested:
+                targets = list(dict.fromkeys(targets + requested))
+            path = set(str(i) for i in query.vianode)
+            targets = [i for i in targets if (i is not origin) and (str(i.node) not in path)]
+            if not targets:
+                dropped.labels('nolink').inc()
+                continue
+            query.vianode = query.vianode + [via]
+            packet = query.pack()
+            for session in targets:
+                queued = packets.setdefault(session, [])
+                if (len(queued) >= config.diffusion_peer_batch) or \
+                   (session.queued() > config.diffusion_peer_buffer):
+                    dropped.labels('busy').inc()
+                    continue
+                queued.append(packet)
+                forwarded.labels(direction).inc()
+                self.count += 1
+        for session, queued in packets.items():
+            if queued:
+                session.send_packets(queued, NyQuery.code)
+
+    def throughput(self):
+        '''Forwarded queries per second, measured at least for 1 second.
+        '''
+        now = monotonic()
+        if now - self.since >= 1:
+            self.rate = self.count / (now - self.since)
+            self.count = 0
+            self.since = now
+        return self.rate
+
+
+# End of DiffusionEngine
+
+
+def _test():
+    import doctest
+    from pyny import diffusion
+    return doctest.testmod(diffusion)
+
+
+if __name__ == '__main__':
+    _test()
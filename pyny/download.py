@@ -0,0 +1,544 @@
+'''Download Engine.
+
+File is split into blocks of NyFileResponse.data_limit bytes.
+Each source node keeps config.download_window requests in flight.
+When no block is left to request, blocks in flight are requested from
+idle sources too (end game), and the first response wins.
+Blocks are verified by verify.Verifier before they are written into
+block cache. MD5 of the file is updated in order of blocks as they are
+stored, blocks stored before their turn are read back from cache,
+and only blocks evicted before their turn are requested again.
+Senders of corrupt blocks are penalized and dropped, and the blocks are
+requested from other sources.
+'''
+#
+# Copyright (c) 2006 Pyny Project.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHORS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# $Id: $
+#
+
+import asyncio
+import hashlib
+import itertools
+from collections import deque
+from time import monotonic
+
+from . import config
+from . import penalty
+from .nycommand import NyFileRequest, NyFileResponse, NyLiar
+from .verify import check_block, verified
+
+__version__ = '$Revision: $'
+__all__ = ['Download', 'Downloader']
+
+block_size = NyFileResponse.data_limit
+_task_ids = itertools.count(1)
+
+
+class Source:
+    '''Node which has the file.
+
+    Argument session has send(command) and peer, such as NySession.
+    '''
+
+    def __init__(self, session, window):
+        self.session = session
+        self.window = window
+        self.inflight = {}  # block -> request time
+        self.received = 0
+        self.timeouts = 0
+
+    def idle(self):
+        return len(self.inflight) < self.window
+
+
+# End of Source
+
+
+class Download:
+    '''Download of one file.
+
+    Sample:
+    >>> class Session:
+    ...     def __init__(self, peer): self.peer, self.sent = (peer, 7743), []
+    ...     def send(self, command): self.sent.append(command.block_begin)
+    >>> class Cache:
+    ...     def __init__(self): self.blocks = {}
+    ...     def put_response(self, r): self.blocks[r.block_begin] = r.file_data
+    >>> d = Download('fcc3b22beb4c242c', block_size * 3 + 10, Cache(), window=2)
+    >>> a, b = Session('192.0.2.1'), Session('192.0.2.2')
+    >>> d.add_source(a)
+    >>> d.add_source(b)
+    >>> a.sent, b.sent
+    ([0, 1], [2, 3])
+    >>> response = NyFileResponse()
+    >>> response.task_id, response.block_begin = d.task_id, 0
+    >>> response.setvalues(hash='fcc3b22beb4c242c', file_data='x' * block_size)
+    >>> d.on_response(a, response)
+    True
+    >>> a.sent
+    [0, 1, 2]
+    >>> len(d.done), d.complete()
+    (1, False)
+    >>> response.block_begin, response.file_data = 1, 'x'
+    >>> d.on_response(a, response)
+    True
+    >>> d.corrupt, id(a) in d.sources, list(d.missing)
+    (1, False, [1])
+
+    Block evicted before it is hashed is requested again:
+    >>> class Cache:
+    ...     def put_response(self, r): pass
+    ...     def get(self, hash, block): return None
+    >>> data = 'x' * block_size + 'y'
+    >>> hash = hashlib.md5(data.encode('latin-1')).digest().decode('latin-1')
+    >>> d = Download(hash, len(data), Cache(), window=2)
+    >>> d.add_source(a)
+    >>> def respond(block):
+    ...     response = NyFileResponse()
+    ...     response.task_id, response.block_begin = d.task_id, block
+    ...     response.setvalues(hash=hash, file_data=data[block * block_size:(block + 1) * block_size])
+    ...     d.on_response(a, response)
+    >>> a.sent = []
+    >>> respond(1)
+    >>> respond(0)
+    >>> a.sent, d.hashed
+    ([1], 1)
+    >>> respond(1)
+    >>> d.verified
+    True
+    '''
+
+    def __init__(self, hash, file_size, cache, window=None, task_id=None, verifier=None, checksums=None):
+        if window is None:
+            window = config.download_window
+        self.hash = hash
+        self.file_size = file_size
+        self.cache = cache
+        self.window = window
+        self.task_id = task_id or next(_task_ids)
+        self.blocks = (file_size+block_size-1) // block_size
+        self.missing = deque(range(self.blocks))
+        self.requested = {}  # block -> list of Source
+        self.done = set()
+        self.verifying = set()
+        self.sources = {}  # id of session -> Source
+        self.verifier = verifier
+        self.checksums = checksums  # sum32 of blocks, or None
+        self.senders = {}  # block -> address of sender of stored copy
+        self.votes = {}  # block -> {sum32: set of senders}, after broken file
+        self.failures = 0
+        self.corrupt = 0
+        self.verified = None  # MD5 of file matched, None until checked
+        self.md5 = hashlib.md5()
+        self.hashed = 0  # blocks before it are in md5
+        self.sums = [None] * self.blocks  # sum32 of stored blocks
+        self.finished = None
+        self.received = 0
+        self.started = monotonic()
+
+    def complete(self):
+        return len(self.done) == self.blocks
+
+    def over(self):
+        '''File is verified, or given up.
+        '''
+        return self.verified is not None
+
+    def add_source(self, session):
+        if id(session) not in self.sources:
+            self.sources[id(session)] = Source(session, self.window)
+        self.pump()
+
+    def remove_source(self, session):
+        source = self.sources.pop(id(session), None)
+        if source is None:
+            return
+        for block in source.inflight:
+            self._forget(block, source)
+        self.pump()
+
+    def _forget(self, block, source):
+        '''Source does not serve block any more.
+        '''
+        sources = self.requested.get(block)
+        if sources is None:
+            return
+        if source in sources:
+            sources.remove(source)
+        if not sources:
+            del self.requested[block]
+            self._requeue(block)
+
+    def _requeue(self, block):
+        if (block not in self.done) and (block not in self.verifying) and (block not in self.requested):
+            self.missing.appendleft(block)
+
+    def request(self, source, block):
+        request = NyFileRequest()
+        request.task_id = self.task_id
+        request.block_begin = block
+        request.block_size = min(block_size, self.file_size - block * block_size)
+        request.setvalues(hash=self.hash)
+        request.file_size = self.file_size
+        source.inflight[block] = monotonic()
+        self.requested.setdefault(block, []).append(source)
+        source.session.send(request)
+
+    def pump(self):
+        '''Fill windows of all sources.
+        '''
+        for source in list(self.sources.values()):
+            while source.idle():
+                block = self._next_block(source)
+                if block is None:
+                    break
+                self.request(source, block)
+
+    def _next_block(self, source):
+        skipped = []
+        try:
+            while self.missing and (len(skipped) < self.window * len(self.sources)):
+                block = self.missing.popleft()
+                if (block in self.done) or (block in self.requested) or (block in self.verifying):
+                    continue
+                if self._sent_before(source, block):
+                    skipped.append(block)
+                    continue
+                return block
+        finally:
+            self.missing.extendleft(reversed(skipped))
+        if self.missing:
+            return None
+        # end game: the oldest block requested from other sources only
+        oldest = None
+        for block, sources in self.requested.items():
+            if (source in sources) or (len(sources) >= config.download_endgame_copies) or \
+               (block in self.verifying):
+                continue
+            since = min(i.inflight[block] for i in sources)
+            if (oldest is None) or (since < oldest[0]):
+                oldest = (since, block)
+        if oldest is None:
+            return None
+        return oldest[1]
+
+    def _sent_before(self, source, block):
+        '''Source sent a copy of block, and others can send it.
+        '''
+        votes = self.votes.get(block)
+        if votes is None:
+            return False
+        voters = set().union(*votes.values())
+        return (source.session.peer[0] in voters) and \
+               any(i.session.peer[0] not in voters for i in self.sources.values())
+
+    def on_response(self, session, response):
+        '''Response from session, returns False if it is not for us.
+        '''
+        if response.task_id != self.task_id:
+            return False
+        source = self.sources.get(id(session))
+        block = response.block_begin
+        if source is not None:
+            source.inflight.pop(block, None)
+            source.received += len(response.file_data)
+        if (block >= self.blocks) or (block in self.done) or (block in self.verifying):
+            if source is not None:
+                self._forget(block, source)
+        elif not self.accept(source, response):
+            self.reject(session, block)
+        else:
+            self.verifying.add(block)
+            if source is not None:
+                self._forget(block, source)
+            expected = min(block_size, self.file_size - block * block_size)
+            checksum = None if self.checksums is None else self.checksums[block]
+            args = (response.file_data, expected, checksum)
+            if self.verifier is None:
+                self.on_verified(session, response, check_block(*args))
+            else:
+                self.verifier.submit(check_block, args,
+                                     lambda result: self.on_verified(session, response, result))
+        self.pump()
+        return True
+
+    def accept(self, source, response):
+        '''Cheap checks before verification.
+        '''
+        return response.hash == self.hash[:16] + chr(0) * (16 - len(self.hash))
+
+    def on_verified(self, session, response, checksum):
+        '''Result of check_block(), sum32 of good block.
+        '''
+        block = response.block_begin
+        self.verifying.discard(block)
+        if block in self.done:
+            return
+        if not isinstance(checksum, int):
+            self.reject(session, block)
+        elif self.vote(block, session.peer[0], checksum):
+            self.senders[block] = session.peer[0]
+            self.store(block, response, checksum)
+        else:
+            self._requeue(block)
+        self.pump()
+
+    def vote(self, block, sender, checksum):
+        '''Copy of block is stored, or asked to another source.
+
+        After broken file, copy is stored when two senders agree on it,
+        and senders of other copies are penalized.
+        While senders disagree, block is asked to another source.
+        '''
+        votes = self.votes.get(block)
+        if votes is None:
+            return True
+        voters = votes.setdefault(checksum, set())
+        voters.add(sender)
+        if len(voters) >= 2:
+            del self.votes[block]
+            for other, senders in votes.items():
+                if other != checksum:
+                    self._penalize(senders)
+            return True
+        voters = set().union(*votes.values())
+        return all(i.session.peer[0] in voters for i in self.sources.values())
+
+    def _penalize(self, senders):
+        for sender in senders:
+            if sender is not None:
+                penalty.table.penalize(sender, NyLiar.code)
+        for source in list(self.sources.values()):
+            if source.session.peer[0] in senders:
+                self.remove_source(source.session)
+
+    def reject(self, session, block):
+        '''Corrupt block, its sender is penalized and dropped.
+        '''
+        self.corrupt += 1
+        source = self.sources.get(id(session))
+        if source is not None:
+            self._forget(block, source)
+        self._penalize({session.peer[0]})
+        self._requeue(block)
+
+    def store(self, block, response, checksum=None):
+        self.cache.put_response(response)
+        self.done.add(block)
+        self.sums[block] = checksum
+        self.received += len(response.file_data)
+        for other in self.requested.pop(block, []):
+            other.inflight.pop(block, None)
+        if block == self.hashed:
+            self.md5.update(response.file_data.encode('latin-1'))
+            self.hashed += 1
+        self.advance()
+
+    def advance(self):
+        '''Hash stored blocks in order, and check file when all are hashed.
+
+        Block evicted from cache before its turn is requested again,
+        it is hashed as soon as it is stored.
+        '''
+        while (self.hashed < self.blocks) and (self.hashed in self.done):
+            block = self.cache.get(self.hash, self.hashed)
+            if block is None:
+                self.done.discard(self.hashed)
+                self._requeue(self.hashed)
+                return
+            with block as data:
+                self.md5.update(data)
+            self.hashed += 1
+        if self.hashed == self.blocks:
+            self.check_file()
+
+    def check_file(self):
+        hash = self.hash
+        if isinstance(hash, str):
+            hash = hash.encode('latin-1')
+        ok = self.md5.digest() == hash
+        verified.labels('file', 'ok' if ok else 'corrupt').inc()
+        self.on_file_checked(ok)
+
+    def on_file_checked(self, ok):
+        '''Finish, or download again.
+
+        When file is broken, all blocks are requested again, and copies
+        are voted by their senders.
+        Senders of copies which differ from the good file are penalized.
+        '''
+        sums = self.sums
+        if ok:
+            for block, votes in self.votes.items():
+                self._penalize(set().union(*[v for k, v in votes.items() if k != sums[block]]))
+            self.votes = {}
+            self.finish(True)
+            return
+        self.failures += 1
+        if self.failures > config.download_retries:
+            self.finish(False)
+            return
+        for block, checksum in enumerate(sums):
+            self.votes.setdefault(block, {}).setdefault(checksum, set()).add(self.senders.get(block))
+        self.done.clear()
+        self.senders.clear()
+        self.md5 = hashlib.md5()
+        self.hashed = 0
+        self.sums = [None] * self.blocks
+        self.missing = deque(range(self.blocks))
+        self.pump()
+
+    def finish(self, verified):
+        self.verified = verified
+        if (self.finished is not None) and (not self.finished.done()):
+            self.finished.set_result(self)
+
+    def check_timeouts(self, now=None):
+        '''Requests slower than config.download_timeout go to other sources.
+        '''
+        if now is None:
+            now = monotonic()
+        for source in list(self.sources.values()):
+            for block, since in list(source.inflight.items()):
+                if now - since > config.download_timeout:
+                    del source.inflight[block]
+                    source.timeouts += 1
+                    self._forget(block, source)
+        self.pump()
+
+    def rate(self):
+        '''Bytes per second.
+        '''
+        return self.received / max(monotonic() - self.started, 0.001)
+
+    async def wait(self):
+        '''Wait until the file is verified or given up.
+        '''
+        loop = asyncio.get_running_loop()
+        if self.finished is None:
+            self.finished = loop.create_future()
+            if self.over():
+                self.finished.set_result(self)
+        while True:
+            try:
+                return await asyncio.wait_for(asyncio.shield(self.finished), config.download_timeout / 2)
+            except asyncio.TimeoutError:
+                self.check_timeouts()
+
+
+# End of Download
+
+
+class Downloader:
+    '''Downloads by task_id.
+
+    Register on_response as handler of NyFileResponse,
+    and drop as close listener of server.
+    Downloads verified after their last response are stopped by stop().
+    Timeouts of downloads are checked by sweep task while they run,
+    it is started by start() in event loop.
+
+    Sample:
+    >>> import asyncio
+    >>> class Session:
+    ...     def __init__(self, peer): self.peer, self.sent = (peer, 7743), []
+    ...     def send(self, command): self.sent.append(command.block_begin)
+    >>> async def main():
+    ...     a = Session('192.0.2.1')
+    ...     d = Downloader(None, interval=0.01).start('fcc3b22beb4c242c', block_size * 2, [a])
+    ...     source = d.sources[id(a)]
+    ...     for block in source.inflight:
+    ...         source.inflight[block] -= config.download_timeout + 1
+    ...     await asyncio.sleep(0.05)
+    ...     return a.sent, source.timeouts
+    >>> asyncio.run(main())
+    ([0, 1, 1, 0], 2)
+    '''
+
+    def __init__(self, cache, verifier=None, interval=None):
+        if interval is None:
+            interval = config.download_timeout / 2
+        self.cache = cache
+        self.verifier = verifier
+        self.interval = interval
+        self.downloads = {}
+        self.sweeper = None
+
+    def start(self, hash, file_size, sessions=(), checksums=None):
+        download = Download(hash, file_size, self.cache, verifier=self.verifier, checksums=checksums)
+        self.downloads[download.task_id] = download
+        for session in sessions:
+            download.add_source(session)
+        if self.sweeper is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                pass  # no sweep, Download.wait() checks timeouts
+            else:
+                self.sweeper = loop.create_task(self.sweep())
+        return download
+
+    def stop(self, download):
+        self.downloads.pop(download.task_id, None)
+
+    def drop(self, session):
+        '''Remove closed session from sources of downloads.
+        '''
+        for download in list(self.downloads.values()):
+            download.remove_source(session)
+
+    def on_response(self, session, response):
+        download = self.downloads.get(response.task_id)
+        if download is not None:
+            download.on_response(session, response)
+            if download.over():
+                self.stop(download)
+
+    async def sweep(self):
+        '''Check timeouts of downloads every interval seconds,
+        until no download is left.
+        '''
+        try:
+            while self.downloads:
+                await asyncio.sleep(self.interval)
+                now = monotonic()
+                for download in list(self.downloads.values()):
+                    download.check_timeouts(now)
+        finally:
+            self.sweeper = None
+
+
+# End of Downloader
+
+
+def _test():
+    import doctest
+    from pyny import download
+    return doctest.testmod(download)
+
+
+if __name__ == '__main__':
+    _test()
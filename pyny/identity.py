@@ -0,0 +1,222 @@
+'''Local Node Identity.
+
+Addresses of this node: configured address, addresses of interfaces,
+address of config.dnsname, and address reported by other nodes
+(NyNodeDetails, it is global address when we are behind NAT).
+'''
+#
+# Copyright (c) 2006 Pyny Project.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHORS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# $Id: $
+#
+
+import socket
+from threading import Lock, Thread
+
+from . import config
+from .conv import parse_address
+
+__version__ = '$Revision: $'
+__all__ = ['LocalIdentity', 'local']
+
+any_address = '0.0.0.0'
+loopback_address = '127.0.0.1'
+
+
+def interface_addresses():
+    '''IPv4 addresses bound to this host.
+    '''
+    addresses = set([loopback_address])
+    try:
+        for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET):
+            addresses.add(info[4][0])
+    except (socket.error, UnicodeError):
+        pass
+    return addresses
+
+
+def resolve(hostname):
+    '''IPv4 addresses of hostname.
+    '''
+    if not hostname:
+        return set()
+    try:
+        return set(socket.gethostbyname_ex(hostname)[2])
+    except (socket.error, UnicodeError):
+        return set()
+
+
+class LocalIdentity:
+    '''Local Node Identity.
+
+    Addresses are kept as integer sets, and they are swapped on update,
+    so isself() needs no lock. Updates are made under lock, so refresh()
+    in a thread and report() from server do not undo each other.
+    Until refresh() is called, configured and loopback addresses are used,
+    and refresh() runs in a thread, so the first check does not wait DNS.
+    Nodes of host names are compared with config.dnsname by name.
+
+    Sample:
+    >>> from pyny.node import strnode
+    >>> me = LocalIdentity()
+    >>> me.refresh(interfaces=['192.168.1.10'])
+    >>> me.isself(strnode('192.168.1.10:%d' % config.port))
+    True
+    >>> me.isself(strnode('192.168.1.10:1'))
+    False
+    >>> me.isself(strnode('example.com:%d' % config.port))
+    False
+    >>> me.isself_address('192.168.1.10', config.port)
+    True
+    >>> me.best_address()
+    '192.168.1.10'
+    >>> me.report('203.0.113.5')
+    >>> me.isself(strnode('203.0.113.5:%d' % config.port))
+    True
+    >>> me.best_address()
+    '203.0.113.5'
+    >>> me.report('203.0.113.6')
+    >>> me.isself(strnode('203.0.113.5:%d' % config.port))
+    False
+    '''
+
+    def __init__(self):
+        self.ready = False
+        self.refreshing = False
+        self.lock = Lock()
+        self.reported_address = None
+        self._found = set()
+        self.addresses = frozenset()
+        self.nodes = frozenset()
+
+    def refresh(self, interfaces=None):
+        '''Collect addresses again.
+
+        Argument interfaces is list of bound addresses,
+        interface addresses of the host are used by default.
+        '''
+        found = set()
+        if config.address != any_address:
+            found.add(config.address)
+        elif interfaces is None:
+            found.update(interface_addresses())
+        if interfaces is not None:
+            found.update(interfaces)
+        found.update(resolve(config.dnsname))
+        with self.lock:
+            self._found = found
+            self._update()
+
+    def report(self, address):
+        '''Address reported by other node.
+
+        It replaces address reported before.
+        Argument address is IP address or NyNodeDetails.
+        '''
+        if not isinstance(address, str):
+            address = address.address
+        with self.lock:
+            if address == self.reported_address:
+                return
+            self.reported_address = address
+            self._update()
+
+    def _update(self):
+        '''Make address sets of found and reported addresses.
+
+        It is called with lock held.
+        '''
+        found = set(self._found)
+        if self.reported_address:
+            found.add(self.reported_address)
+        addresses = frozenset(i for i in map(parse_address, found) if i is not None)
+        self.nodes = frozenset((i << 16) | (config.port & 0xFFFF) for i in addresses)
+        self.addresses = addresses
+        self.ready = True
+
+    def _prepare(self):
+        '''Make addresses ready without DNS, and refresh them in a thread.
+        '''
+        with self.lock:
+            if self.ready or self.refreshing:
+                return
+            self.refreshing = True
+            found = set([loopback_address])
+            if config.address != any_address:
+                found.add(config.address)
+            self._found = found
+            self._update()
+        Thread(target=self.refresh, daemon=True).start()
+
+    def isself(self, node):
+        if not self.ready:
+            self._prepare()
+        key = node.key()
+        if key is None:
+            return bool(config.dnsname) and (node.addr == config.dnsname) and \
+                (node.port == config.port)
+        if key in self.nodes:
+            return True
+        reported = getattr(node, 'reported_address', None)
+        return bool(reported) and (parse_address(reported) in self.addresses)
+
+    def best_address(self):
+        '''Address of this node to tell other nodes.
+
+        Address reported by other node is preferred.
+        '''
+        if not self.ready:
+            self._prepare()
+        if self.reported_address:
+            return self.reported_address
+        for address in sorted(self._found):
+            if address != loopback_address:
+                return address
+        return loopback_address
+
+    def isself_address(self, address, port):
+        '''isself() of address and port, such as ViaNode of NyQuery.
+        '''
+        if not self.ready:
+            self._prepare()
+        address = parse_address(address)
+        if address is None:
+            return False
+        return ((address << 16) | (port & 0xFFFF)) in self.nodes
+
+
+# End of LocalIdentity
+
+local = LocalIdentity()
+
+
+def _test():
+    import doctest
+    from pyny import identity
+    return doctest.testmod(identity)
+
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,420 @@
+'''Persistent Key Cache.
+
+Key cache file is a header, keys in the layout of NyKeyInformation.pack(),
+and index records sorted by hash.
+Index records have expire times of keys in seconds since the epoch,
+so keys loaded after a downtime have their timers shortened by it.
+File is mapped by mmap, so loading it does not parse records,
+and keys are decoded when they are taken into key store.
+Keys are packed and written by config.keycache_save_step keys,
+and saving thread sleeps between steps, so it does not hold the GIL
+for the whole store.
+'''
+#
+# Copyright (c) 2006 Pyny Project.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHORS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# $Id: $
+#
+
+import asyncio
+import logging
+import os
+import mmap
+import struct
+from bisect import bisect_left
+from threading import Thread, Event
+from time import time, sleep
+
+from . import config
+from .nykey import NyKeyInformation
+from .nyexcept import *
+
+__version__ = '$Revision: $'
+__all__ = ['KeyCache', 'KeyKeeper', 'restore']
+
+log = logging.getLogger(__name__)
+
+magic = b'PYNYKEYS'
+file_version = 2
+
+header = struct.Struct('<8sIIQQ')  # magic, version, record size, count, saved time
+record = struct.Struct('<QQQII')  # hash key, source, offset, length, expire
+keyfield = struct.Struct('<Q')  # hash key at head of record
+chunk = 10000  # keys taken from cache per step before save
+
+
+def hashkey(hash):
+    '''Sort key of hash, its first 8 bytes.
+
+    Sample:
+    >>> hex(hashkey('fcc3b22beb4c242c'))
+    '0x6663633362323262'
+    '''
+    return int.from_bytes(hash.encode('latin-1')[:8].ljust(8, b'\0'), 'big')
+
+
+class RecordKeys:
+    '''Hash keys of records in mapping, for bisect.
+
+    Keys are read as little endian whatever the host is.
+    '''
+
+    def __init__(self, records):
+        self.records = records
+        self.count = len(records) // record.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not (0 <= i < self.count):
+            raise IndexError(i)
+        return keyfield.unpack_from(self.records, i * record.size)[0]
+
+
+# End of RecordKeys
+
+
+class KeyCache:
+    '''Key Cache.
+
+    Keys are taken once, by take() when their hash is asked,
+    or by take_next() in order of file, and expired keys are skipped.
+    KeyStore.restore() makes key store take keys from cache.
+
+    Sample:
+    >>> import os, tempfile
+    >>> from pyny.keystore import KeyStore
+    >>> from pyny.nykey import NyKeyInformation
+    >>> path = os.path.join(tempfile.mkdtemp(), 'keys.dat')
+    >>> s = KeyStore(size=10, tick=1)
+    >>> for port, timer in ((4000, 100), (4001, 50), (4002, 300)):
+    ...     k = NyKeyInformation()
+    ...     k.hash = 'fcc3b22beb4c242c' if port < 4002 else 'a8e0c7ff9a4b5d31'
+    ...     k.file_name, k.timer = 'file%d' % port, timer
+    ...     k.sharing_address, k.sharing_port = '192.168.1.1', port
+    ...     k.bbs_address = '0.0.0.0'
+    ...     s.put(k, source=7, now=1000)
+    >>> cache = KeyCache(path)
+    >>> cache.save(s, now=1000)
+    3
+    >>> cache = KeyCache(path)
+    >>> cache.load()
+    >>> len(cache), cache.saved
+    (3, 1000)
+    >>> s = KeyStore(size=10, tick=1)
+    >>> events, restored = [], []
+    >>> s.listeners.append(lambda k, added: events.append(k.file_name))
+    >>> s.restore_listeners.append(lambda k, added: restored.append(k.file_name))
+    >>> s.restore(cache)
+
+    After a downtime of 60 seconds:
+    >>> [(k.file_name, k.timer) for k in s.find('fcc3b22beb4c242c', now=1060)]
+    [('file4000', 40)]
+    >>> len(s), len(cache)
+    (1, 1)
+    >>> s.warm(100, now=1060)
+    1
+    >>> [k.file_name for k in s.from_source(7, now=1060)]
+    ['file4000', 'file4002']
+    >>> s.snapshot is None
+    True
+    >>> events, sorted(restored)
+    ([], ['file4000', 'file4002'])
+    '''
+
+    def __init__(self, path=None):
+        if path is None:
+            path = config.keycache
+        self.path = path
+        self.saved = 0
+        self.count = 0
+        self.left = 0
+        self.cursor = 0
+        self.taken = None
+        self._file = None
+        self._map = None
+        self._view = None
+        self._keys = ()
+        self._records = None
+        self._data = None
+
+    def __len__(self):
+        '''Number of keys not taken yet.
+        '''
+        return self.left
+
+    def load(self):
+        '''Map key cache file.
+        '''
+        self.close()
+        if (not os.path.exists(self.path)) or \
+           (os.path.getsize(self.path) <= header.size):
+            return
+        self._file = open(self.path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        head, version, size, count, saved = header.unpack_from(self._map)
+        end = len(self._map) - count * size
+        if (head != magic) or (version != file_version) or (size != record.size) or \
+           (end < header.size):
+            self.close()
+            raise KeyCacheError('KeyCache: broken key cache file')
+        self._view = memoryview(self._map)
+        self._data = self._view[header.size:end]
+        self._records = self._view[end:]
+        self._keys = RecordKeys(self._records)
+        self.saved = saved
+        self.count = self.left = count
+        self.cursor = 0
+        self.taken = bytearray(count)
+
+    def close(self):
+        if self._map is not None:
+            for view in (self._records, self._data, self._view):
+                if view is not None:
+                    view.release()
+            self._keys = ()
+            self._records = None
+            self._data = None
+            self._view = None
+            self._map.close()
+            self._map = None
+            self._file.close()
+            self._file = None
+        self.count = self.left = self.cursor = 0
+        self.taken = None
+
+    def _take(self, i, now):
+        '''(keyinfo, source) of record i, or None if it is expired.
+        '''
+        self.taken[i] = 1
+        self.left -= 1
+        key, source, offset, length, expire = \
+            record.unpack_from(self._records, i * record.size)
+        if expire <= now:
+            return None
+        keyinfo = NyKeyInformation(bytes(self._data[offset:offset + length]).decode('latin-1'))
+        keyinfo.timer = expire - int(now)
+        return (keyinfo, source or None)
+
+    def take(self, hash, now=None):
+        '''Keys of hash not taken yet, as list of (keyinfo, source).
+        '''
+        if not self.left:
+            return []
+        if now is None:
+            now = time()
+        key = hashkey(hash)
+        keys = self._keys
+        result = []
+        i = bisect_left(keys, key)
+        while (i < len(keys)) and (keys[i] == key):
+            if not self.taken[i]:
+                item = self._take(i, now)
+                if item is not None:
+                    if item[0].hash == hash:
+                        result.append(item)
+                    else:
+                        # other hash of the same sort key
+                        self.taken[i] = 0
+                        self.left += 1
+            i += 1
+        return result
+
+    def take_next(self, count, now=None):
+        '''Up to count keys not taken yet in order of file.
+        '''
+        if now is None:
+            now = time()
+        result = []
+        while (self.cursor < self.count) and (len(result) < count):
+            i = self.cursor
+            self.cursor += 1
+            if not self.taken[i]:
+                item = self._take(i, now)
+                if item is not None:
+                    result.append(item)
+        return result
+
+    def save(self, store, now=None, pause=0):
+        '''Write keys of store into key cache file atomically,
+        and returns number of them.
+
+        Keys not taken from cache are taken into store first.
+        Keys are written by steps, with pause seconds between them.
+        '''
+        if now is None:
+            now = time()
+        step = config.keycache_save_step
+        while store.snapshot is not None:
+            store.warm(chunk, now)
+        with store.lock:
+            keys = list(store.entries)
+        tmppath = self.path + '.tmp'
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        index = bytearray()
+        order = []  # hash key << 32 | number of record
+        with open(tmppath, 'wb') as f:
+            f.write(header.pack(magic, file_version, record.size, 0, int(now)))
+            offset = 0
+            for i in range(0, len(keys), step):
+                data = []
+                for keyinfo, expire, source in store.items(keys[i:i + step], now):
+                    packed = keyinfo.pack().encode('latin-1')
+                    key = hashkey(keyinfo.hash)
+                    order.append((key << 32) | len(order))
+                    index += record.pack(key, source or 0, offset, len(packed), expire)
+                    offset += len(packed)
+                    data.append(packed)
+                f.write(b''.join(data))
+                if pause:
+                    sleep(pause)
+            order.sort()
+            records = memoryview(index)
+            for i in range(0, len(order), step):
+                f.write(b''.join(records[(n & 0xFFFFFFFF) * record.size:][:record.size]
+                                 for n in order[i:i + step]))
+            records.release()
+            f.seek(0)
+            f.write(header.pack(magic, file_version, record.size, len(order), int(now)))
+            f.flush()
+            os.fsync(f.fileno())
+        self.close()
+        os.replace(tmppath, self.path)
+        return len(order)
+
+    async def run(self, store, interval=None):
+        '''Take keys into store, and save store every interval seconds.
+        '''
+        if interval is None:
+            interval = config.keycache_interval
+        loop = asyncio.get_running_loop()
+        while store.snapshot is not None:
+            store.warm(config.keycache_warm)
+            await asyncio.sleep(config.keycache_warm_interval)
+        while True:
+            await asyncio.sleep(interval)
+            await loop.run_in_executor(None, self.save, store, None, config.keycache_save_pause)
+
+
+# End of KeyCache
+
+
+def restore(store, path=None):
+    '''Load key cache into store, and returns the cache.
+
+    Broken key cache file is skipped, it is replaced at the next save.
+
+    Sample:
+    >>> import os, tempfile
+    >>> from pyny.keystore import KeyStore
+    >>> path = os.path.join(tempfile.mkdtemp(), 'keys.dat')
+    >>> with open(path, 'wb') as f:
+    ...     f.write(b'x' * 100)
+    100
+    >>> s = KeyStore()
+    >>> cache = restore(s, path)
+    >>> len(cache), s.snapshot
+    (0, None)
+    '''
+    cache = KeyCache(path)
+    try:
+        cache.load()
+    except KeyCacheError:
+        log.warning('%s: broken key cache is skipped', cache.path)
+    store.restore(cache)
+    return cache
+
+
+class KeyKeeper(Thread):
+    '''Key cache of key store out of event loop of server.
+
+    It runs KeyCache.run() in its own loop, for the key store in manager
+    process of supervisor. stop() saves key store once more.
+
+    Sample:
+    >>> import os, tempfile
+    >>> from pyny.keystore import KeyStore
+    >>> from pyny.nykey import NyKeyInformation
+    >>> path = os.path.join(tempfile.mkdtemp(), 'keys.dat')
+    >>> s = KeyStore()
+    >>> keeper = KeyKeeper(s, path)
+    >>> keeper.start()
+    >>> k = NyKeyInformation()
+    >>> k.hash, k.file_name, k.timer = 'fcc3b22beb4c242c', 'abc', 100
+    >>> k.sharing_address = k.bbs_address = '192.168.1.1'
+    >>> s.put(k)
+    >>> keeper.stop()
+    >>> s = KeyStore()
+    >>> cache = restore(s, path)
+    >>> [i.file_name for i in s.find('fcc3b22beb4c242c')]
+    ['abc']
+    '''
+
+    def __init__(self, store, path=None):
+        Thread.__init__(self)
+        self.daemon = True
+        self.store = store
+        self.cache = restore(store, path)
+        self.loop = None
+        self.task = None
+        self.ready = Event()
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        self.task = self.loop.create_task(self.cache.run(self.store))
+        self.ready.set()
+        try:
+            self.loop.run_until_complete(self.task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            # a save in executor is finished before the last one
+            self.loop.run_until_complete(self.loop.shutdown_default_executor())
+            self.loop.close()
+            try:
+                self.cache.save(self.store)
+            except Exception:
+                log.exception('KeyKeeper: save failed')
+
+    def stop(self):
+        self.ready.wait()
+        self.loop.call_soon_threadsafe(self.task.cancel)
+        self.join()
+
+
+# End of KeyKeeper
+
+
+def _test():
+    import doctest
+    from pyny import keycache
+    return doctest.testmod(keycache)
+
+
+if __name__ == '__main__':
+    _test()
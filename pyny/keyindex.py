@@ -0,0 +1,259 @@
+'''Keyword Index.
+
+File names of keys are decoded by config.name_encoding, and normalized
+by NFKC and lower case.
+Words of ASCII letters and digits are indexed by trigrams and their
+first two letters, other words by characters and character bigrams,
+so names without spaces, such as Japanese names, are found by any part.
+ASCII query words of two letters match beginning of words only.
+Posting lists are sorted array('I') of document numbers, 4 bytes each.
+
+Query is words separated by spaces, words beginning with '-' are NOT.
+Candidates are intersection of postings of AND words, by bisect when
+one is much shorter or when more matches than limit are expected,
+or by set, and they are checked by substring of their names.
+'''
+#
+# Copyright (c) 2006 Pyny Project.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHORS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# $Id: $
+#
+
+import re
+import unicodedata
+from array import array
+from bisect import bisect_left
+
+from . import config
+from .keystore import keyid
+
+__version__ = '$Revision: $'
+__all__ = ['KeywordIndex', 'normalize', 'terms']
+
+_ascii = re.compile(r'[0-9a-z]+')
+_other = re.compile(r'[^\W0-9a-z_]+')
+
+
+def normalize(name):
+    '''Decode file name of key or keyword, and normalize it.
+
+    Sample:
+    >>> normalize('ＡＢＣ abc'.encode('cp932').decode('latin-1'))
+    'abc abc'
+    '''
+    data = name.encode('latin-1', 'replace')
+    text = data.decode(config.name_encoding, 'replace')
+    return unicodedata.normalize('NFKC', text).lower()
+
+
+def terms(text, query=False):
+    '''Index terms of normalized text.
+
+    Terms of query are ones which all names having it have.
+
+    Sample:
+    >>> sorted(terms('abcd 日本語 x'))
+    ['ab', 'abc', 'bcd', 'x', '日', '日本', '本', '本語', '語']
+    >>> sorted(terms('bcd x 本', query=True))
+    ['bcd', '本']
+    '''
+    result = set()
+    for word in _ascii.findall(text):
+        if len(word) < 3:
+            if not query or len(word) == 2:
+                result.add(word)
+            continue
+        if not query:
+            result.add(word[:2])
+        for i in range(len(word) - 2):
+            result.add(word[i:i + 3])
+    for word in _other.findall(text):
+        if query and len(word) > 1:
+            result.update(word[i:i + 2] for i in range(len(word) - 1))
+            continue
+        result.update(word)
+        result.update(word[i:i + 2] for i in range(len(word) - 1))
+    return result
+
+
+def _contains(posting, doc):
+    i = bisect_left(posting, doc)
+    return (i < len(posting)) and (posting[i] == doc)
+
+
+class KeywordIndex:
+    '''Keyword Index.
+
+    Documents are keyids of key store, numbered in order of addition,
+    so postings are sorted by appending.
+    Removed documents are left in postings until half of a posting is
+    removed ones.
+    attach(store) follows additions and removals of key store.
+
+    Sample:
+    >>> i = KeywordIndex()
+    >>> i.add('k1', 'Winny Manual.pdf')
+    >>> i.add('k2', 'winny source.zip')
+    >>> i.add('k3', 'manual of python.pdf')
+    >>> i.search('winny')
+    ['k1', 'k2']
+    >>> i.search('manual -winny')
+    ['k3']
+    >>> i.search('.pdf man')
+    ['k1', 'k3']
+    >>> i.remove('k1')
+    >>> i.search('manual')
+    ['k3']
+    '''
+
+    def __init__(self):
+        self.postings = {}  # term -> array('I') of documents
+        self.removed = {}  # term -> removed documents in posting
+        self.docs = {}  # document -> (keyid, normalized name)
+        self.numbers = {}  # keyid -> document
+        self.dead = {}  # removed document -> postings which have it
+        self.next = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def attach(self, store):
+        store.listeners.append(self.on_key)
+        store.restore_listeners.append(self.on_key)
+
+    def on_key(self, keyinfo, added):
+        if added:
+            self.add(keyid(keyinfo), keyinfo.file_name)
+        else:
+            self.remove(keyid(keyinfo))
+
+    def add(self, key, name):
+        if key in self.numbers:
+            self.remove(key)
+        doc = self.next
+        self.next += 1
+        text = normalize(name)
+        self.docs[doc] = (key, text)
+        self.numbers[key] = doc
+        for term in terms(text):
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = array('I')
+                self.postings[term] = posting
+            posting.append(doc)
+
+    def remove(self, key):
+        doc = self.numbers.pop(key, None)
+        if doc is None:
+            return
+        key, text = self.docs.pop(doc)
+        found = terms(text)
+        self.dead[doc] = len(found)
+        for term in found:
+            removed = self.removed.get(term, 0) + 1
+            if removed * 2 > len(self.postings[term]):
+                self._compact(term)
+            else:
+                self.removed[term] = removed
+
+    def _compact(self, term):
+        posting = self.postings[term]
+        live = array('I')
+        dead = self.dead
+        for doc in posting:
+            if doc in dead:
+                dead[doc] -= 1
+                if not dead[doc]:
+                    del dead[doc]
+            else:
+                live.append(doc)
+        self.removed.pop(term, None)
+        if live:
+            self.postings[term] = live
+        else:
+            del self.postings[term]
+
+    def search(self, query, limit=None):
+        '''keyids of names which have all words, and no NOT words.
+        '''
+        words = []
+        nots = []
+        for word in normalize(query).split():
+            if word.startswith('-'):
+                if len(word) > 1:
+                    nots.append(word[1:])
+            else:
+                words.append(word)
+        found = set()
+        for word in words:
+            found |= terms(word, query=True)
+        postings = []
+        for term in found:
+            posting = self.postings.get(term)
+            if posting is None:
+                return []
+            postings.append(posting)
+        if not postings:
+            return []
+        postings.sort(key=len)
+        candidates = postings[0]
+        expected = float(len(candidates))
+        for posting in postings[1:]:
+            expected *= len(posting) / max(len(self.docs), 1)
+        if (limit is not None) and (expected >= limit):
+            # many matches, stop at limit
+            others = postings[1:]
+            candidates = (doc for doc in candidates if all(_contains(p, doc) for p in others))
+        else:
+            for posting in postings[1:]:
+                if len(candidates) * 16 < len(posting):
+                    candidates = [doc for doc in candidates if _contains(posting, doc)]
+                else:
+                    candidates = sorted(set(candidates).intersection(posting))
+        result = []
+        docs = self.docs
+        for doc in candidates:
+            item = docs.get(doc)
+            if item is None:
+                continue
+            key, text = item
+            if all(w in text for w in words) and not any(w in text for w in nots):
+                result.append(key)
+                if len(result) == limit:
+                    break
+        return result
+
+
+# End of KeywordIndex
+
+
+def _test():
+    import doctest
+    from pyny import keyindex
+    return doctest.testmod(keyindex)
+
+
+if __name__ == '__main__':
+    _test()
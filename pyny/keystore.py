@@ -0,0 +1,419 @@
+'''Key Store.
+
+NyKeyInformation records are kept by (hash, sharing address, port),
+and indexed by hash and by source node which sent them.
+Expire times are in a timer wheel of config.keystore_tick seconds,
+so time goes on by emptying slots, not by counting down each key.
+When more than config.keystore_size keys are stored,
+keys of shortest remaining time are evicted.
+With keytable.KeyTable, keys are stored in its columns, not as objects,
+and a key costs about 550 bytes with its indexes, against 770 bytes
+without it (200,000 keys, two keys per hash).
+With keycache.KeyCache, keys saved before restart are taken from it
+when their hash is asked, and by warm() in background.
+'''
+#
+# Copyright (c) 2006 Pyny Project.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHORS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# $Id: $
+#
+
+import copy
+from threading import Lock
+from time import time
+
+from . import config
+from .metrics import registry
+
+__version__ = '$Revision: $'
+__all__ = ['KeyStore', 'keyid']
+
+wheel_size = 0x10000  # ticks, longer than max timer of keys
+expired = registry.counter('pyny_keys_removed_total', 'Keys removed from key store', ('reason', ))
+
+
+def keyid(keyinfo):
+    '''Identity of key, (hash, sharing address, sharing port).
+    '''
+    return (keyinfo.hash, keyinfo.sharing_address, keyinfo.sharing_port)
+
+
+class KeyStore:
+    '''Key Store.
+
+    Entries are dict of keyid -> [keyinfo, expire tick, source],
+    or keyid -> row with table, whose columns have expire time and source.
+    Key of row is in list of rows, and keys from a source are found by
+    mask of table, so keys cost no Python object but keyid and its indexes.
+    Timers of keys returned by find() and get() are remaining seconds,
+    they are copies of stored keys.
+    Listeners are called as listener(keyinfo, added) when keys are
+    added or removed, or file names of keys are changed (removed and added),
+    with lock held, so they must not change the store.
+
+    Sample:
+    >>> from pyny.nykey import NyKeyInformation
+    >>> def key(name, port, timer):
+    ...     k = NyKeyInformation()
+    ...     k.hash, k.file_name, k.timer = 'fcc3b22beb4c242c', name, timer
+    ...     k.sharing_address, k.sharing_port = '192.168.1.1', port
+    ...     return k
+    >>> s = KeyStore(size=2, tick=1)
+    >>> s.put(key('a', 4000, 100), source=1, now=0)
+    >>> s.put(key('a', 4001, 50), source=2, now=0)
+    >>> [k.sharing_port for k in s.find('fcc3b22beb4c242c', now=10)]
+    [4000, 4001]
+    >>> s.get('fcc3b22beb4c242c', '192.168.1.1', 4000, now=10).timer
+    90
+    >>> s.put(key('b', 4002, 70), source=1, now=10)
+    >>> sorted(k.sharing_port for k in s.from_source(1, now=10))
+    [4000, 4002]
+    >>> s.expire(now=80)
+    1
+    >>> [k.file_name for k in s.find('fcc3b22beb4c242c', now=80)]
+    ['a']
+    >>> events = []
+    >>> s.listeners.append(lambda k, added: events.append((k.file_name, added)))
+    >>> s.put(key('c', 4000, 100), source=1, now=80)
+    >>> events
+    [('a', False), ('c', True)]
+
+    With table:
+    >>> from pyny.keytable import KeyTable
+    >>> s = KeyStore(size=2, tick=1, table=KeyTable())
+    >>> s.put(key('a', 4000, 100), source=1, now=0)
+    >>> s.put(key('a', 4001, 50), source=2, now=0)
+    >>> s.put(key('b', 4002, 70), source=1, now=10)
+    >>> [(k.file_name, k.timer) for k in s.from_source(1, now=10)]
+    [('a', 90), ('b', 70)]
+    >>> len(s.table)
+    2
+    >>> [k.file_name for k in s.select(ttl=80, now=10)]
+    ['a']
+    >>> s.remove_source(1), len(s), len(s.table)
+    (2, 0, 0)
+    '''
+
+    def __init__(self, size=None, tick=None, table=None):
+        if size is None:
+            size = config.keystore_size
+        if tick is None:
+            tick = config.keystore_tick
+        self.size = size
+        self.tick = tick
+        self.table = table
+        self.lock = Lock()
+        self.entries = {}
+        self.by_hash = {}  # hash -> list of keyid, few keys share a hash
+        self.by_source = {}  # source -> {keyid: None}, without table
+        self.keys = []  # row -> keyid, with table
+        self.wheel = [None] * wheel_size  # tick % wheel_size -> set of keyid
+        self.now = None  # tick which is expired up to
+        self.low = 0  # no key expires before this tick
+        self.listeners = []
+        self.restore_listeners = []  # called for keys taken from snapshot
+        self.snapshot = None  # keycache.KeyCache which has keys not taken
+        registry.gauge('pyny_keys', 'Keys in key store', func=lambda: len(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def _tick(self, now):
+        if now is None:
+            now = time()
+        return int(now // self.tick)
+
+    def _entry(self, key):
+        '''[keyinfo or row, expire tick, source] of keyid, or None.
+        '''
+        value = self.entries.get(key)
+        if (value is None) or (self.table is None):
+            return value
+        return [value, self.table.expire[value] // self.tick, self.table.source[value] or None]
+
+    def _slot(self, tick):
+        slot = self.wheel[tick % wheel_size]
+        if slot is None:
+            slot = set()
+            self.wheel[tick % wheel_size] = slot
+        return slot
+
+    def put(self, keyinfo, source=None, now=None, notify=True):
+        '''Store key which came from source.
+
+        source is Node.key() of the node, or None.
+        Expire time of known key is extended, never shortened.
+        If notify is False, restore_listeners are called for added keys
+        instead of listeners.
+        '''
+        now = self._tick(now)
+        expire = now + min(max(keyinfo.timer // self.tick, 1), wheel_size - 1)
+        key = keyid(keyinfo)
+        with self.lock:
+            self._expire(now)
+            entry = self._entry(key)
+            if entry is not None:
+                self._unindex(key, entry)
+                expire = max(expire, entry[1])
+                if notify and self.listeners:
+                    old = entry[0] if self.table is None else self.table.get(entry[0])
+                    if old.file_name != keyinfo.file_name:
+                        self._notify(old, False)
+                        self._notify(keyinfo, True)
+            if self.table is None:
+                self.entries[key] = [keyinfo, expire, source]
+                if source is not None:
+                    self.by_source.setdefault(source, {})[key] = None
+            elif entry is None:
+                row = self.table.add(keyinfo, expire * self.tick, source or 0)
+                if row == len(self.keys):
+                    self.keys.append(key)
+                else:
+                    self.keys[row] = key
+                self.entries[key] = row
+            else:
+                self.table.update(entry[0], keyinfo, expire * self.tick, source or 0)
+            self.by_hash.setdefault(keyinfo.hash, []).append(key)
+            self._slot(expire).add(key)
+            self.low = min(self.low, expire)
+            if entry is None:
+                self._notify(keyinfo, True, self.listeners if notify else self.restore_listeners)
+                while len(self.entries) > self.size:
+                    self._evict(now)
+
+    def put_many(self, keys, source=None, now=None):
+        '''put() keys which came from source at once,
+        so proxy of other process calls once for them.
+        '''
+        for keyinfo in keys:
+            self.put(keyinfo, source, now)
+
+    def _unindex(self, key, entry):
+        value, expire, source = entry
+        self.wheel[expire % wheel_size].discard(key)
+        keys = self.by_hash[key[0]]
+        keys.remove(key)
+        if not keys:
+            del self.by_hash[key[0]]
+        if (source is not None) and (self.table is None):
+            keys = self.by_source[source]
+            del keys[key]
+            if not keys:
+                del self.by_source[source]
+
+    def _drop(self, key, reason):
+        entry = self._entry(key)
+        del self.entries[key]
+        self._unindex(key, entry)
+        expired.labels(reason).inc()
+        if self.table is None:
+            self._notify(entry[0], False)
+            return
+        if self.listeners:
+            self._notify(self.table.get(entry[0]), False)
+        self.table.remove(entry[0])
+        self.keys[entry[0]] = None
+
+    def remove(self, key):
+        '''Remove key of keyid.
+        '''
+        with self.lock:
+            if key in self.entries:
+                self._drop(key, 'removed')
+
+    def remove_source(self, source):
+        '''Remove keys which came from source, and returns number of them.
+        '''
+        with self.lock:
+            if self.table is None:
+                keys = list(self.by_source.get(source, ()))
+            else:
+                keys = [self.keys[row] for row in self.table.rows(self.table.from_node(source))]
+            for key in keys:
+                self._drop(key, 'removed')
+        return len(keys)
+
+    def _evict(self, now):
+        '''Drop one key of the shortest remaining time.
+        '''
+        for tick in range(max(now, self.low), now + wheel_size):
+            slot = self.wheel[tick % wheel_size]
+            if slot:
+                self.low = tick
+                self._drop(next(iter(slot)), 'evicted')
+                return
+
+    def expire(self, now=None):
+        '''Drop expired keys, and returns number of them.
+        '''
+        with self.lock:
+            return self._expire(self._tick(now))
+
+    def _expire(self, now):
+        if self.now is None:
+            self.now = now
+        removed = 0
+        # after a long sleep all slots are old
+        for tick in range(self.now, min(now, self.now + wheel_size) + 1):
+            slot = self.wheel[tick % wheel_size]
+            if not slot:
+                continue
+            for key in [i for i in slot if self._entry(i)[1] <= now]:
+                self._drop(key, 'expired')
+                removed += 1
+        self.now = max(self.now, now)
+        return removed
+
+    def _ttl(self, entry, now):
+        value, expire, source = entry
+        if self.table is not None:
+            return self.table.get(value, now * self.tick)
+        value = copy.copy(value)
+        value.timer = max(expire - now, 0) * self.tick
+        return value
+
+    def restore(self, snapshot):
+        '''Take keys from loaded keycache.KeyCache.
+
+        Keys taken from it are not new ones, so only restore_listeners
+        are called for them.
+        '''
+        self.snapshot = snapshot if len(snapshot) else None
+
+    def _restore(self, hash, now):
+        for keyinfo, source in self.snapshot.take(hash, now):
+            self.put(keyinfo, source, now, notify=False)
+
+    def warm(self, count, now=None):
+        '''Take next count keys from snapshot, and returns number of them.
+        '''
+        snapshot = self.snapshot
+        if snapshot is None:
+            return 0
+        items = snapshot.take_next(count, now)
+        for keyinfo, source in items:
+            self.put(keyinfo, source, now, notify=False)
+        if not len(snapshot):
+            self.snapshot = None
+            snapshot.close()
+        return len(items)
+
+    def items(self, keys, now=None):
+        '''(keyinfo, expire time in seconds, source) of keyids which are alive.
+        '''
+        now = self._tick(now)
+        result = []
+        with self.lock:
+            for key in keys:
+                entry = self._entry(key)
+                if (entry is not None) and (entry[1] > now):
+                    result.append((self._ttl(entry, now), entry[1] * self.tick, entry[2]))
+        return result
+
+    def get(self, hash, address, port, now=None):
+        '''Key of hash shared by address:port, or None.
+        '''
+        if self.snapshot is not None:
+            self._restore(hash, now)
+        now = self._tick(now)
+        with self.lock:
+            entry = self._entry((hash, address, port))
+            if (entry is None) or (entry[1] <= now):
+                return None
+            return self._ttl(entry, now)
+
+    def find(self, hash, now=None):
+        '''Keys of hash.
+        '''
+        if self.snapshot is not None:
+            self._restore(hash, now)
+        now = self._tick(now)
+        with self.lock:
+            entries = [self._entry(key) for key in self.by_hash.get(hash, ())]
+            return [self._ttl(entry, now) for entry in entries if entry[1] > now]
+
+    def from_source(self, source, now=None):
+        '''Keys which came from source.
+
+        Keys of snapshot are not found until they are taken.
+        '''
+        return self.select(source=source, now=now)
+
+    def select(self, size=None, ignored=None, ttl=0, source=None, limit=None, now=None):
+        '''Up to limit keys which match all of given conditions.
+
+        size is (low, high) of file_size, ignored is value of ignore,
+        keys live ttl seconds more at least, and source sent them.
+        With table, conditions are masks of its columns.
+        '''
+        now = self._tick(now)
+        table = self.table
+        with self.lock:
+            if table is not None:
+                mask = table.ttl_over(ttl, now * self.tick)
+                if size is not None:
+                    mask = mask & table.size_range(*size)
+                if ignored is not None:
+                    mask = mask & (~table.not_ignored() if ignored else table.not_ignored())
+                if source is not None:
+                    mask = mask & table.from_node(source)
+                return table.select(mask, limit, now * self.tick)
+            if source is None:
+                entries = self.entries.values()
+            else:
+                entries = [self.entries[key] for key in self.by_source.get(source, ())]
+            result = []
+            for entry in entries:
+                keyinfo, expire = entry[:2]
+                if ((expire - now) * self.tick <= ttl) or \
+                   ((size is not None) and not (size[0] <= keyinfo.file_size <= size[1])) or \
+                   ((ignored is not None) and (bool(keyinfo.ignore) != ignored)):
+                    continue
+                result.append(self._ttl(entry, now))
+                if len(result) == limit:
+                    break
+            return result
+
+    def _notify(self, keyinfo, added, listeners=None):
+        if listeners is None:
+            listeners = self.listeners
+        for listener in listeners:
+            listener(keyinfo, added)
+
+
+# End of KeyStore
+
+
+def _test():
+    import doctest
+    from pyny import keystore
+    return doctest.testmod(keystore)
+
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,370 @@
+'''Columnar Key Table.
+
+Keys are rows of fixed width columns in arrays,
+strings of keys are in one blob, and rows have their offsets and lengths.
+A row costs 79 bytes and its strings, not a NyKeyInformation
+object, and NyKeyInformation is made only for rows returned.
+When half of the blob is garbage, strings are moved into a new blob
+by config.keytable_compact_step rows per change, not all at once.
+
+Filters return masks of rows, they are combined by & | ~.
+With NumPy, masks are made by NumPy on columns without copy,
+without it, masks are bytes made by C loops of map().
+'''
+#
+# Copyright (c) 2006 Pyny Project.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHORS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# $Id: $
+#
+
+import array
+import operator
+from itertools import compress, islice, repeat
+
+from . import config
+from .conv import address_to_int, int_to_address
+from .nykey import NyKeyInformation
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__version__ = '$Revision: $'
+__all__ = ['KeyTable']
+
+columns = (
+    ('sharing_address', 'I'),
+    ('sharing_port', 'H'),
+    ('bbs_address', 'I'),
+    ('bbs_port', 'H'),
+    ('file_size', 'I'),
+    ('expire', 'I'),
+    ('block_size', 'I'),
+    ('modified_time', 'I'),
+    ('ignore', 'B'),
+    ('version', 'B'),
+    ('source', 'Q'),
+    ('live', 'B'),
+)
+strings = ('hash', 'file_name', 'sharing_sign', 'bbs_sign')
+addresses = ('sharing_address', 'bbs_address')
+fields = [name for name, typecode in columns if name not in ('expire', 'source', 'live')]
+
+
+class ByteMask:
+    '''Mask of bytes 0 or 1, used without NumPy.
+    '''
+
+    def __init__(self, data):
+        self.data = bytes(data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def _int(self):
+        return int.from_bytes(self.data, 'little')
+
+    def _bytes(self, n):
+        return ByteMask(n.to_bytes(len(self.data), 'little'))
+
+    def __and__(self, other):
+        return self._bytes(self._int() & other._int())
+
+    def __or__(self, other):
+        return self._bytes(self._int() | other._int())
+
+    def __invert__(self):
+        return self._bytes(self._int() ^ int.from_bytes(b'\1' * len(self.data), 'little'))
+
+    def nonzero(self):
+        return compress(range(len(self.data)), self.data)
+
+
+# End of ByteMask
+
+
+class KeyTable:
+    '''Columnar Key Table.
+
+    Rows are reused after remove().
+    expire is time in seconds when the key expires, source is Node.key()
+    of the node which sent the key, 0 if unknown.
+
+    Sample:
+    >>> t = KeyTable()
+    >>> for i, size in enumerate((100, 2000, 30000)):
+    ...     k = NyKeyInformation()
+    ...     k.hash, k.file_name, k.file_size = 'fcc3b22beb4c242c', 'file%d' % i, size
+    ...     k.sharing_address, k.sharing_port = '192.168.1.%d' % i, 4000
+    ...     k.ignore = (i == 2)
+    ...     row = t.add(k, expire=1000 + i * 100, source=7 if i else 0)
+    >>> mask = t.size_range(1000, 50000) & t.not_ignored() & t.ttl_over(50, now=1000)
+    >>> [(k.file_name, k.sharing_address, k.timer) for k in t.select(mask, now=1000)]
+    [('file1', '192.168.1.1', 100)]
+    >>> t.remove(1)
+    >>> [k.file_name for k in t.select(t.from_node(7))]
+    ['file2']
+    >>> t.add(k, expire=0)
+    1
+
+    Blob is compacted step by step:
+    >>> t = KeyTable(step=2)
+    >>> for i in range(4):
+    ...     k.file_name = 'file%d' % i
+    ...     row = t.add(k)
+    >>> for i in range(3):
+    ...     t.remove(i)
+    >>> t.cursor, len(t.blob) > len(t.next_blob)
+    (2, True)
+    >>> k.file_name = 'new'
+    >>> t.update(0, k)
+    >>> t.next_blob is None, [k.file_name for k in t.select(t.live_rows())]
+    (True, ['new', 'file3'])
+    '''
+
+    def __init__(self, step=None):
+        if step is None:
+            step = config.keytable_compact_step
+        for name, typecode in columns:
+            setattr(self, name, array.array(typecode))
+        for name in strings:
+            setattr(self, name + '_offset', array.array('Q'))
+            setattr(self, name + '_length', array.array('H'))
+        self.blob = bytearray()
+        self.garbage = 0
+        self.step = step
+        self.next_blob = None  # strings of rows before cursor while compacting
+        self.next_garbage = 0
+        self.cursor = 0
+        self.free = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _values(self, keyinfo, expire, source):
+        return (address_to_int(keyinfo.sharing_address or '0.0.0.0'), keyinfo.sharing_port,
+                address_to_int(keyinfo.bbs_address or '0.0.0.0'), keyinfo.bbs_port,
+                keyinfo.file_size, expire, keyinfo.block_size, keyinfo.modified_time,
+                int(keyinfo.ignore), keyinfo.version, source, 1)
+
+    def _append_string(self, name, value):
+        data = value.encode('latin-1')
+        getattr(self, name + '_offset').append(len(self.blob))
+        getattr(self, name + '_length').append(len(data))
+        self.blob += data
+
+    def _blob(self, row):
+        if (self.next_blob is not None) and (row < self.cursor):
+            return self.next_blob
+        return self.blob
+
+    def _set_string(self, name, row, value):
+        data = value.encode('latin-1')
+        lengths = getattr(self, name + '_length')
+        blob = self._blob(row)
+        if blob is self.blob:
+            self.garbage += lengths[row]
+        else:
+            self.next_garbage += lengths[row]
+        getattr(self, name + '_offset')[row] = len(blob)
+        lengths[row] = len(data)
+        blob += data
+
+    def _string(self, name, row):
+        offset = getattr(self, name + '_offset')[row]
+        return self._blob(row)[offset:offset + getattr(self, name + '_length')[row]].decode('latin-1')
+
+    def add(self, keyinfo, expire=0, source=0):
+        '''Store key, and returns its row.
+        '''
+        if self.free:
+            row = self.free.pop()
+            self.update(row, keyinfo, expire, source)
+            return row
+        for (name, typecode), value in zip(columns, self._values(keyinfo, expire, source)):
+            getattr(self, name).append(value)
+        for name in strings:
+            self._append_string(name, getattr(keyinfo, name))
+        self.count += 1
+        return len(self.live) - 1
+
+    def update(self, row, keyinfo, expire=0, source=0):
+        if not self.live[row]:
+            self.count += 1
+        for (name, typecode), value in zip(columns, self._values(keyinfo, expire, source)):
+            getattr(self, name)[row] = value
+        for name in strings:
+            self._set_string(name, row, getattr(keyinfo, name))
+        self._compact()
+
+    def remove(self, row):
+        if not self.live[row]:
+            return
+        self.live[row] = 0
+        self.count -= 1
+        moved = self._blob(row) is not self.blob
+        for name in strings:
+            lengths = getattr(self, name + '_length')
+            if moved:
+                self.next_garbage += lengths[row]
+            else:
+                self.garbage += lengths[row]
+            lengths[row] = 0
+        self.free.append(row)
+        self._compact()
+
+    def _compact(self):
+        '''Move strings of next step rows into new blob,
+        it is started when half of blob is garbage.
+        '''
+        if self.next_blob is None:
+            if self.garbage * 2 <= len(self.blob):
+                return
+            self.next_blob = bytearray()
+            self.next_garbage = 0
+            self.cursor = 0
+        blob = self.next_blob
+        end = min(self.cursor + self.step, len(self.live))
+        for name in strings:
+            offsets = getattr(self, name + '_offset')
+            lengths = getattr(self, name + '_length')
+            for row in range(self.cursor, end):
+                offset = offsets[row]
+                offsets[row] = len(blob)
+                blob += self.blob[offset:offset + lengths[row]]
+        self.cursor = end
+        if end == len(self.live):
+            self.blob = blob
+            self.garbage = self.next_garbage
+            self.next_blob = None
+            self.cursor = 0
+
+    def get(self, row, now=None):
+        '''NyKeyInformation of row, its timer is seconds until expire.
+        '''
+        keyinfo = NyKeyInformation()
+        for name in fields:
+            setattr(keyinfo, name, getattr(self, name)[row])
+        for name in addresses:
+            setattr(keyinfo, name, int_to_address(getattr(keyinfo, name)))
+        for name in strings:
+            setattr(keyinfo, name, self._string(name, row))
+        keyinfo.ignore = bool(keyinfo.ignore)
+        if now is not None:
+            keyinfo.timer = max(self.expire[row] - int(now), 0)
+        return keyinfo
+
+    def _mask(self, name, op, value):
+        column = getattr(self, name)
+        if numpy is not None:
+            if not column:
+                return numpy.zeros(0, dtype=bool)
+            return op(numpy.frombuffer(column, dtype=column.typecode), value)
+        return ByteMask(map(op, column, repeat(value, len(column))))
+
+    def _flag(self, name):
+        '''Mask of 0/1 column.
+        '''
+        column = getattr(self, name)
+        if numpy is not None:
+            return numpy.frombuffer(column, dtype=bool).copy() if column else numpy.zeros(0, dtype=bool)
+        return ByteMask(column.tobytes())
+
+    def live_rows(self):
+        return self._flag('live')
+
+    def size_range(self, low, high):
+        '''Rows of low <= file_size <= high.
+        '''
+        return self._mask('file_size', operator.ge, low) & self._mask('file_size', operator.le, high)
+
+    def not_ignored(self):
+        return ~self._flag('ignore')
+
+    def ttl_over(self, seconds, now):
+        '''Rows which expire after now + seconds.
+        '''
+        return self._mask('expire', operator.gt, int(now + seconds))
+
+    def from_node(self, source):
+        return self._mask('source', operator.eq, source)
+
+    def rows(self, mask, limit=None):
+        '''Live rows of mask.
+        '''
+        mask = mask & self.live_rows()
+        if numpy is not None:
+            return numpy.flatnonzero(mask)[:limit].tolist()
+        return list(islice(mask.nonzero(), limit))
+
+    def select(self, mask, limit=None, now=None):
+        '''NyKeyInformation of live rows of mask.
+        '''
+        return [self.get(row, now) for row in self.rows(mask, limit)]
+
+
+# End of KeyTable
+
+
+if numpy is not None:
+    # it runs only with NumPy, masks of both paths select the same rows
+    __test__ = {'numpy': '''
+    >>> import random
+    >>> from pyny import keytable
+    >>> random.seed(1)
+    >>> t = KeyTable()
+    >>> for i in range(300):
+    ...     k = NyKeyInformation()
+    ...     k.hash, k.file_name = 'fcc3b22beb4c242c', 'file%d' % i
+    ...     k.file_size, k.ignore = random.randrange(5000), random.random() < 0.3
+    ...     k.sharing_address, k.sharing_port = '192.168.1.%d' % (i & 0xFF), 4000 + i
+    ...     row = t.add(k, expire=random.randrange(2000), source=random.randrange(3))
+    >>> for row in range(0, 300, 7):
+    ...     t.remove(row)
+    >>> def rows():
+    ...     mask = (t.size_range(1000, 4000) & t.not_ignored() & t.ttl_over(100, now=500)) | \\
+    ...            ~t.from_node(2)
+    ...     return type(mask).__name__, t.rows(mask, limit=100)
+    >>> kind, found = rows()
+    >>> keytable.numpy = None
+    >>> try:
+    ...     kind2, found2 = rows()
+    ... finally:
+    ...     keytable.numpy = numpy
+    >>> kind, kind2, found == found2, len(found)
+    ('ndarray', 'ByteMask', True, 100)
+    '''}
+
+
+def _test():
+    import doctest
+    from pyny import keytable
+    return doctest.testmod(keytable)
+
+
+if __name__ == '__main__':
+    _test()
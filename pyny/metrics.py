@@ -0,0 +1,298 @@
+'''Metrics.
+
+Counters, gauges and histograms, rendered in Prometheus text format.
+Updating a metric is one addition, so metrics are always enabled.
+Metrics updated from several threads may lose some counts.
+'''
+#
+# Copyright (c) 2006 Pyny Project.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHORS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# $Id: $
+#
+
+import asyncio
+import logging
+from bisect import bisect_left
+
+__version__ = '$Revision: $'
+__all__ = ['Counter', 'Gauge', 'Histogram', 'Registry', 'registry']
+
+log = logging.getLogger(__name__)
+
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labelstr(names, values, extra=''):
+    pairs = ['%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"')) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(pairs)
+
+
+def _number(n):
+    if isinstance(n, float) and n.is_integer():
+        return str(int(n))
+    return str(n)
+
+
+class Metric:
+    '''Metric base class.
+
+    Metric with labelnames has children, they are got by labels().
+    Metric made with func gets its value from func() when rendered,
+    func returns number, or dict of label values -> number.
+    '''
+    kind = ''
+
+    def __init__(self, name, help='', labelnames=(), func=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.func = func
+        self.children = {}
+        self.reset()
+
+    def reset(self):
+        self.value = 0
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.__class__(self.name)
+            self.children[values] = child
+        return child
+
+    def samples(self):
+        '''List of (suffix, label string, value).
+        '''
+        if self.func is not None:
+            value = self.func()
+            if isinstance(value, dict):
+                return [('', _labelstr(self.labelnames, k if isinstance(k, tuple) else (k, )), v)
+                        for k, v in value.items()]
+            return [('', '', value)]
+        if self.labelnames:
+            result = []
+            for values, child in list(self.children.items()):
+                result.extend(child._samples(_labelstr, self.labelnames, values))
+            return result
+        return self._samples(_labelstr, (), ())
+
+    def _samples(self, labelstr, names, values):
+        return [('', labelstr(names, values), self.value)]
+
+    def render(self):
+        lines = []
+        if self.help:
+            lines.append('# HELP %s %s' % (self.name, self.help))
+        lines.append('# TYPE %s %s' % (self.name, self.kind))
+        for suffix, labels, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, labels, _number(value)))
+        return lines
+
+
+# End of Metric
+
+
+class Counter(Metric):
+    '''Counter.
+
+    Sample:
+    >>> c = Counter('pyny_frames_total', labelnames=('code',))
+    >>> c.labels(13).inc()
+    >>> c.labels(13).inc(2)
+    >>> c.render()
+    ['# TYPE pyny_frames_total counter', 'pyny_frames_total{code="13"} 3']
+    '''
+    kind = 'counter'
+
+    def inc(self, n=1):
+        self.value += n
+
+
+# End of Counter
+
+
+class Gauge(Metric):
+    '''Gauge.
+
+    Sample:
+    >>> g = Gauge('pyny_nodes', labelnames=('list',), func=lambda: {'all': 3})
+    >>> g.render()
+    ['# TYPE pyny_nodes gauge', 'pyny_nodes{list="all"} 3']
+    '''
+    kind = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, n=1):
+        self.value += n
+
+    def dec(self, n=1):
+        self.value -= n
+
+
+# End of Gauge
+
+
+class Histogram(Metric):
+    '''Histogram with fixed buckets.
+
+    Sample:
+    >>> h = Histogram('pyny_seconds', buckets=(0.1, 1))
+    >>> h.observe(0.05)
+    >>> h.observe(0.5)
+    >>> for line in h.render(): print(line)
+    # TYPE pyny_seconds histogram
+    pyny_seconds_bucket{le="0.1"} 1
+    pyny_seconds_bucket{le="1"} 2
+    pyny_seconds_bucket{le="+Inf"} 2
+    pyny_seconds_sum 0.55
+    pyny_seconds_count 2
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, help='', labelnames=(), buckets=default_buckets):
+        self.buckets = tuple(buckets)
+        Metric.__init__(self, name, help, labelnames)
+
+    def reset(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = Histogram(self.name, buckets=self.buckets)
+            self.children[values] = child
+        return child
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def _samples(self, labelstr, names, values):
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf', ), self.counts):
+            total += count
+            result.append(('_bucket', labelstr(names, values, 'le="%s"' % _number(bound)), total))
+        result.append(('_sum', labelstr(names, values), round(self.sum, 9)))
+        result.append(('_count', labelstr(names, values), self.count))
+        return result
+
+
+# End of Histogram
+
+
+class Registry:
+    '''Metrics Registry.
+
+    Metric of same name is made once, so modules can ask it again.
+    Func of metric is replaced when it is asked with new func,
+    so values come from the latest instance which registered it.
+    Metrics whose func raises are left out of render().
+
+    Sample:
+    >>> r = Registry()
+    >>> g = r.gauge('pyny_sessions', func=lambda: 1)
+    >>> g = r.gauge('pyny_sessions', func=lambda: 2)
+    >>> g = r.gauge('pyny_broken', func=lambda: 1 // 0)
+    >>> print(r.render(), end='')
+    # TYPE pyny_sessions gauge
+    pyny_sessions 2
+    '''
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _get(self, cls, name, *args, **kw):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = cls(name, *args, **kw)
+            self.metrics[name] = metric
+        return metric
+
+    def counter(self, name, help='', labelnames=(), func=None):
+        metric = self._get(Counter, name, help, labelnames, func)
+        if func is not None:
+            metric.func = func
+        return metric
+
+    def gauge(self, name, help='', labelnames=(), func=None):
+        metric = self._get(Gauge, name, help, labelnames, func)
+        if func is not None:
+            metric.func = func
+        return metric
+
+    def histogram(self, name, help='', labelnames=(), buckets=default_buckets):
+        return self._get(Histogram, name, help, labelnames, buckets)
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                log.exception('metric %s is not rendered', metric.name)
+        return '\n'.join(lines) + '\n'
+
+    async def handle(self, reader, writer):
+        '''HTTP handler, it returns metrics for any request.
+        '''
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = self.render().encode('utf-8')
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: %d\r\n\r\n' % len(body) + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        return await asyncio.start_server(self.handle, host=host, port=port)
+
+
+# End of Registry
+
+registry = Registry()
+
+
+def _test():
+    import doctest
+    from pyny import metrics
+    return doctest.testmod(metrics)
+
+
+if __name__ == '__main__':
+    _test()
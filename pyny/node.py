@@ -28,13 +28,15 @@
 # $Id: node.py 15 2006-12-10 06:23:36Z fuktommy $
 #
 
+from time import time
+
 from . import rc4
-from . import config
+from . import identity
 from . import nyconnection
+from .conv import parse_address
 from .nyexcept import *
-from .conv import hexstr, binary
 
-__all__ = ['Node']
+__all__ = ['Node', 'pack_hash_many', 'unpack_hash_many']
 __version__ = '$Revision: 15 $'
 
 level = {'Hi': 16, 'Middle': 4, 'Low': 1}
@@ -56,17 +58,58 @@ class Node:
     - nodetype          Raw, NAT, DDNS, or Port0
     - speed
     - sortkey
+    - last_seen         Time when node was seen last
     '''
 
     def __init__(self):
         self.isknown = False
         self.priority = 128
+        self.correlation = 0
+        self.speed = 0
+        self.sortkey = 0
+        self.clustering = []
+        self.last_seen = 0
         self.addr = '0.0.0.0'
         self.port = 0
 
     def __str__(self):
         return '%s:%d' % (self.addr, self.port)
 
+    def key(self):
+        '''Integer key, (address << 16) | port.
+
+        It is None if address is host name, such as DDNS node.
+
+        Sample:
+        >>> node = strnode('192.168.1.10:8000')
+        >>> node.key()
+        211827804479296
+        >>> strnode('example.com:8000').key() is None
+        True
+        '''
+        if getattr(self, '_keysrc', None) != (self.addr, self.port):
+            self._keysrc = (self.addr, self.port)
+            address = parse_address(self.addr)
+            if address is None:
+                self._key = None
+            else:
+                self._key = (address << 16) | (self.port & 0xFFFF)
+        return self._key
+
+    def __getstate__(self):
+        # connection and session are local to process, they are not sent to workers
+        state = self.__dict__.copy()
+        state.pop('connection', None)
+        state.pop('session', None)
+        return state
+
+    def seen(self, now=None):
+        '''Node is seen now, it is connected or it told us about itself.
+        '''
+        if now is None:
+            now = time()
+        self.last_seen = int(now)
+
     def update_sortkey(self):
         self.sortkey = ((self.priority & 0xFF) << 24) | \
                        ((self.correlation & 0xff) << 16) | \
@@ -135,14 +178,7 @@ class Node:
         return not self.can_upstream(speed)
 
     def isself(self):
-        selfnode = '%s:%d' % (config.addr, config.port)
-        if (str(self) == selfnode):
-            return True
-        elif hasattr(self, 'reported_address') and \
-             self.reported_address == config.addr:
-            return True
-        else:
-            return False
+        return identity.local.isself(self)
 
     def connect(self):
         return nyconnection.Connection(self)
@@ -177,6 +213,20 @@ def RC4Key(checksum):
     return chr(checksum) + magic[1:]
 
 
+_hash_keys = None
+
+
+def _hash_rc4(checksum):
+    '''RC4 object for node hash.
+
+    The 256 key schedules of RC4Key are made once, and copied per use.
+    '''
+    global _hash_keys
+    if _hash_keys is None:
+        _hash_keys = [rc4.RC4(RC4Key(i)) for i in range(256)]
+    return _hash_keys[checksum].copy()
+
+
 def pack_hash(inetaddrss):
     '''Pack internet address.
 
@@ -186,12 +236,9 @@ def pack_hash(inetaddrss):
     >>> pack_hash('123.1.2.3:1234')
     '@ba9582a383c7d6e79cd5d8c71f7347'
     '''
-    checksum = 0
-    for i in inetaddrss:
-        checksum = (checksum + ord(i)) & 0xFF
-    rc4key = RC4Key(checksum)
-    hash = '@' + hexstr(chr(checksum) + rc4.crypt(rc4key, inetaddrss))
-    return hash
+    checksum = sum(inetaddrss.encode('latin-1')) & 0xFF
+    encoded = _hash_rc4(checksum).crypt(inetaddrss)
+    return '@' + (chr(checksum) + encoded).encode('latin-1').hex()
 
 
 def unpack_hash(hash):
@@ -208,19 +255,76 @@ def unpack_hash(hash):
     elif not hash.startswith('@'):
         raise NodeFormatError('Specified hash-string is not hash-string of NodeAddress')
 
-    sum = binary(hash[1:3])
-    encoded = binary(hash[3:])
-    rc4key = RC4Key(ord(sum))
-    unpackedstr = rc4.crypt(rc4key, encoded)
-
-    checksum = 0
-    for i in unpackedstr:
-        checksum += ord(i)
-    if (checksum & 0xFF) != ord(sum):
+    try:
+        packed = bytes.fromhex(hash[1:])
+    except ValueError:
+        raise NodeFormatError('Specified hash-string is not hex string')
+    checksum = packed[0]
+    unpackedstr = _hash_rc4(checksum).crypt(packed[1:].decode('latin-1'))
+    if (sum(unpackedstr.encode('latin-1')) & 0xFF) != checksum:
         raise NodeFormatError('sum check error')
     return unpackedstr
 
 
+def pack_hash_many(inetaddrs):
+    '''Pack many internet addresses.
+
+    Blank lines and lines beginning with '#' are skipped.
+    NodeFormatError of a bad address tells its line number.
+
+    sample:
+    >>> pack_hash_many(['123.1.2.3:1234', '', '# seed', '192.168.1.10:8000'])
+    ['@ba9582a383c7d6e79cd5d8c71f7347', '@5961f0e683057ecd1fd6127803ed80f2648e']
+    >>> pack_hash_many(['123.1.2.3:1234', '123.1.2.3'])
+    Traceback (most recent call last):
+        ...
+    pyny.nyexcept.NodeFormatError: line 2: Specified string is not address:port
+    '''
+    hashes = []
+    for lineno, line in enumerate(inetaddrs, 1):
+        line = line.strip()
+        if (not line) or line.startswith('#'):
+            continue
+        addr, sep, port = line.rpartition(':')
+        if not (addr and sep and port.isdigit()):
+            raise NodeFormatError('line %d: Specified string is not address:port' % lineno)
+        try:
+            hashes.append(pack_hash(line))
+        except UnicodeError:
+            raise NodeFormatError('line %d: Specified string is not latin-1' % lineno)
+    return hashes
+
+
+def unpack_hash_many(lines):
+    '''Unpack many winny node format strings.
+
+    Argument lines is iterable of strings, such as Noderef file object.
+    Blank lines and lines beginning with '#' are skipped.
+    Returns (nodes, errors), errors is list of (line number, line, message).
+
+    sample:
+    >>> lines = ['@ba9582a383c7d6e79cd5d8c71f7347\\n', '\\n', '@ba95', '@ba9582a383c7d6e79cd5d8c71f7348']
+    >>> nodes, errors = unpack_hash_many(lines)
+    >>> nodes
+    ['123.1.2.3:1234']
+    >>> errors
+    [(3, '@ba95', 'Specified hash-string is too small'), (4, '@ba9582a383c7d6e79cd5d8c71f7348', 'sum check error')]
+    '''
+    nodes = []
+    errors = []
+    for lineno, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            line = line.decode('latin-1')
+        line = line.strip()
+        if (not line) or line.startswith('#'):
+            continue
+        try:
+            nodes.append(unpack_hash(line))
+        except NodeFormatError as err:
+            errors.append((lineno, line, str(err)))
+    return nodes, errors
+
+
 def _test():
     import doctest
     from pyny import node
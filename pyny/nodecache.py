@@ -0,0 +1,331 @@
+'''Persistent Node Cache.
+
+Node table file is a header and fixed width records sorted by key,
+key is (IPv4 address << 16) | port.
+File is mapped by mmap, so loading it does not parse records.
+'''
+#
+# Copyright (c) 2006 Pyny Project.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHORS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# $Id: $
+#
+
+import os
+import mmap
+import struct
+from bisect import bisect_left
+
+from .node import Node
+from .conv import parse_address, int_to_address
+from .nyexcept import *
+
+__version__ = '$Revision: $'
+__all__ = ['NodeCache']
+
+magic = b'PYNYNODE'
+file_version = 1
+word_size = 16  # bytes, one clustering word
+wordsize = 3  # clustering words per node
+
+header = struct.Struct('<8sIII12x')
+# key, speed, last seen, priority, correlation, clustering words
+record = struct.Struct('<QIIBB%ds6x' % (word_size * wordsize))
+keyfield = struct.Struct('<Q')  # key at head of record
+
+
+def nodekey(addr, port):
+    '''Key of node table.
+
+    Sample:
+    >>> nodekey('192.168.1.10', 8000)
+    211827804479296
+    >>> nodekey('example.com', 8000) is None
+    True
+    '''
+    address = parse_address(addr)
+    if address is None:
+        return None
+    return (address << 16) | (port & 0xFFFF)
+
+
+class RecordKeys:
+    '''Keys of records in mapping, for bisect.
+
+    Keys are read as little endian whatever the host is.
+    '''
+
+    def __init__(self, records):
+        self.records = records
+        self.count = len(records) // record.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not (0 <= i < self.count):
+            raise IndexError(i)
+        return keyfield.unpack_from(self.records, i * record.size)[0]
+
+
+# End of RecordKeys
+
+
+def _pack_words(words):
+    data = b''
+    for i in range(wordsize):
+        if i < len(words):
+            word = words[i].encode('latin-1')[:word_size]
+        else:
+            word = b''
+        data += word + b'\0' * (word_size - len(word))
+    return data
+
+
+def _unpack_words(data):
+    words = []
+    for i in range(wordsize):
+        word = data[i * word_size:(i+1) * word_size].rstrip(b'\0')
+        if word:
+            words.append(word.decode('latin-1'))
+    return words
+
+
+class NodeCache:
+    '''Node Cache.
+
+    Records loaded from file are read from mapping when they are used.
+    Nodes updated at runtime are kept in memory until save().
+    Nodes of host names are not cached, they have no key.
+
+    Sample:
+    >>> import os, tempfile
+    >>> from pyny.node import strnode
+    >>> path = os.path.join(tempfile.mkdtemp(), 'nodes.dat')
+    >>> cache = NodeCache(path)
+    >>> cache.load()
+    >>> node = strnode('192.168.1.10:8000')
+    >>> node.speed, node.clustering, node.last_seen = 120, ['a', 'bb'], 1146886153
+    >>> cache.update(node)
+    >>> cache.update(strnode('example.com:8000'))
+    >>> cache.save()
+    >>> cache = NodeCache(path)
+    >>> cache.load()
+    >>> len(cache)
+    1
+    >>> node = cache.get('192.168.1.10', 8000)
+    >>> str(node), node.speed, node.clustering, node.last_seen
+    ('192.168.1.10:8000', 120, ['a', 'bb'], 1146886153)
+    >>> cache.discard('192.168.1.10', 8000)
+    >>> cache.get('192.168.1.10', 8000) is None
+    True
+    >>> cache.close()
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._map = None
+        self._view = None
+        self._keys = ()
+        self._records = None
+        self._updated = {}  # key -> record bytes, None if removed
+
+    def load(self):
+        '''Map node table file.
+        '''
+        self.close()
+        if (not os.path.exists(self.path)) or \
+           (os.path.getsize(self.path) <= header.size):
+            return
+        self._file = open(self.path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        head, version, size, count = header.unpack_from(self._map)
+        if (head != magic) or (version != file_version) or (size != record.size) or \
+           (len(self._map) < header.size + count * size):
+            self.close()
+            raise NodeFormatError('NodeCache: broken node table file')
+        self._view = memoryview(self._map)
+        self._records = self._view[header.size:header.size + count * size]
+        self._keys = RecordKeys(self._records)
+
+    def close(self):
+        if self._map is not None:
+            for view in (self._records, self._view):
+                view.release()
+            self._keys = ()
+            self._records = None
+            self._view = None
+            self._map.close()
+            self._map = None
+            self._file.close()
+            self._file = None
+
+    def _find(self, key):
+        i = bisect_left(self._keys, key)
+        if (i < len(self._keys)) and (self._keys[i] == key):
+            return i
+        return -1
+
+    def __len__(self):
+        count = len(self._keys)
+        for key, rec in self._updated.items():
+            found = self._find(key) >= 0
+            if (rec is None) and found:
+                count -= 1
+            elif (rec is not None) and (not found):
+                count += 1
+        return count
+
+    def __contains__(self, key):
+        if key in self._updated:
+            return self._updated[key] is not None
+        return self._find(key) >= 0
+
+    def _record(self, key):
+        if key in self._updated:
+            return self._updated[key]
+        i = self._find(key)
+        if i < 0:
+            return None
+        return bytes(self._records[i * record.size:(i+1) * record.size])
+
+    def get(self, addr, port):
+        '''Get node, or None.
+        '''
+        key = nodekey(addr, port)
+        if key is None:
+            return None
+        rec = self._record(key)
+        if rec is None:
+            return None
+        return _make_node(rec)
+
+    def __iter__(self):
+        for key, rec in self._updated.items():
+            if rec is not None:
+                yield _make_node(rec)
+        if self._records is not None:
+            for rec in record.iter_unpack(self._records):
+                if rec[0] not in self._updated:
+                    yield _make_node(rec)
+
+    def update(self, node):
+        '''Add or update node.
+        '''
+        key = nodekey(node.addr, node.port)
+        if key is None:
+            return
+        self._updated[key] = record.pack(key,
+                                         int(node.speed) & 0xFFFFFFFF,
+                                         int(node.last_seen) & 0xFFFFFFFF,
+                                         node.priority & 0xFF,
+                                         node.correlation & 0xFF,
+                                         _pack_words(node.clustering))
+
+    def merge(self, nodes):
+        for node in nodes:
+            self.update(node)
+
+    def discard(self, addr, port):
+        key = nodekey(addr, port)
+        if key is not None:
+            self._updated[key] = None
+
+    def save(self):
+        '''Write node table file atomically.
+        '''
+        updated = sorted((k, r) for k, r in self._updated.items() if r is not None)
+        tmppath = self.path + '.tmp'
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        removed = None in self._updated.values()
+        count = 0
+        with open(tmppath, 'wb') as f:
+            f.write(header.pack(magic, file_version, record.size, 0))
+            keys = self._keys
+            i = 0
+            for key, rec in updated:
+                # copy unchanged records in front of this one
+                j = bisect_left(keys, key, i)
+                count += self._copy_records(f, i, j, removed)
+                f.write(rec)
+                count += 1
+                i = j
+                if (i < len(keys)) and (keys[i] == key):
+                    i += 1
+            count += self._copy_records(f, i, len(keys), removed)
+            f.seek(0)
+            f.write(header.pack(magic, file_version, record.size, count))
+            f.flush()
+            os.fsync(f.fileno())
+        self.close()
+        os.replace(tmppath, self.path)
+        self._updated = {}
+        self.load()
+
+    def _copy_records(self, f, begin, end, removed):
+        '''Copy base records [begin, end) except removed ones.
+        '''
+        if not removed:
+            if end > begin:
+                f.write(self._records[begin * record.size:end * record.size])
+            return end - begin
+        count = 0
+        for i in range(begin, end):
+            if self._updated.get(self._keys[i], b'') is None:
+                continue
+            f.write(self._records[i * record.size:(i+1) * record.size])
+            count += 1
+        return count
+
+
+# End of NodeCache
+
+
+def _make_node(rec):
+    if isinstance(rec, bytes):
+        rec = record.unpack(rec)
+    key, speed, last_seen, priority, correlation, words = rec
+    node = Node()
+    node.addr = int_to_address(key >> 16)
+    node.port = key & 0xFFFF
+    node.speed = speed
+    node.last_seen = last_seen
+    node.priority = priority
+    node.correlation = correlation
+    node.clustering = _unpack_words(words)
+    node.update_sortkey()
+    return node
+
+
+def _test():
+    import doctest
+    from pyny import nodecache
+    return doctest.testmod(nodecache)
+
+
+if __name__ == '__main__':
+    _test()
@@ -28,13 +28,33 @@
 # $Id: nodelist.py 15 2006-12-10 06:23:36Z fuktommy $
 #
 
-from threading import Thread
+import os
+import heapq
+import logging
+from time import time
+from threading import Thread, Lock, Event, current_thread
+from concurrent.futures import ThreadPoolExecutor
 
-__all__ = ['NodeManager']
+from . import config
+from . import penalty
+from .metrics import registry
+from .node import strnode, unpack_hash_many
+from .nodecache import NodeCache
+
+__all__ = ['NodeManager', 'start']
 __version__ = '$Revision: 15 $'
 
+_manager = None
+seed_batch = 10000  # nodes of cache added at once
+log = logging.getLogger(__name__)
+schedule_errors = registry.counter('pyny_schedule_errors_total', 'Failed rounds of NodeManager')
+
+
+class NodeList(tuple):
+    '''Snapshot of node list.
 
-class NodeList(list):
+    It is immutable, so readers need no lock.
+    '''
     pass
 
 
@@ -51,22 +71,447 @@ class NodeManager(Thread):
     - downstream: downstream find connection list.
     - forward: data forwading connection list.
     - all: all nodes list.
+
+    Lists are NodeList snapshots. Only NodeManager changes them,
+    changed lists are made again when they are read next,
+    so many nodes are added at the cost of one snapshot.
+    Known nodes are kept in cache, it is saved into config.nodecache.
+    Nodes of cache and config.noderef are added at start, and nodes seen
+    since the last save are saved every config.nodecache_interval seconds
+    and at stop.
+
+    Scheduler keeps config.upstream_target, downstream_target links.
+    It dials the best candidates by sortkey in background, and it sheds
+    the worst links when a list is over target.
+    Nodes are dialled only after serve() is called with server.
+    Dialled sockets are handed to server.attach(), nodes are linked after
+    handshake, and they are unlinked when sessions end.
+    Failed nodes are not dialled again for config.dial_retry seconds,
+    doubled for each failure in a row, and nodes which close links
+    with close codes are not dialled again for penalty.backoffs seconds.
+
+    Sample:
+    >>> from pyny.node import strnode
+    >>> manager = NodeManager()
+    >>> node = strnode('192.168.1.10:8000')
+    >>> manager.add(node, 'upstream')
+    >>> [str(i) for i in manager.upstream], [str(i) for i in manager.all]
+    (['192.168.1.10:8000'], ['192.168.1.10:8000'])
+    >>> manager.find('192.168.1.10:8000') is node
+    True
+    >>> manager.remove(node, 'upstream')
+    >>> len(manager.upstream), len(manager.all)
+    (0, 1)
+    >>> manager.remove(node)
+    >>> '192.168.1.10:8000' in manager
+    False
     '''
-    upstream = None
-    downstream = None
-    forward = None
-    all = None
+    listnames = ('upstream', 'downstream', 'forward', 'all')
+
+    def __init__(self, dial=None):
+        Thread.__init__(self)
+        self.daemon = True
+        self.lock = Lock()  # for writers
+        self.savelock = Lock()
+        self.stopped = Event()
+        self.cache = NodeCache(config.nodecache)
+        self._members = {}
+        self._snapshots = {}  # listname -> NodeList, removed when it is changed
+        for name in self.listnames:
+            self._members[name] = {}  # 'addr:port' -> Node
+        self.dial = dial or dial_node
+        self.dialing = {'upstream': set(), 'downstream': set()}  # 'addr:port'
+        self.retry = {}  # 'addr:port' -> (time to dial again, failures)
+        self.server = None
+        self.scan_cursor = 0
+        self.pool = None
+        self.saved = int(time())  # nodes seen since then are saved next
 
     def run(self):
-        self.upstream = NodeList()
-        self.downstream = NodeList()
-        self.forward = NodeList()
-        self.all = NodeList()
+        self.cache.load()
+        self.seed()
+        self.load_noderef()
+        self.pool = ThreadPoolExecutor(max_workers=config.dial_workers)
+        try:
+            while not self.stopped.wait(config.schedule_interval):
+                try:
+                    self.schedule()
+                except Exception:
+                    schedule_errors.inc()
+                    log.exception('NodeManager: schedule failed')
+                if time() >= self.saved + config.nodecache_interval:
+                    self._save()
+        finally:
+            self.pool.shutdown(wait=False)
+            self._save()
+
+    def stop(self):
+        '''Stop scheduler, and wait until node cache is saved.
+        '''
+        self.stopped.set()
+        if self.is_alive() and (current_thread() is not self):
+            self.join()
+
+    def seed(self):
+        '''Add unknown nodes of cache into all, and returns number of them.
+        '''
+        count = 0
+        nodes = []
+        for node in self.cache:
+            if str(node) in self:
+                continue
+            nodes.append(node)
+            if len(nodes) >= seed_batch:
+                self.update(add=nodes)
+                count += len(nodes)
+                nodes = []
+        self.update(add=nodes)
+        return count + len(nodes)
+
+    def load_noderef(self, path=None):
+        '''Add unknown nodes of Noderef file, and returns number of them.
+
+        Bad lines are logged and skipped.
+
+        Sample:
+        >>> import os, tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), 'Noderef.txt')
+        >>> with open(path, 'w') as f:
+        ...     _ = f.write('@ba9582a383c7d6e79cd5d8c71f7347\\n\\n@ba95\\n')
+        >>> manager = NodeManager()
+        >>> manager.load_noderef(path)
+        1
+        >>> [str(i) for i in manager.all]
+        ['123.1.2.3:1234']
+        '''
+        if path is None:
+            path = config.noderef
+        if not (path and os.path.exists(path)):
+            return 0
+        with open(path, 'rb') as f:
+            names, errors = unpack_hash_many(f)
+        for lineno, line, message in errors:
+            log.warning('%s:%d: %s', path, lineno, message)
+        nodes = []
+        for name in names:
+            if name in self:
+                continue
+            try:
+                nodes.append(strnode(name))
+            except ValueError:
+                log.warning('%s: bad node %r', path, name)
+        self.update(add=nodes)
+        return len(nodes)
+
+    def serve(self, server):
+        '''Attach dialled links to server.
+        '''
+        self.server = server
+        server.close_listeners.append(self.on_close)
+
+    def on_close(self, session):
+        '''Unlink node of ended session.
+        '''
+        node = session.node
+        if (node is None) or (getattr(node, 'session', None) is not session):
+            return
+        node.session = None
+        node.connection = None
+        for listname in ('upstream', 'downstream', 'forward'):
+            self.remove(node, listname)
+
+    def backoff(self, name, code, now=None):
+        '''Node of 'addr:port' closed link with close code,
+        it is not dialled again for a while.
+
+        Sample:
+        >>> from pyny.nycommand import NyConnectedLimitation
+        >>> manager = NodeManager()
+        >>> manager.backoff('192.168.1.10:8000', NyConnectedLimitation.code, now=0)
+        >>> manager.retry['192.168.1.10:8000']
+        (60, 0)
+        '''
+        seconds = penalty.backoffs.get(code)
+        if not seconds:
+            return
+        if now is None:
+            now = time()
+        with self.lock:
+            until, failures = self.retry.get(name, (0, 0))
+            self.retry[name] = (max(until, now + seconds), failures)
+
+    def find(self, name):
+        '''Find node by 'addr:port'.
+        '''
+        return self._members['all'].get(name)
+
+    def __contains__(self, name):
+        return name in self._members['all']
+
+    def snapshot(self, listname='all'):
+        '''Node list, it is used by proxies of other processes.
+        '''
+        return getattr(self, listname)
+
+    def update(self, add=(), remove=(), listname='all'):
+        '''Add and remove nodes at once.
+
+        Nodes added into upstream, downstream or forward are added into all,
+        and they are seen now.
+        Nodes removed from all are removed from every list.
+        '''
+        with self.lock:
+            changed = set()
+            for node in add:
+                name = str(node)
+                if listname != 'all':
+                    node.seen()
+                    node = self._members['all'].setdefault(name, node)
+                    changed.add('all')
+                self._members[listname][name] = node
+                changed.add(listname)
+            for node in remove:
+                name = str(node)
+                if listname == 'all':
+                    names = self.listnames
+                else:
+                    names = (listname,)
+                for i in names:
+                    if self._members[i].pop(name, None) is not None:
+                        changed.add(i)
+            for name in changed:
+                self._snapshots.pop(name, None)
+
+    def _snapshot(self, listname):
+        nodes = self._snapshots.get(listname)
+        if nodes is None:
+            with self.lock:
+                nodes = self._snapshots.get(listname)
+                if nodes is None:
+                    nodes = NodeList(self._members[listname].values())
+                    self._snapshots[listname] = nodes
+        return nodes
+
+    upstream = property(lambda self: self._snapshot('upstream'))
+    downstream = property(lambda self: self._snapshot('downstream'))
+    forward = property(lambda self: self._snapshot('forward'))
+    all = property(lambda self: self._snapshot('all'))
+
+    def add(self, node, listname='all'):
+        self.update(add=[node], listname=listname)
+
+    def remove(self, node, listname='all'):
+        self.update(remove=[node], listname=listname)
+
+    def targets(self):
+        return {
+            'upstream': config.upstream_target,
+            'downstream': config.downstream_target,
+            'forward': config.forward_target,
+        }
+
+    def schedule(self):
+        '''Rebalance upstream, downstream and forward links.
+        '''
+        penalty.table.purge()
+        now = time()
+        with self.lock:
+            for name in [k for k, v in self.retry.items() if v[0] + config.dial_retry_max < now]:
+                del self.retry[name]
+        for listname, target in self.targets().items():
+            nodes = getattr(self, listname)
+            if len(nodes) > target:
+                self.shed(listname, len(nodes) - target)
+            elif (listname != 'forward') and (self.pool is not None) and \
+                 (self.server is not None):
+                dialing = self.dialing[listname]
+                with self.lock:
+                    want = min(target - len(nodes) - len(dialing),
+                               config.dial_batch - len(dialing))
+                for node in self.candidates(listname, want):
+                    self.pool.submit(self._dial, node, listname)
+
+    def candidates(self, listname, count):
+        '''Best count nodes for listname.
+
+        Only config.candidate_scan nodes of all are checked at once,
+        the next call continues from where this call stops.
+        '''
+        if count <= 0:
+            return []
+        nodes = self.all
+        if not nodes:
+            return []
+        scan = min(config.candidate_scan, len(nodes))
+        begin = self.scan_cursor % len(nodes)
+        self.scan_cursor = begin + scan
+        window = nodes[begin:begin + scan]
+        if len(window) < scan:
+            window += nodes[:scan - len(window)]
+        members = self._members[listname]
+        upstream = (listname == 'upstream')
+        dialing = self.dialing['upstream'] | self.dialing['downstream']
+        now = time()
+        found = []
+        for node in window:
+            name = str(node)
+            if (name in members) or (name in dialing) or node.isself():
+                continue
+            if self.retry.get(name, (0, 0))[0] > now:
+                continue
+            if penalty.table.banned(node.addr):
+                continue
+            if node.can_upstream(config.speed) != upstream:
+                continue
+            found.append(node)
+        found = heapq.nlargest(count, found, key=lambda node: node.sortkey)
+        with self.lock:
+            for node in found:
+                self.dialing[listname].add(str(node))
+        return found
+
+    def _dial(self, node, listname):
+        '''Dial node, and link it if session of server does handshake.
+
+        Sample:
+        >>> from pyny.node import strnode
+        >>> class Connection:
+        ...     socket = 'socket'
+        ...     def clear(self):
+        ...         print('closed')
+        >>> manager = NodeManager(dial=lambda node: Connection())
+        >>> node = strnode('192.168.1.10:8000')
+        >>> manager._dial(node, 'upstream')
+        closed
+        >>> len(manager.upstream), node.connection
+        (0, None)
+        '''
+        name = str(node)
+        linked = False
+        future = None
+        try:
+            node.connection = self.dial(node)
+            if self.server is not None:
+                # socket is owned by session from here
+                future = self.server.attach(node.connection.socket, node)
+                node.session = future.result(config.dial_timeout + config.handshake_timeout)
+                linked = node.session is not None
+        except Exception:
+            pass
+        finally:
+            with self.lock:
+                self.dialing[listname].discard(name)
+                if linked:
+                    self.retry.pop(name, None)
+                else:
+                    failures = self.retry.get(name, (0, 0))[1] + 1
+                    delay = min(config.dial_retry * 2 ** (failures - 1), config.dial_retry_max)
+                    self.retry[name] = (time() + delay, failures)
+        if linked:
+            self.add(node, listname)
+            return
+        if future is not None:
+            # session which does handshake after timeout is not linked
+            future.add_done_callback(self._unlinked)
+        elif getattr(node, 'connection', None) is not None:
+            node.connection.clear()
+        node.session = None
+        node.connection = None
+
+    def _unlinked(self, future):
+        if future.cancelled() or (future.exception() is not None):
+            return
+        session = future.result()
+        if session is not None:
+            self.server.close_session(session)
+
+    def shed(self, listname, count):
+        '''Disconnect the worst count nodes of listname.
+        '''
+        worst = heapq.nsmallest(count, getattr(self, listname), key=_linkkey)
+        self.update(remove=worst, listname=listname)
+        for node in worst:
+            session = getattr(node, 'session', None)
+            if session is not None:
+                node.session = None
+                self.server.close_session(session)
+            else:
+                connection = getattr(node, 'connection', None)
+                if connection is not None:
+                    connection.clear()
+            node.connection = None
+
+    def save(self):
+        '''Merge nodes seen since the last save into cache and save it,
+        and returns number of them.
+
+        Sample:
+        >>> import os, tempfile
+        >>> from pyny.node import strnode
+        >>> path = os.path.join(tempfile.mkdtemp(), 'nodes.dat')
+        >>> manager = NodeManager()
+        >>> manager.cache = NodeCache(path)
+        >>> manager.add(strnode('192.168.1.10:8000'), 'upstream')
+        >>> manager.add(strnode('192.168.1.11:8000'))
+        >>> manager.save()
+        1
+        >>> manager = NodeManager()
+        >>> manager.cache = NodeCache(path)
+        >>> manager.cache.load()
+        >>> manager.seed()
+        1
+        >>> [str(i) for i in manager.all]
+        ['192.168.1.10:8000']
+        '''
+        with self.savelock:
+            now = int(time())
+            nodes = [i for i in self.all if i.last_seen >= self.saved]
+            self.cache.merge(nodes)
+            self.cache.save()
+            self.saved = now
+        return len(nodes)
+
+    def _save(self):
+        try:
+            self.save()
+        except Exception:
+            log.exception('NodeManager: save failed')
 
 
 # End of NodeManager
 
 
+def _sizes():
+    if _manager is None:
+        return {}
+    return dict((name, len(_manager.snapshot(name))) for name in NodeManager.listnames)
+
+
+registry.gauge('pyny_nodes', 'Nodes in lists of NodeManager', ('list', ), _sizes)
+
+
+def _linkkey(node):
+    '''Sort key of link, sortkey and measured speed.
+    '''
+    connection = getattr(node, 'connection', None)
+    if connection is None:
+        return (node.sortkey, 0)
+    return (node.sortkey, connection.get_speed())
+
+
+def dial_node(node):
+    connection = node.connect()
+    connection.open(config.dial_timeout)
+    return connection
+
+
+def start():
+    global _manager
+    _manager = NodeManager()
+    _manager.start()
+    return _manager
+
+
 def _test():
     import doctest
     from pyny import nodelist
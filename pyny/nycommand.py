@@ -723,7 +723,25 @@ class NyQuery(UnpackMixIn, NyCommand):
     keyinfo = []
     header_length = 4 + int_size + 1
 
-    def _unpack(self, data):
+    def unpack_header(self, data):
+        '''Unpack fields before keys, and returns the rest of data.
+
+        Sample:
+        >>> com = NyQuery()
+        >>> com.is_response = com.is_diffusion_query = False
+        >>> com.is_downstream_query = com.is_bbs_query = False
+        >>> com.query_id, com.vianode = 300, [ViaNode('192.168.1.1', 4000)]
+        >>> data = com.pack()
+        >>> com = NyQuery()
+        >>> hexstr(com.unpack_header(data[command_length_size + code_size:]))
+        '0000'
+        >>> com.query_id, str(com.vianode[0]), com.keyinfo
+        (300, '192.168.1.1:4000', [])
+        >>> com.unpack_header(data[command_length_size + code_size:-4])
+        Traceback (most recent call last):
+          ...
+        pyny.nyexcept.CommandError: NyQuery: command is too small
+        '''
         if len(data) < self.header_length:
             raise CommandError('NyQuery: command is too small')
         packet = StringIO(data)
@@ -739,10 +757,20 @@ class NyQuery(UnpackMixIn, NyCommand):
         self.keyword = packet.read(keyword_length)
         self.sign = re.sub('\0.*', '', packet.read(sign_length))
         vianode_size = ord(packet.read(1))
+        if len(data) < self.header_length + \
+                       keyword_length + sign_length + 1 + \
+                       vianode_size * node_size:
+            raise CommandError('NyQuery: command is too small')
+        self.vianode = []
+        self.keyinfo = []
         for i in range(vianode_size):
             vianode = ViaNode()
             vianode.unpack(packet.read(node_size))
             self.vianode.append(vianode)
+        return packet.read()
+
+    def _unpack(self, data):
+        packet = StringIO(self.unpack_header(data))
         keyinfo_size = packet_to_int(packet.read(short_size))
         pack = packet.read()
         for i in range(keyinfo_size):
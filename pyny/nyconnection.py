@@ -29,6 +29,7 @@
 #
 
 import random
+import socket
 from time import time
 
 from . import rc4
@@ -81,7 +82,8 @@ class Connection:
     '''Winny Connection.
     '''
 
-    def __init__(self):
+    def __init__(self, node=None):
+        self.node = node
         self.register = Register()
         self.socket = None
 
@@ -91,9 +93,16 @@ class Connection:
         self.send_size_sec = 0
         self.start_time = 0
 
+    def open(self, timeout=None):
+        '''Connect to node.
+        '''
+        self.socket = socket.create_connection((self.node.addr, self.node.port), timeout)
+        self.start_time = int(time())
+
     def clear(self):
         if self.socket:
             self.socket.close()
+            self.socket = None
 
     def get_speed(self):
         '''Speed (bps).
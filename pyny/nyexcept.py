@@ -29,7 +29,8 @@
 #
 
 __version__ = '$Revision: 15 $'
-__all__ = ['NyError', 'NodeError', 'NodeFormatError', 'CommandError']
+__all__ = ['NyError', 'NodeError', 'NodeFormatError', 'CommandError',
+           'KeyCacheError']
 
 
 class NyError(Exception):
@@ -46,3 +47,7 @@ class NodeFormatError(NodeError):
 
 class CommandError(NyError):
     pass
+
+
+class KeyCacheError(NyError):
+    pass
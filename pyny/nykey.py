@@ -156,7 +156,7 @@ class NyKeyInformation:
         self.modified_time = packet_to_int(packet.read(int_size))
         self.ignore = bool(packet_to_int(packet.read(1)))
         self.version = packet_to_int(packet.read(1))
-        return str(packet)
+        return packet.read()
 
 
 def _test():
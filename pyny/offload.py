@@ -0,0 +1,260 @@
+'''Process Pool Offload.
+
+RC4 and key decoding of large commands run in process pool.
+Payloads are passed by shared memory and crypted in place,
+results are memoryviews of it.
+Jobs smaller than config.offload_threshold run in caller.
+'''
+#
+# Copyright (c) 2006 Pyny Project.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHORS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# $Id: $
+#
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from . import rc4
+from . import config
+from . import nycommand
+
+__version__ = '$Revision: $'
+__all__ = ['Offloader', 'OffloadResult']
+
+
+def _key(key):
+    '''RC4 object of key string or RC4 object.
+    '''
+    if isinstance(key, rc4.RC4):
+        return key
+    r = rc4.RC4()
+    if isinstance(key, str):
+        r.setkey(key)
+    else:
+        r.setstate(key)
+    return r
+
+
+def _crypt_jobs(name, jobs):
+    '''Crypt jobs of (key, offset, size) in shared memory.
+
+    Integer key is index of former job, its RC4 stream goes on.
+    Returns RC4 states after crypt.
+    '''
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        keys = []
+        states = []
+        for key, offset, size in jobs:
+            if isinstance(key, int):
+                r = keys[key]
+            else:
+                r = _key(key)
+            keys.append(r)
+            view = shm.buf[offset:offset + size]
+            try:
+                r.crypt_into(view)
+            finally:
+                view.release()
+            states.append(r.getstate())
+        return states
+    finally:
+        shm.close()
+
+
+def _unpack_query(packet):
+    return nycommand.NyQuery(packet)
+
+
+class OffloadResult:
+    '''Crypted payloads.
+
+    views are memoryviews of payloads, they are valid until release().
+    '''
+
+    def __init__(self, buf, views, shm=None):
+        self.buf = buf
+        self.views = views
+        self.shm = shm
+
+    def __iter__(self):
+        return iter(self.views)
+
+    def __len__(self):
+        return len(self.views)
+
+    def __getitem__(self, i):
+        return self.views[i]
+
+    def release(self):
+        for view in self.views:
+            view.release()
+        self.views = []
+        self.buf.release()
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+# End of OffloadResult
+
+
+class Offloader:
+    '''Process Pool Offload.
+
+    Jobs are (key, payload), key is key string or RC4 object.
+    RC4 objects are updated, so stream crypt can go on after job.
+
+    Sample:
+    >>> o = Offloader(threshold=0x10000)
+    >>> key = rc4.RC4('abc')
+    >>> with o.crypt([(key, 'xyz'), ('abc', b'xyz')]) as result:
+    ...     [bytes(i) == rc4.crypt('abc', 'xyz').encode('latin-1') for i in result]
+    [True, True]
+    >>> key.m_x
+    3
+    '''
+
+    def __init__(self, workers=None, threshold=None):
+        if workers is None:
+            workers = config.offload_workers
+        if threshold is None:
+            threshold = config.offload_threshold
+        self.workers = workers
+        self.threshold = threshold
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers or None)
+        return self._pool
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def offloaded(self, size):
+        return (self.threshold > 0) and (size >= self.threshold)
+
+    def _prepare(self, jobs):
+        payloads = []
+        for key, payload in jobs:
+            if isinstance(payload, str):
+                payload = payload.encode('latin-1')
+            payloads.append(payload)
+        return payloads
+
+    def _layout(self, jobs, payloads, buf):
+        offset = 0
+        layout = []
+        views = []
+        for (key, payload), data in zip(jobs, payloads):
+            size = len(data)
+            buf[offset:offset + size] = data
+            views.append(buf[offset:offset + size])
+            layout.append((offset, size))
+            offset += size
+        return layout, views
+
+    def crypt(self, jobs):
+        '''Crypt jobs, and returns OffloadResult.
+        '''
+        jobs = list(jobs)
+        payloads = self._prepare(jobs)
+        total = sum(len(i) for i in payloads)
+        if not self.offloaded(total):
+            buf = memoryview(bytearray(total))
+            layout, views = self._layout(jobs, payloads, buf)
+            for (key, payload), view in zip(jobs, views):
+                _key(key).crypt_into(view)
+            return OffloadResult(buf, views)
+        shm, buf, views, future = self._submit(jobs, payloads, total)
+        self._finish(jobs, future.result())
+        return OffloadResult(buf, views, shm)
+
+    async def crypt_async(self, jobs):
+        '''Crypt jobs without blocking event loop.
+        '''
+        jobs = list(jobs)
+        payloads = self._prepare(jobs)
+        total = sum(len(i) for i in payloads)
+        if not self.offloaded(total):
+            return self.crypt(jobs)
+        shm, buf, views, future = self._submit(jobs, payloads, total)
+        self._finish(jobs, await asyncio.wrap_future(future))
+        return OffloadResult(buf, views, shm)
+
+    def _submit(self, jobs, payloads, total):
+        shm = shared_memory.SharedMemory(create=True, size=max(total, 1))
+        buf = shm.buf[:total]
+        layout, views = self._layout(jobs, payloads, buf)
+        args = []
+        streams = {}  # id of RC4 object -> index of job
+        for i, ((key, payload), (offset, size)) in enumerate(zip(jobs, layout)):
+            if isinstance(key, rc4.RC4):
+                if id(key) in streams:
+                    index, streams[id(key)] = streams[id(key)], i
+                    key = index
+                else:
+                    streams[id(key)] = i
+                    key = key.getstate()
+            args.append((key, offset, size))
+        return shm, buf, views, self.pool.submit(_crypt_jobs, shm.name, args)
+
+    def _finish(self, jobs, states):
+        for (key, payload), state in zip(jobs, states):
+            if isinstance(key, rc4.RC4):
+                key.setstate(state)
+
+    async def unpack_query(self, packet):
+        '''Unpack NyQuery and its keys.
+        '''
+        if not self.offloaded(len(packet)):
+            return nycommand.NyQuery(packet)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, _unpack_query, packet)
+
+
+# End of Offloader
+
+
+def _test():
+    import doctest
+    from pyny import offload
+    return doctest.testmod(offload)
+
+
+if __name__ == '__main__':
+    _test()
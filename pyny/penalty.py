@@ -0,0 +1,176 @@
+'''Peer Penalty Table.
+
+Peers are penalized for broken commands and for wrong blocks.
+Close commands sent by peers are about us, they are not penalized,
+but the peer is not dialled again for the seconds of backoffs.
+Penalty points of address decay with time, and the address is banned
+while its points are over the limit.
+Addresses which are not IPv4 are never penalized.
+'''
+#
+# Copyright (c) 2006 Pyny Project.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHORS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# $Id: $
+#
+
+import heapq
+import math
+from threading import Lock
+from time import time
+
+from . import nycommand
+from .conv import parse_address
+
+__version__ = '$Revision: $'
+__all__ = ['PenaltyTable', 'table', 'violation', 'backoffs']
+
+violation = 'violation'  # reason of broken commands
+
+# reason: (points, half life seconds)
+reasons = {
+    nycommand.NyLiar.code: (100, 6 * 3600),
+    violation: (50, 3600),
+}
+# close code received from peer: seconds before it is dialled again
+backoffs = {
+    nycommand.NyConnectedLimitation.code: 60,
+    nycommand.NyReject.code: 600,
+    nycommand.NySlow.code: 600,
+    nycommand.NyLiar.code: 3600,
+    nycommand.NyWrongListeningPort.code: 3600,
+    nycommand.NyLowVersion.code: 24 * 3600,
+}
+limit = 50  # banned while points >= limit
+floor = 1  # forget address when points < floor
+
+
+class PenaltyTable:
+    '''Penalty Table.
+
+    Table is dict of integer address -> [points, time, half life, expire].
+    Expire times are in heap, purge() pops expired addresses.
+
+    Sample:
+    >>> t = PenaltyTable()
+    >>> t.penalize('192.168.1.10', violation, now=0)
+    >>> t.banned('192.168.1.10', now=0)
+    True
+    >>> t.banned('192.168.1.10', now=600)
+    False
+    >>> t.penalize('192.168.1.11', nycommand.NySlow.code, now=0)
+    >>> t.banned('192.168.1.11', now=0)
+    False
+    >>> t.purge(now=10**6)
+    1
+    >>> t.penalize('::1', violation, now=0)
+    >>> t.banned('::1', now=0)
+    False
+    >>> len(t)
+    0
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.table = {}
+        self.expires = []  # heap of (expire, address)
+
+    def __len__(self):
+        return len(self.table)
+
+    def penalize(self, address, code, now=None):
+        '''Add points of reason code.
+
+        Argument address is IP address or its integer.
+        '''
+        if code not in reasons:
+            return
+        if now is None:
+            now = time()
+        if isinstance(address, str):
+            address = parse_address(address)
+            if address is None:
+                return
+        points, halflife = reasons[code]
+        with self.lock:
+            entry = self.table.get(address)
+            if entry is not None:
+                points += _decay(entry, now)
+                halflife = max(halflife, entry[2])
+            expire = now + halflife * math.log2(max(points / floor, 1))
+            self.table[address] = [points, now, halflife, expire]
+            heapq.heappush(self.expires, (expire, address))
+
+    def points(self, address, now=None):
+        if isinstance(address, str):
+            address = parse_address(address)
+        entry = self.table.get(address)
+        if entry is None:
+            return 0
+        if now is None:
+            now = time()
+        return _decay(entry, now)
+
+    def banned(self, address, now=None):
+        '''Check address before dialling or accepting it.
+        '''
+        return self.points(address, now) >= limit
+
+    def purge(self, now=None):
+        '''Forget expired addresses.
+
+        Returns number of them.
+        '''
+        if now is None:
+            now = time()
+        count = 0
+        with self.lock:
+            while self.expires and (self.expires[0][0] <= now):
+                expire, address = heapq.heappop(self.expires)
+                entry = self.table.get(address)
+                if (entry is not None) and (entry[3] == expire):
+                    del self.table[address]
+                    count += 1
+        return count
+
+
+# End of PenaltyTable
+
+
+def _decay(entry, now):
+    points, since, halflife = entry[:3]
+    return points * 0.5 ** (max(now - since, 0) / halflife)
+
+
+table = PenaltyTable()
+
+
+def _test():
+    import doctest
+    from pyny import penalty
+    return doctest.testmod(penalty)
+
+
+if __name__ == '__main__':
+    _test()
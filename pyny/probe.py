@@ -0,0 +1,219 @@
+'''Hot Path Probes.
+
+Probes measure wall clock and CPU time of codec, crypt and dispatch.
+Coroutine stages wait for network and other tasks, so only their
+latency is measured, and they are not in sampled stacks.
+They are installed by enable() and removed by disable(),
+so disabled probes cost nothing.
+One of config.probe_rate calls is measured.
+Sampled stacks are dumped in collapsed format for flamegraph,
+when SIGUSR2 is received or dump() is called.
+
+Stages:
+- rc4.crypt             rc4.RC4.crypt
+- rc4.crypt_into        rc4.RC4.crypt_into, blocks of send_block and offload
+- nykey.unpack          nykey.NyKeyInformation.unpack
+- nycommand.query       nycommand.NyQuery._unpack
+- server.read           server.NySession.read (latency)
+- server.dispatch       server.NyServer.dispatch (latency)
+'''
+#
+# Copyright (c) 2006 Pyny Project.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHORS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# $Id: $
+#
+
+import os
+import sys
+import signal
+import asyncio
+import functools
+from time import perf_counter, thread_time
+
+from . import config
+from .metrics import registry
+
+__version__ = '$Revision: $'
+__all__ = ['enable', 'disable', 'dump']
+
+wall_seconds = registry.histogram('pyny_probe_wall_seconds', 'Wall clock time of sampled calls', ('stage', ))
+cpu_seconds = registry.histogram('pyny_probe_cpu_seconds', 'CPU time of sampled calls', ('stage', ))
+latency_seconds = registry.histogram('pyny_probe_latency_seconds',
+                                     'Time of sampled coroutine calls with awaits', ('stage', ))
+
+stacks = {}  # collapsed stack -> microseconds
+_installed = []  # (owner, attribute name, original)
+_handler = None  # SIGUSR2 handler before enable()
+
+
+def _targets():
+    from . import rc4, nykey, nycommand, server
+    return [
+        ('rc4.crypt', rc4.RC4, 'crypt'),
+        ('rc4.crypt_into', rc4.RC4, 'crypt_into'),
+        ('nykey.unpack', nykey.NyKeyInformation, 'unpack'),
+        ('nycommand.query', nycommand.NyQuery, '_unpack'),
+        ('server.read', server.NySession, 'read'),
+        ('server.dispatch', server.NyServer, 'dispatch'),
+    ]
+
+
+def _collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s:%s' % (code.co_filename.rsplit('/', 1)[-1], code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def _record(stage, wall, cpu, frame):
+    wall_seconds.labels(stage).observe(wall)
+    cpu_seconds.labels(stage).observe(cpu)
+    key = _collapse(frame) + ';' + stage
+    stacks[key] = stacks.get(key, 0) + int(wall * 1000000)
+
+
+def _wrap(stage, func, rate):
+    counter = [0]
+
+    if asyncio.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def probe(*args, **kw):
+            counter[0] += 1
+            if counter[0] < rate:
+                return await func(*args, **kw)
+            counter[0] = 0
+            begin = perf_counter()
+            try:
+                return await func(*args, **kw)
+            finally:
+                latency_seconds.labels(stage).observe(perf_counter() - begin)
+
+        return probe
+
+    @functools.wraps(func)
+    def probe(*args, **kw):
+        counter[0] += 1
+        if counter[0] < rate:
+            return func(*args, **kw)
+        counter[0] = 0
+        frame = sys._getframe(1)
+        wall, cpu = perf_counter(), thread_time()
+        try:
+            return func(*args, **kw)
+        finally:
+            _record(stage, perf_counter() - wall, thread_time() - cpu, frame)
+
+    return probe
+
+
+def enable(rate=None):
+    '''Install probes, measure one of rate calls.
+
+    Sample:
+    >>> from pyny import rc4
+    >>> previous = signal.getsignal(signal.SIGUSR2)
+    >>> enable(rate=1)
+    >>> data = rc4.RC4('abc').crypt('xyz')
+    >>> wall_seconds.labels('rc4.crypt').count
+    1
+    >>> rc4.RC4('abc').crypt_into(bytearray(b'xyz'))
+    >>> wall_seconds.labels('rc4.crypt_into').count
+    1
+    >>> disable()
+    >>> signal.getsignal(signal.SIGUSR2) is previous
+    True
+    >>> data = rc4.RC4('abc').crypt('xyz')
+    >>> wall_seconds.labels('rc4.crypt').count
+    1
+    >>> any(i.endswith(';rc4.crypt') for i in stacks)
+    True
+    '''
+    global _handler
+    if rate is None:
+        rate = config.probe_rate
+    if _installed:
+        disable()
+    for stage, owner, name in _targets():
+        original = owner.__dict__[name]
+        _installed.append((owner, name, original))
+        setattr(owner, name, _wrap(stage, original, max(rate, 1)))
+    if hasattr(signal, 'SIGUSR2'):
+        try:
+            _handler = signal.signal(signal.SIGUSR2, lambda signum, frame: dump())
+        except ValueError:
+            pass  # not main thread
+        else:
+            if _handler is None:
+                # handler was not set from Python
+                _handler = signal.SIG_DFL
+
+
+def disable():
+    '''Remove probes, and restore SIGUSR2 handler.
+    '''
+    global _handler
+    while _installed:
+        owner, name, original = _installed.pop()
+        setattr(owner, name, original)
+    if _handler is not None:
+        try:
+            signal.signal(signal.SIGUSR2, _handler)
+            _handler = None
+        except ValueError:
+            pass  # not main thread
+
+
+def dump(path=None):
+    '''Write collapsed stacks, and clear them.
+
+    Stacks are copied first, other threads record while they are written,
+    and only written time is taken from them.
+    '''
+    if path is None:
+        path = config.probe_dump
+    items = sorted(list(stacks.items()))
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(path, 'w') as f:
+        for stack, usec in items:
+            f.write('%s %d\n' % (stack, usec))
+    for stack, usec in items:
+        left = stacks.pop(stack, 0) - usec
+        if left > 0:
+            stacks[stack] = left
+
+
+def _test():
+    import doctest
+    from pyny import probe
+    return doctest.testmod(probe)
+
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,209 @@
+'''Query Filter.
+
+Same NyQuery comes back again and again while it is diffused.
+Query ids seen recently are kept exactly in LRU, and older ones are kept
+in Bloom filters of time buckets, so memory does not grow with traffic.
+The oldest bucket is cleared and reused when the newest one gets older
+than config.query_seen_time / config.query_filter_buckets.
+Queries are checked by their headers, before keys are unpacked.
+'''
+#
+# Copyright (c) 2006 Pyny Project.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHORS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# $Id: $
+#
+
+from collections import OrderedDict
+from time import monotonic
+
+from . import config
+from .identity import local
+from .metrics import registry
+from .nycommand import NyQuery
+
+__version__ = '$Revision: $'
+__all__ = ['RotatingBloom', 'QueryFilter']
+
+mask64 = 0xFFFFFFFFFFFFFFFF
+filtered = registry.counter('pyny_queries_filtered_total', 'Queries checked by query filter',
+                            ('result', ))
+
+
+class RotatingBloom:
+    '''Bloom Filters of Time Buckets.
+
+    Sample:
+    >>> b = RotatingBloom(bits=0x1000, hashes=4, buckets=2, period=10, now=0)
+    >>> b.add(300, now=0)
+    >>> 300 in b, 301 in b
+    (True, False)
+    >>> b.rotate(now=7)
+    >>> 300 in b
+    True
+    >>> b.rotate(now=12)
+    >>> 300 in b
+    False
+    '''
+
+    def __init__(self, bits, hashes, buckets, period, now=None):
+        if now is None:
+            now = monotonic()
+        self.bits = bits
+        self.hashes = hashes
+        self.span = period / buckets
+        self.filters = [bytearray(bits >> 3) for i in range(buckets)]
+        self.current = 0
+        self.since = now
+
+    def _positions(self, key):
+        h = (key * 0x9E3779B97F4A7C15) & mask64
+        h ^= h >> 29
+        h = (h * 0xBF58476D1CE4E5B9) & mask64
+        h1 = h & 0xFFFFFFFF
+        h2 = (h >> 32) | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def rotate(self, now=None):
+        '''Clear buckets older than period.
+        '''
+        if now is None:
+            now = monotonic()
+        for i in range(len(self.filters)):
+            if now - self.since < self.span:
+                return
+            self.current = (self.current + 1) % len(self.filters)
+            self.filters[self.current] = bytearray(self.bits >> 3)
+            self.since += self.span
+        self.since = now
+
+    def add(self, key, now=None):
+        self.rotate(now)
+        bucket = self.filters[self.current]
+        for p in self._positions(key):
+            bucket[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, key):
+        positions = self._positions(key)
+        for bucket in self.filters:
+            for p in positions:
+                if not bucket[p >> 3] & (1 << (p & 7)):
+                    break
+            else:
+                return True
+        return False
+
+
+# End of RotatingBloom
+
+
+class QueryFilter:
+    '''Query Filter.
+
+    Register filter() as command filter of NyQuery.
+    Responses are not filtered, they go back along their via nodes.
+
+    Sample:
+    >>> from pyny.identity import LocalIdentity
+    >>> from pyny.nycommand import NyQuery, ViaNode, command_length_size, code_size
+    >>> def query(query_id, *vianode):
+    ...     q = NyQuery()
+    ...     q.is_response = q.is_diffusion_query = False
+    ...     q.is_downstream_query = q.is_bbs_query = False
+    ...     q.query_id, q.vianode = query_id, list(vianode)
+    ...     return q.pack()[command_length_size + code_size:]
+    >>> f = QueryFilter(recent=2, bits=0x1000)
+    >>> [f.filter(None, query(i)) for i in (1, 2, 1, 3, 4, 1)]
+    [True, True, False, True, True, False]
+    >>> f.identity = LocalIdentity()
+    >>> f.identity.refresh(interfaces=['192.168.1.10'])
+    >>> f.filter(None, query(5, ViaNode('192.168.1.10', config.port)))
+    False
+    '''
+
+    def __init__(self, recent=None, bits=None, hashes=None, buckets=None, seen_time=None):
+        if recent is None:
+            recent = config.query_filter_recent
+        if bits is None:
+            bits = config.query_filter_bits
+        if hashes is None:
+            hashes = config.query_filter_hashes
+        if buckets is None:
+            buckets = config.query_filter_buckets
+        if seen_time is None:
+            seen_time = config.query_seen_time
+        self.size = recent
+        self.seen_time = seen_time
+        self.identity = local
+        self.recent = OrderedDict()  # query id -> time seen
+        self.bloom = RotatingBloom(bits, hashes, buckets, seen_time)
+
+    def seen(self, query_id, now=None):
+        '''True if query_id is seen before, and remember it.
+        '''
+        if now is None:
+            now = monotonic()
+        since = self.recent.get(query_id)
+        if (since is not None) and (now - since < self.seen_time):
+            self.recent.move_to_end(query_id)
+            filtered.labels('recent').inc()
+            return True
+        self.bloom.rotate(now)
+        if (since is None) and (query_id in self.bloom):
+            filtered.labels('bloom').inc()
+            return True
+        self.bloom.add(query_id, now)
+        self.recent[query_id] = now
+        self.recent.move_to_end(query_id)
+        if len(self.recent) > self.size:
+            self.recent.popitem(last=False)
+        filtered.labels('new').inc()
+        return False
+
+    def filter(self, session, data):
+        '''Command filter of NyQuery, False for duplicated queries
+        and queries which came through this node.
+        '''
+        query = NyQuery()
+        query.unpack_header(data)
+        if query.is_response:
+            return True
+        for node in query.vianode:
+            if self.identity.isself_address(node.address, node.port):
+                filtered.labels('loop').inc()
+                return False
+        return not self.seen(query.query_id)
+
+
+# End of QueryFilter
+
+
+def _test():
+    import doctest
+    from pyny import queryfilter
+    return doctest.testmod(queryfilter)
+
+
+if __name__ == '__main__':
+    _test()
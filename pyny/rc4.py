@@ -28,9 +28,14 @@
 # $Id: rc4.py 15 2006-12-10 06:23:36Z fuktommy $
 #
 
+from .metrics import registry
+
 __version__ = '$Revision: 15 $'
 __all__ = ['crypt']
 
+crypted_bytes = registry.counter('pyny_rc4_bytes_total', 'Bytes crypted by RC4')
+_schedules = {}  # one byte key -> state after setkey()
+
 
 class RC4:
     '''RC4 for Winny.
@@ -68,7 +73,54 @@ class RC4:
             if ki >= len(key):
                 ki = 0
 
+    def copy(self):
+        '''Copy key schedule and stream position.
+
+        Sample:
+        >>> r = RC4('abc')
+        >>> r.copy().crypt('xyz') == r.crypt('xyz')
+        True
+        '''
+        clone = RC4()
+        clone.m_state = self.m_state[:]
+        clone.m_x = self.m_x
+        clone.m_y = self.m_y
+        return clone
+
+    def getstate(self):
+        return (self.m_state[:], self.m_x, self.m_y)
+
+    def setstate(self, state):
+        self.m_state = list(state[0])
+        self.m_x = state[1]
+        self.m_y = state[2]
+
+    def crypt_into(self, buf):
+        '''Crypt writable bytes buffer in place.
+
+        Sample:
+        >>> buf = bytearray(b'xyz')
+        >>> RC4('abc').crypt_into(buf)
+        >>> buf.decode('latin-1') == RC4('abc').crypt('xyz')
+        True
+        '''
+        crypted_bytes.inc(len(buf))
+        state = self.m_state
+        x = self.m_x
+        y = self.m_y
+        for i in range(len(buf)):
+            x = (x + 1) & 0xFF
+            sx = state[x]
+            y = (sx + y) & 0xFF
+            sy = state[y]
+            state[y] = sx
+            state[x] = sy
+            buf[i] ^= state[(sx + sy) & 0xFF]
+        self.m_x = x
+        self.m_y = y
+
     def crypt(self, src):
+        crypted_bytes.inc(len(src))
         dest = []
         for c in src:
             x = (self.m_x + 1) & 0xFF
@@ -101,7 +153,16 @@ def crypt(key, src):
     >>> hexstr(crypt(key, src))
     'a631000057696e6e7920566572322e30'
     '''
-    return RC4(key).crypt(src)
+    if len(key) != 1:
+        return RC4(key).crypt(src)
+    # file names of keys are crypted by one byte keys
+    state = _schedules.get(key)
+    if state is None:
+        state = RC4(key).getstate()
+        _schedules[key] = state
+    rc4 = RC4()
+    rc4.setstate(state)
+    return rc4.crypt(src)
 
 
 def _test():
@@ -28,61 +28,583 @@
 # $Id: nodelist.py 3 2006-03-06 01:03:41Z fuktommy $
 #
 
-from threading import Thread
-from socketserver import ThreadingTCPServer, StreamRequestHandler
+import asyncio
+import struct
+from time import monotonic
+from threading import Thread, Event
+from concurrent.futures import ThreadPoolExecutor
 
+from . import rc4
 from . import config
+from . import penalty
+from . import nycommand
+from . import nodelist
+from . import keycache
+from .conv import packet_to_int, int_to_packet
+from .offload import Offloader
+from .metrics import registry
+from .admission import Admission
+from .identity import local as identity
+from .node import Node
+from .queryfilter import QueryFilter
+from .diffusion import DiffusionEngine
+from .aggregator import ResponseAggregator
+from .conditions import ConditionRegistry
+from .keystore import KeyStore
+from .blockcache import BlockCache
+from .upload import UploadScheduler
+from .download import Downloader
+from .verify import Verifier
+from .nyconnection import random_data, block_max
+from .nyexcept import *
 
 __all__ = ['start']
 __version__ = '$Revision: 3 $'
 
 _server = None
 
+init_block_size = 6
+commands = {}
+for _name in nycommand.__all__:
+    _class = getattr(nycommand, _name)
+    if getattr(_class, 'code', 0) > 0 or _class is nycommand.NyProtocolHeader:
+        commands[_class.code] = _class
+close_commands = (nycommand.CloseConnection,)
 
-class NyServer(ThreadingTCPServer, Thread):
+frames_in = registry.counter('pyny_frames_in_total', 'Commands received', ('code', ))
+frames_out = registry.counter('pyny_frames_out_total', 'Commands sent', ('code', ))
+link_bytes = registry.counter('pyny_link_bytes_total', 'Bytes on links', ('linktype', 'direction'))
+decode_errors = registry.counter('pyny_decode_errors_total', 'Broken commands', ('error', ))
+sent_blocks = registry.counter('pyny_cached_blocks_sent_total', 'Cached blocks sent', ('path', ))
+handshake_seconds = registry.histogram('pyny_handshake_seconds', 'Time to exchange init blocks')
 
-    def __init__(self, port):
+
+class NyServer(Thread):
+    '''Winny Server.
+
+    All connections are handled by one event loop in this thread.
+    Command handlers are called as handler(session, command),
+    coroutine handlers are awaited.
+    Command filters are called as filter(session, data) with data of
+    command before it is unpacked, and the command is dropped if it
+    returns False.
+    Close listeners are called as listener(session) when sessions end.
+    NyQuery is filtered by QueryFilter, and diffused by DiffusionEngine
+    over links of manager, nodelist._manager by default.
+    Links dialled by NodeManager are attached to this server.
+    NyFileRequest is served by UploadScheduler from block cache,
+    and NyFileResponse goes to downloads of Downloader into it.
+    Block cache is BlockCache of config.blockcache by default,
+    none if it is empty.
+    They are set up in start().
+    Commands larger than config.server_offload_size are unpacked in
+    executor when config.server_workers > 0.
+    Commands larger than config.offload_threshold are decrypted,
+    and NyQuery is unpacked, in process pool.
+    '''
+
+    def __init__(self, port, reuse_port=False, manager=None, store=None, cache=None):
         Thread.__init__(self)
-        address = ('', port)
-        ThreadingTCPServer.__init__(self, address, NyRequestHandler)
+        self.daemon = True
+        self.port = port
+        self.reuse_port = reuse_port
+        self.manager = manager
+        self.store = store
+        self.cache = cache
+        self.uploads = None
+        self.downloads = None
+        self.loop = None
+        self.aserver = None
+        self.ready = Event()
+        self.sessions = set()
+        self.handlers = {}
+        self.filters = {}
+        self.close_listeners = []
+        self.query_filter = None
+        self.diffusion = None
+        self.aggregator = None
+        self.conditions = None
+        self.keycache = None
+        self.admission = Admission()
+        self.offloader = Offloader()
+        admission = self.admission
+        registry.gauge('pyny_sessions', 'Sessions', func=lambda: len(self.sessions))
+        registry.gauge('pyny_queued_bytes', 'Bytes waiting to be sent', func=lambda: admission.queued)
+        registry.gauge('pyny_loop_lag_seconds', 'Event loop lag', func=lambda: admission.lag)
+        registry.gauge('pyny_links', 'Links by type', ('linktype', ), lambda: dict(admission.links))
+        registry.counter('pyny_admitted_total', 'Admitted connections', func=lambda: admission.admitted)
+        registry.counter('pyny_rejected_total', 'Rejected connections', ('reason', ),
+                         lambda: dict(admission.rejected))
+        self.executor = None
+        if config.server_workers > 0:
+            self.executor = ThreadPoolExecutor(max_workers=config.server_workers)
+        self.register(nycommand.NyProtocolHeader, _handle_header)
+        self.register(nycommand.NyConnectionType, _handle_connection_type)
+        self.register(nycommand.NyNodeDetails, _handle_node_details)
+        for code, command in commands.items():
+            if issubclass(command, close_commands):
+                self.register(command, _handle_close)
+
+    def register(self, command, handler):
+        '''Set handler of command class.
+        '''
+        self.handlers[command.code] = handler
+
+    def register_filter(self, command, filter):
+        '''Set filter of command class.
+        '''
+        self.filters[command.code] = filter
+
+    def start(self):
+        '''Set up query filter, key store and diffusion, and start the thread.
+
+        Local key store is restored from key cache, and saved into it
+        while running and once more when the thread ends.
+        '''
+        self.query_filter = QueryFilter()
+        self.register_filter(nycommand.NyQuery, self.query_filter.filter)
+        if self.store is None:
+            self.store = KeyStore()
+        if isinstance(self.store, KeyStore) and config.keycache:
+            self.keycache = keycache.restore(self.store)
+        if self.manager is None:
+            self.manager = nodelist._manager
+        if isinstance(self.manager, nodelist.NodeManager):
+            self.manager.serve(self)
+        if self.manager is not None:
+            self.diffusion = DiffusionEngine(self, self.manager, self.store)
+            self.aggregator = ResponseAggregator()
+            self.diffusion.on_response = self.aggregator.on_response
+            self.register(nycommand.NyQuery, self.diffusion.on_query)
+            self.register(nycommand.NyDiffusionRequest, self.diffusion.on_request)
+            self.close_listeners.append(self.diffusion.drop)
+        if self.store is not None:
+            self.conditions = ConditionRegistry(on_match=self.send_match)
+            self.register(nycommand.NyConditionalDiffusionRequest, self.conditions.on_request)
+            self.close_listeners.append(self.conditions.remove_owner)
+            if isinstance(self.store, KeyStore):
+                self.conditions.attach(self.store)
+            elif self.diffusion is not None:
+                self.diffusion.on_keys = self.conditions.on_keys
+        if (self.cache is None) and config.blockcache:
+            self.cache = BlockCache()
+        if self.cache is not None:
+            if self.cache.map is None:
+                self.cache.open()
+            self.uploads = UploadScheduler(self.cache)
+            self.register(nycommand.NyFileRequest, self.uploads.on_request)
+            self.close_listeners.append(self.uploads.drop)
+            self.downloads = Downloader(self.cache, Verifier())
+            self.register(nycommand.NyFileResponse, self.downloads.on_response)
+            self.close_listeners.append(self.downloads.drop)
+        Thread.start(self)
 
     def run(self):
-        self.serve_forever()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            # a save in executor is finished before the last one
+            self.loop.run_until_complete(self.loop.shutdown_default_executor())
+            self.loop.close()
+            if self.keycache is not None:
+                self.keycache.save(self.store)
+
+    async def serve(self):
+        self.aserver = await asyncio.start_server(self.accept,
+                                                  host=config.address,
+                                                  port=self.port,
+                                                  backlog=config.server_backlog,
+                                                  reuse_port=self.reuse_port)
+        loop = asyncio.get_running_loop()
+        monitor = loop.create_task(self.admission.monitor(self.sessions))
+        keeper = None
+        if self.keycache is not None:
+            keeper = loop.create_task(self.keycache.run(self.store))
+        scraper = None
+        if config.metrics_port:
+            scraper = await registry.serve(config.metrics_address, config.metrics_port)
+        self.ready.set()
+        try:
+            await self.aserver.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            monitor.cancel()
+            if keeper is not None:
+                keeper.cancel()
+            if scraper is not None:
+                scraper.close()
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.aserver.close)
+
+    def verify_request(self, peer):
+        '''Refuse banned peers before handling them.
+        '''
+        return not (peer and penalty.table.banned(peer[0]))
 
     def busy(self):
         '''I am busy.
 
         Requests are ommited.
         '''
-        return False
+        return self.admission.reason() is not None
 
+    async def accept(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        if not self.verify_request(peer):
+            writer.close()
+            return
+        if self.admission.check() is not None:
+            writer.write(reject_packet())
+            writer.close()
+            return
+        await self.handle(NySession(self, reader, writer))
 
-# End of NyServer
+    def attach(self, sock, node=None):
+        '''Handle connected socket in event loop.
 
+        It is called from other threads, with sockets made by NodeManager.
+        Returns concurrent future of the session after handshake,
+        or None if handshake fails.
+        '''
 
-class NyRequestHandler(StreamRequestHandler):
+        async def attach():
+            try:
+                reader, writer = await asyncio.open_connection(sock=sock)
+            except BaseException:
+                sock.close()
+                raise
+            session = NySession(self, reader, writer, node)
+            asyncio.get_running_loop().create_task(self.handle(session))
+            await session.handshaken.wait()
+            if session.closed:
+                return None
+            return session
 
-    def handle(self):
-        '''Server main loop.
+        return asyncio.run_coroutine_threadsafe(attach(), self.loop)
+
+    def close_session(self, session):
+        '''Close session from other threads.
         '''
-        self.close_connection = True
-        self.handle_one_request()
-        while not self.close_connection:
-            self.handle_one_request()
+        self.loop.call_soon_threadsafe(session.close)
+
+    def send_match(self, session, query_id, keyinfo):
+        '''Send key which matched condition of session, as response of query_id.
 
-    def handle_one_request(self):
-        '''Now it is ECHO server.
+        It is on_match of conditions, called in event loop.
         '''
-        if _server.busy():
+        if session.closed:
+            return
+        query = nycommand.NyQuery()
+        query.is_response = True
+        query.is_diffusion_query = query.is_downstream_query = query.is_bbs_query = False
+        query.query_id = query_id
+        query.vianode = []
+        query.keyinfo = [keyinfo]
+        session.send(query)
+
+    async def handle(self, session):
+        self.sessions.add(session)
+        self.admission.admit()
+        try:
+            await session.run()
+        finally:
+            self.admission.release()
+            self.sessions.discard(session)
+            for listener in self.close_listeners:
+                listener(session)
+
+    async def dispatch(self, session, command):
+        handler = self.handlers.get(command.code)
+        if handler is None:
             return
-        while True:
-            buf = self.rfile.readline()
-            if not buf:
-                break
-            self.wfile.write(buf)
+        result = handler(session, command)
+        if asyncio.iscoroutine(result):
+            await result
+
+
+# End of NyServer
+
+
+class NySession:
+    '''Connection with one node.
+
+    Each side sends 6 bytes init block first, and the rest of stream is
+    crypted by RC4 keyed with init_block[2:6] of the sender.
+    Links with config.raw_peers are not crypted, cached blocks are sent
+    to them by sendfile.
+    '''
+
+    def __init__(self, server, reader, writer, node=None):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.node = node
+        self.peer = writer.get_extra_info('peername')
+        self.header = None
+        self.linktype = ''
+        self.closed = False
+        self.send_key = None
+        self.recv_key = None
+        self.raw = bool(self.peer) and (self.peer[0] in config.raw_peers)
+        self.handshaken = asyncio.Event()  # set after handshake or close
+        self.sendfile_lock = asyncio.Lock()
+        self.held = None  # data written while sendfile is in progress
+
+    async def handshake(self):
+        init_block = random_data(init_block_size)
+        self.send_key = rc4.RC4(init_block[2:])
+        self.writer.write(init_block.encode('latin-1'))
+        header = nycommand.NyProtocolHeader()
+        header.major = nycommand.major_version
+        header.minor = nycommand.minor_version
+        self.send(header)
+        peer_block = await self.read(init_block_size, False)
+        self.recv_key = rc4.RC4(peer_block[2:])
+
+    async def read(self, size, decrypt=True):
+        data = await self.reader.readexactly(size)
+        self.server.admission.traffic(size)
+        link_bytes.labels(self.linktype, 'in').inc(size)
+        if self.raw:
+            decrypt = False
+        if decrypt and self.server.offloader.offloaded(size):
+            with await self.server.offloader.crypt_async([(self.recv_key, data)]) as result:
+                return result[0].tobytes().decode('latin-1')
+        data = data.decode('latin-1')
+        if decrypt:
+            data = self.recv_key.crypt(data)
+        return data
+
+    async def read_command(self):
+        '''Read one command, None if its code is unknown or it is filtered.
+        '''
+        head = await self.read(nycommand.command_length_size)
+        length = packet_to_int(head)
+        if (length < nycommand.code_size) or (length > block_max):
+            raise CommandError('NyServer: bad command length')
+        body = await self.read(length)
+        frames_in.labels(ord(body[0])).inc()
+        command = commands.get(ord(body[0]))
+        if command is None:
+            return None
+        try:
+            return await self._decode(command, head, body)
+        except (IndexError, KeyError, TypeError, ValueError, UnicodeError, struct.error) as err:
+            raise CommandError('%s: broken command (%s)' % (command.__name__, err))
+
+    async def _decode(self, command, head, body):
+        '''Filter and unpack command.
+
+        Sample:
+        >>> class Server:
+        ...     filters = {}
+        ...     offloader = Offloader()
+        ...     executor = ThreadPoolExecutor(max_workers=1)
+        >>> session = NySession.__new__(NySession)
+        >>> session.server = Server()
+        >>> com = nycommand.NyConnectionType()
+        >>> com.setvalues(linktypestr='Transfer')
+        >>> packet = com.pack()
+        >>> decode = lambda: session._decode(type(com), packet[:4], packet[4:])
+        >>> asyncio.run(decode()).linktypestr
+        'Transfer'
+        >>> size, config.server_offload_size = config.server_offload_size, 0
+        >>> asyncio.run(decode()).linktypestr
+        'Transfer'
+        >>> config.server_offload_size = size
+        >>> Server.executor.shutdown()
+        '''
+        filter = self.server.filters.get(command.code)
+        if (filter is not None) and not filter(self, body[nycommand.code_size:]):
+            return None
+        packet = head + body
+        if (command is nycommand.NyQuery) and self.server.offloader.offloaded(len(packet)):
+            return await self.server.offloader.unpack_query(packet)
+        if (self.server.executor is not None) and (len(packet) > config.server_offload_size):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.server.executor, command, packet)
+        return command(packet)
+
+    def send(self, command):
+        self.send_packets([command.pack()], command.code)
+
+    def send_packets(self, packets, code):
+        '''Send packed commands of code, crypted and written at once.
+        '''
+        packet = ''.join(packets)
+        self.server.admission.traffic(len(packet))
+        frames_out.labels(code).inc(len(packets))
+        link_bytes.labels(self.linktype, 'out').inc(len(packet))
+        if not self.raw:
+            packet = self.send_key.crypt(packet)
+        self.write(packet.encode('latin-1'))
+
+    def write(self, data):
+        '''Write data, after sendfile if it is in progress.
+        '''
+        if self.held is not None:
+            self.held.append(data)
+        else:
+            self.writer.write(data)
+
+    async def send_block(self, cache, hash, block_begin, task_id):
+        '''Send cached block as NyFileResponse.
+
+        Returns False when the block is not cached.
+        Block data is sent from cache file by sendfile on raw links,
+        and crypted from mapping on others.
+        Other writes wait until sendfile ends, and so do other sendfiles.
+        '''
+        block = cache.get(hash, block_begin)
+        if block is None:
+            return False
+        with block as data:
+            length = len(data)
+            if self.raw and config.sendfile:
+                async with self.sendfile_lock:
+                    await self._sendfile(cache, block.slot, hash, block_begin, task_id, length)
+                sent_blocks.labels('sendfile').inc()
+                return True
+            packet = self._block_header(hash, block_begin, task_id, length)
+            packet += data
+        if not self.raw:
+            self.send_key.crypt_into(packet)
+        self.write(packet)
+        sent_blocks.labels('write').inc()
+        return True
+
+    def _block_header(self, hash, block_begin, task_id, length):
+        '''Header of NyFileResponse as bytearray, and it is counted as sent.
+        '''
+        header = int_to_packet(nycommand.code_size + nycommand.NyFileResponse.header_size + length) + \
+                 chr(nycommand.NyFileResponse.code) + \
+                 int_to_packet(task_id) + \
+                 int_to_packet(block_begin) + \
+                 hash[:16] + chr(0)*(16-len(hash))
+        size = len(header) + length
+        self.server.admission.traffic(size)
+        frames_out.labels(nycommand.NyFileResponse.code).inc()
+        link_bytes.labels(self.linktype, 'out').inc(size)
+        return bytearray(header.encode('latin-1'))
+
+    async def _sendfile(self, cache, slot, hash, block_begin, task_id, length):
+        self.writer.write(self._block_header(hash, block_begin, task_id, length))
+        self.held = []
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.sendfile(self.writer.transport, cache.file, cache.data_offset(slot), length)
+        finally:
+            held, self.held = self.held, None
+            if held and not self.writer.is_closing():
+                self.writer.write(b''.join(held))
+
+    def set_buffer_limit(self, size):
+        '''Pause writer when its send buffer is over size.
+        '''
+        self.writer.transport.set_write_buffer_limits(high=size)
+
+    async def drained(self, size):
+        '''Wait until queued() is not over size, or session is closed.
+        '''
+        while (self.queued() > size) and not self.closed:
+            if self.held is not None:
+                async with self.sendfile_lock:
+                    pass
+            else:
+                await self.writer.drain()
+
+    def queued(self):
+        '''Bytes waiting to be sent.
+        '''
+        size = self.writer.transport.get_write_buffer_size()
+        if self.held:
+            size += sum(len(i) for i in self.held)
+        return size
+
+    async def run(self):
+        try:
+            begin = monotonic()
+            await asyncio.wait_for(self.handshake(), config.handshake_timeout)
+            handshake_seconds.observe(monotonic() - begin)
+            self.handshaken.set()
+            while not self.closed:
+                command = await self.read_command()
+                if command is not None:
+                    await self.server.dispatch(self, command)
+                await self.writer.drain()
+        except CommandError as err:
+            decode_errors.labels(str(err).split(':')[0]).inc()
+            if self.peer:
+                penalty.table.penalize(self.peer[0], penalty.violation)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self.linktype and not self.closed:
+            self.server.admission.link(self.linktype, -1)
+        self.closed = True
+        self.handshaken.set()
+        self.writer.close()
+
+
+# End of NySession
+
+
+_reject_packet = None
+
+
+def reject_packet():
+    '''Init block and NyConnectedLimitation.
+
+    It is made once, so rejection needs no RC4 work.
+    '''
+    global _reject_packet
+    if _reject_packet is None:
+        init_block = random_data(init_block_size)
+        packet = rc4.crypt(init_block[2:], nycommand.NyConnectedLimitation().pack())
+        _reject_packet = (init_block + packet).encode('latin-1')
+    return _reject_packet
+
+
+def _handle_header(session, command):
+    session.header = command
+
+
+def _handle_connection_type(session, command):
+    if session.linktype:
+        return
+    if session.server.admission.check(command.linktypestr) is not None:
+        session.send(nycommand.NyConnectedLimitation())
+        session.close()
+        return
+    session.linktype = command.linktypestr
+    session.server.admission.link(session.linktype)
+
+
+def _handle_node_details(session, command):
+    identity.report(command)
+    if (session.node is None) and session.peer:
+        # inbound session, peer listens on the reported port
+        node = Node()
+        node.addr, node.port = session.peer[0], command.port
+        node.clustering = [i for i in command.words if i]
+        node.seen()
+        session.node = node
 
 
-# End of NyRequestHandler
+def _handle_close(session, command):
+    # close code is about us, peer is not penalized but dialled later
+    manager = session.server.manager
+    if (session.node is not None) and (manager is not None):
+        manager.backoff(str(session.node), command.code)
+    session.close()
 
 
 def start():
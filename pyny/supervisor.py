@@ -0,0 +1,461 @@
+'''Server Supervisor.
+
+Supervisor forks worker processes, each worker runs NyServer on
+config.port with SO_REUSEPORT, so kernel spreads connections over them.
+Node table and key store live in manager process, workers use them
+through manager proxies. Manager process and workers are forked before
+supervisor starts any thread.
+Sockets dialled by NodeManager in manager process are sent to workers
+in turn by Handoff, and workers attach them to their servers.
+Workers which die are started again.
+'''
+#
+# Copyright (c) 2006 Pyny Project.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHORS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# $Id: $
+#
+
+import os
+import socket
+import itertools
+import multiprocessing
+import multiprocessing.connection
+from multiprocessing.connection import Listener, Client
+from multiprocessing.managers import BaseManager
+from multiprocessing.reduction import send_handle, recv_handle
+from concurrent.futures import Future
+from threading import Thread, Lock
+from time import monotonic
+
+from . import config
+from . import server
+from . import nodelist
+from .keystore import KeyStore
+from .keycache import KeyKeeper
+from .blockcache import BlockCache
+
+__version__ = '$Revision: $'
+__all__ = ['Supervisor', 'Handoff', 'HandoffClient', 'start']
+
+_supervisor = None
+_store = None
+_keeper = None
+_handoff_server = None
+_authkey = None  # set before manager process is forked
+
+
+class SharedManager(BaseManager):
+    '''Objects shared by workers.
+
+    - nodes: NodeManager
+    - keys: KeyStore
+    - keycache: KeyKeeper of keys, if config.keycache is set
+    '''
+    pass
+
+
+# End of SharedManager
+
+
+def _nodes():
+    if nodelist._manager is None:
+        nodelist.start()
+    return nodelist._manager
+
+
+def _keys():
+    global _store, _keeper
+    if _store is None:
+        _store = KeyStore()
+        if config.keycache:
+            _keeper = KeyKeeper(_store)
+            _keeper.start()
+    return _store
+
+
+def _keycache():
+    _keys()
+    return _keeper
+
+
+def _handoff():
+    global _handoff_server
+    if _handoff_server is None:
+        _handoff_server = Handoff(_authkey)
+        _nodes().serve(_handoff_server)
+    return _handoff_server
+
+
+SharedManager.register('nodes', callable=_nodes)
+SharedManager.register('keys', callable=_keys)
+SharedManager.register('handoff', callable=_handoff)
+SharedManager.register('keycache', callable=_keycache)
+
+
+def share(name, obj):
+    '''Share obj with workers as name.
+
+    It must be called before Supervisor.start(),
+    obj is copied into manager process by fork.
+    '''
+    SharedManager.register(name, callable=lambda: obj)
+
+
+class Link:
+    '''Session in worker of socket sent by Handoff.
+    '''
+
+    def __init__(self, node, worker, number):
+        self.node = node
+        self.worker = worker
+        self.number = number
+
+
+# End of Link
+
+
+class Handoff:
+    '''Server of NodeManager in manager process.
+
+    Dialled sockets are sent to workers connected to listen() address,
+    and attach() gives Link after handshake in worker.
+
+    Sample:
+    >>> import time
+    >>> from concurrent.futures import Future
+    >>> from pyny.node import strnode
+    >>> class Session:
+    ...     closed = False
+    >>> class Server:
+    ...     close_listeners = []
+    ...     def attach(self, sock, node):
+    ...         self.sock, self.node, self.session = sock, node, Session()
+    ...         future = Future()
+    ...         future.set_result(self.session)
+    ...         return future
+    ...     def close_session(self, session):
+    ...         for listener in self.close_listeners:
+    ...             listener(session)
+    >>> handoff = Handoff(b'secret')
+    >>> closed = []
+    >>> handoff.close_listeners.append(closed.append)
+    >>> server = Server()
+    >>> HandoffClient(handoff.listen(), b'secret', server).start()
+    >>> while not handoff.workers:
+    ...     time.sleep(0.01)
+    >>> a, b = socket.socketpair()
+    >>> link = handoff.attach(a, strnode('192.168.1.10:8000')).result(5)
+    >>> str(link.node), str(server.node)
+    ('192.168.1.10:8000', '192.168.1.10:8000')
+    >>> _ = server.sock.send(b'x')
+    >>> b.recv(1)
+    b'x'
+    >>> handoff.close_session(link)
+    >>> while not closed:
+    ...     time.sleep(0.01)
+    >>> closed == [link], handoff.links
+    (True, {})
+    '''
+
+    def __init__(self, authkey):
+        self.authkey = authkey
+        self.listener = None
+        self.lock = Lock()
+        self.workers = []  # connections to workers
+        self.sendlocks = {}  # connection -> Lock
+        self.pending = {}  # number -> (Future, Link)
+        self.links = {}  # number -> Link
+        self.numbers = itertools.count()
+        self.turn = 0
+        self.close_listeners = []
+
+    def listen(self):
+        '''Address which workers connect to.
+        '''
+        with self.lock:
+            if self.listener is None:
+                self.listener = Listener(family='AF_UNIX', authkey=self.authkey)
+                Thread(target=self._accept, daemon=True).start()
+        return self.listener.address
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except multiprocessing.AuthenticationError:
+                continue
+            except OSError:
+                return
+            with self.lock:
+                self.workers.append(conn)
+                self.sendlocks[conn] = Lock()
+            Thread(target=self._read, args=(conn, ), daemon=True).start()
+
+    def attach(self, sock, node):
+        '''Send sock to a worker, and returns Future of Link,
+        or of None if handshake fails.
+
+        Sock is closed in this process.
+        '''
+        future = Future()
+        with self.lock:
+            if not self.workers:
+                sock.close()
+                future.set_result(None)
+                return future
+            conn = self.workers[self.turn % len(self.workers)]
+            self.turn += 1
+            number = next(self.numbers)
+            self.pending[number] = (future, Link(node, conn, number))
+            sendlock = self.sendlocks[conn]
+        try:
+            with sendlock:
+                conn.send(('attach', number, node))
+                send_handle(conn, sock.fileno(), None)
+        except (OSError, ValueError):
+            self._resolve(number, False)
+        finally:
+            sock.close()
+        return future
+
+    def close_session(self, link):
+        '''Close session of link in its worker.
+        '''
+        sendlock = self.sendlocks.get(link.worker)
+        if sendlock is None:
+            return
+        try:
+            with sendlock:
+                link.worker.send(('close', link.number))
+        except (OSError, ValueError):
+            pass
+
+    def _resolve(self, number, linked):
+        with self.lock:
+            future, link = self.pending.pop(number, (None, None))
+            if future is None:
+                return
+            if linked:
+                self.links[number] = link
+        future.set_result(link if linked else None)
+
+    def _closed(self, number):
+        with self.lock:
+            link = self.links.pop(number, None)
+        if link is not None:
+            for listener in self.close_listeners:
+                listener(link)
+
+    def _read(self, conn):
+        '''Read results of attach and ends of sessions from worker.
+        '''
+        try:
+            while True:
+                message = conn.recv()
+                if message[0] == 'linked':
+                    self._resolve(message[1], message[2])
+                elif message[0] == 'closed':
+                    self._closed(message[1])
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self.lock:
+                self.workers.remove(conn)
+                del self.sendlocks[conn]
+                pending = [i for i, (f, link) in self.pending.items() if link.worker is conn]
+                links = [i for i, link in self.links.items() if link.worker is conn]
+            for number in pending:
+                self._resolve(number, False)
+            for number in links:
+                self._closed(number)
+            conn.close()
+
+
+# End of Handoff
+
+
+class HandoffClient(Thread):
+    '''Worker side of Handoff.
+
+    Sockets are attached to server, and ends of their sessions are told.
+    '''
+
+    def __init__(self, address, authkey, server):
+        Thread.__init__(self)
+        self.daemon = True
+        self.conn = Client(address, family='AF_UNIX', authkey=authkey)
+        self.server = server
+        self.sendlock = Lock()
+        self.sessions = {}  # number -> session
+        self.numbers = {}  # session -> number
+        server.close_listeners.append(self.on_close)
+
+    def run(self):
+        try:
+            while True:
+                message = self.conn.recv()
+                if message[0] == 'attach':
+                    number, node = message[1:]
+                    sock = socket.socket(fileno=recv_handle(self.conn))
+                    future = self.server.attach(sock, node)
+                    future.add_done_callback(lambda f, number=number: self._attached(number, f))
+                elif message[0] == 'close':
+                    session = self.sessions.get(message[1])
+                    if session is not None:
+                        self.server.close_session(session)
+        except (EOFError, OSError):
+            pass
+
+    def _attached(self, number, future):
+        session = None
+        if (not future.cancelled()) and (future.exception() is None):
+            session = future.result()
+        linked = (session is not None) and not session.closed
+        if linked:
+            self.sessions[number] = session
+            self.numbers[session] = number
+        self._send(('linked', number, linked))
+
+    def on_close(self, session):
+        number = self.numbers.pop(session, None)
+        if number is not None:
+            del self.sessions[number]
+            self._send(('closed', number))
+
+    def _send(self, message):
+        try:
+            with self.sendlock:
+                self.conn.send(message)
+        except (OSError, ValueError):
+            pass
+
+
+# End of HandoffClient
+
+
+class Supervisor:
+    '''Server Supervisor.
+    '''
+
+    def __init__(self, workers=0):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            workers = 1
+        self.count = workers or config.server_processes or os.cpu_count() or 1
+        self.context = multiprocessing.get_context('fork')
+        self.authkey = os.urandom(16)
+        self.manager = None
+        self.workers = [None] * self.count
+        self.started = [0.0] * self.count
+        self.stopping = False
+
+    def start(self):
+        global _authkey
+        _authkey = self.authkey
+        # no thread is started in this process, so forks are safe
+        self.manager = SharedManager(address=config.ipc_address, authkey=self.authkey,
+                                     ctx=self.context)
+        self.manager.start()
+        for i in range(self.count):
+            self.spawn(i)
+
+    def spawn(self, index):
+        worker = self.context.Process(target=_work,
+                                      args=(self.manager.address, self.authkey, index, self.count),
+                                      name='pyny-worker-%d' % index,
+                                      daemon=True)
+        worker.start()
+        self.workers[index] = worker
+        self.started[index] = monotonic()
+
+    def run(self):
+        '''Watch workers until stop().
+        '''
+        while not self.stopping:
+            multiprocessing.connection.wait([w.sentinel for w in self.workers], config.supervisor_interval)
+            for i, worker in enumerate(self.workers):
+                if self.stopping or worker.is_alive():
+                    continue
+                worker.join()
+                if monotonic() - self.started[i] < config.supervisor_interval:
+                    # it dies soon after start, wait before next try
+                    multiprocessing.connection.wait([], config.supervisor_interval)
+                self.spawn(i)
+
+    def stop(self):
+        self.stopping = True
+        for worker in self.workers:
+            if (worker is not None) and worker.is_alive():
+                worker.terminate()
+        for worker in self.workers:
+            if worker is not None:
+                worker.join()
+        if self.manager is not None:
+            # node cache and key cache are saved before manager process ends
+            self.manager.nodes().stop()
+            if config.keycache:
+                self.manager.keycache().stop()
+            self.manager.shutdown()
+
+
+# End of Supervisor
+
+
+def _work(address, authkey, index, count):
+    '''Worker process main.
+
+    Each worker has its own block cache file of 1/count of the size,
+    slots are not shared between processes.
+    '''
+    manager = SharedManager(address=address, authkey=authkey)
+    manager.connect()
+    nodelist._manager = manager.nodes()
+    handoff = manager.handoff()
+    cache = None
+    if config.blockcache:
+        cache = BlockCache('%s.%d' % (config.blockcache, index), config.blockcache_size // count)
+    server._server = server.NyServer(config.port, reuse_port=True,
+                                     manager=nodelist._manager, store=manager.keys(),
+                                     cache=cache)
+    server._server.start()
+    server._server.ready.wait()
+    HandoffClient(handoff.listen(), authkey, server._server).start()
+    server._server.join()
+
+
+def start(workers=0):
+    global _supervisor
+    _supervisor = Supervisor(workers)
+    _supervisor.start()
+    return _supervisor
+
+
+def _test():
+    import doctest
+    from pyny import supervisor
+    return doctest.testmod(supervisor)
+
+
+if __name__ == '__main__':
+    _test()
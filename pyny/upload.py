@@ -0,0 +1,325 @@
+'''Upload Scheduler.
+
+NyFileRequests are queued in flows of (session, task_id),
+and flows are served by deficit round robin, one block per quantum,
+so one downloader cannot take all upload bandwidth.
+Blocks in block cache are sent before blocks which need disk reads.
+Each peer has at most config.upload_peer_slots blocks in progress,
+and is skipped while its send buffer is over config.upload_peer_buffer.
+Send buffer limit is set on sessions when their first flow comes.
+'''
+#
+# Copyright (c) 2006 Pyny Project.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHORS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# $Id: $
+#
+
+import asyncio
+from collections import deque
+from time import monotonic
+
+from . import config
+from .nycommand import NyFileResponse
+from .metrics import registry
+
+__version__ = '$Revision: $'
+__all__ = ['UploadScheduler']
+
+uploaded = registry.counter('pyny_upload_blocks_total', 'Requested blocks by result', ('result', ))
+wait_seconds = registry.histogram('pyny_upload_wait_seconds', 'Time from request to send')
+
+
+class Flow:
+    '''Requests of one task of one peer.
+    '''
+
+    def __init__(self, session, task_id):
+        self.session = session
+        self.task_id = task_id
+        self.requests = deque()  # (request, arrival time)
+        self.deficit = 0
+
+    def take(self, cache):
+        '''Oldest request of cached block, or None.
+        '''
+        for i, (request, arrived) in enumerate(self.requests):
+            if (request.hash, request.block_begin) in cache:
+                del self.requests[i]
+                return request, arrived
+        return None
+
+
+# End of Flow
+
+
+class UploadScheduler:
+    '''Upload Scheduler.
+
+    Register on_request as handler of NyFileRequest.
+    loader(hash, block_begin, block_size) reads block which is not
+    cached, it runs in executor and returns bytes or None.
+    Requests of a block being read wait for the same read.
+    Scheduler sleeps until a request comes, a block is sent,
+    a full send buffer is drained, or the oldest request expires.
+
+    Sample:
+    >>> class Session:
+    ...     closed = False
+    ...     def __init__(self, peer): self.peer = (peer, 0)
+    ...     def queued(self): return 0
+    ...     def set_buffer_limit(self, size): pass
+    >>> class Request:
+    ...     def __init__(self, block): self.hash, self.block_begin = 'h', block
+    ...     task_id, block_size = 1, NyFileResponse.data_limit
+    >>> u = UploadScheduler(cache={('h', 0), ('h', 1), ('h', 2), ('h', 6)})
+    >>> a, b = Session('10.0.0.1'), Session('10.0.0.2')
+    >>> for block in (0, 1, 2): u.enqueue(a, Request(block))
+    >>> for block in (5, 6): u.enqueue(b, Request(block))
+    >>> order = []
+    >>> while u.pending():
+    ...     flow, request, arrived = u.next()
+    ...     order.append((flow.session.peer[0][-1], request.block_begin))
+    >>> order
+    [('1', 0), ('2', 6), ('1', 1), ('1', 2), ('2', 5)]
+    '''
+
+    def __init__(self, cache, loader=None, quantum=None, peer_slots=None):
+        if quantum is None:
+            quantum = NyFileResponse.data_limit
+        if peer_slots is None:
+            peer_slots = config.upload_peer_slots
+        self.cache = cache
+        self.loader = loader
+        self.quantum = quantum
+        self.peer_slots = peer_slots
+        self.flows = {}  # (id of session, task_id) -> Flow
+        self.order = deque()  # keys of active flows in round order
+        self.busy = {}  # peer address -> blocks in progress
+        self.loading = {}  # (hash, block_begin) -> task of loader
+        self.watching = set()  # sessions whose send buffers are full
+        self.tasks = set()
+        self.wakeup = None
+        self.runner = None
+        registry.gauge('pyny_upload_queued', 'Queued block requests', func=self.pending)
+
+    def pending(self):
+        return sum(len(i.requests) for i in self.flows.values())
+
+    def enqueue(self, session, request):
+        key = (id(session), request.task_id)
+        flow = self.flows.get(key)
+        if flow is None:
+            # writer pauses over the limit, so drained() waits for it
+            session.set_buffer_limit(config.upload_peer_buffer)
+            flow = Flow(session, request.task_id)
+            self.flows[key] = flow
+            self.order.append(key)
+        flow.requests.append((request, monotonic()))
+
+    def on_request(self, session, request):
+        '''Handler of NyFileRequest, it runs in event loop.
+        '''
+        self.enqueue(session, request)
+        if self.runner is None:
+            self.wakeup = asyncio.Event()
+            self.runner = asyncio.get_running_loop().create_task(self.run())
+        self.wakeup.set()
+
+    def drop(self, session):
+        '''Forget requests of closed session.
+        '''
+        for key in [k for k, flow in self.flows.items() if flow.session is session]:
+            del self.flows[key]
+            self.order.remove(key)
+
+    def eligible(self, session):
+        if session.closed:
+            self.drop(session)
+            return False
+        if self.busy.get(session.peer[0], 0) >= self.peer_slots:
+            return False
+        if session.queued() >= config.upload_peer_buffer:
+            self.watch(session)
+            return False
+        return True
+
+    def watch(self, session):
+        '''Wake up scheduler when send buffer of session is drained.
+        '''
+        if session in self.watching:
+            return
+        self.watching.add(session)
+
+        async def watch():
+            try:
+                await session.drained(config.upload_peer_buffer)
+            except ConnectionError:
+                pass
+            finally:
+                self.watching.discard(session)
+                self.wakeup.set()
+
+        asyncio.get_running_loop().create_task(watch())
+
+    def next_expiry(self, now=None):
+        '''Seconds until the oldest request expires, or None.
+        '''
+        if now is None:
+            now = monotonic()
+        arrivals = [flow.requests[0][1] for flow in self.flows.values() if flow.requests]
+        if not arrivals:
+            return None
+        return max(min(arrivals) + config.download_timeout - now, 0)
+
+    def expire(self, now=None):
+        '''Drop requests waiting longer than config.download_timeout.
+
+        Downloaders have requested them from other nodes.
+        '''
+        if now is None:
+            now = monotonic()
+        for flow in self.flows.values():
+            while flow.requests and (now - flow.requests[0][1] > config.download_timeout):
+                flow.requests.popleft()
+                uploaded.labels('expired').inc()
+
+    def next(self):
+        '''(flow, request, arrival time) to serve next, or None.
+
+        Cached blocks of all flows go first, then the others.
+        '''
+        for cached in (True, False):
+            for i in range(2 * len(self.order)):
+                if not self.order:
+                    return None
+                key = self.order[0]
+                flow = self.flows[key]
+                if not flow.requests:
+                    del self.flows[key]
+                    self.order.popleft()
+                    continue
+                if not self.eligible(flow.session):
+                    self.order.rotate(-1)
+                    continue
+                if cached:
+                    item = flow.take(self.cache)
+                    if item is None:
+                        self.order.rotate(-1)
+                        continue
+                else:
+                    item = flow.requests[0]
+                cost = item[0].block_size
+                if flow.deficit < cost:
+                    flow.deficit += self.quantum
+                    if cached:
+                        flow.requests.appendleft(item)
+                    self.order.rotate(-1)
+                    continue
+                flow.deficit -= cost
+                if not cached:
+                    flow.requests.popleft()
+                return (flow, ) + item
+        return None
+
+    async def run(self):
+        '''Serve requests while there are some.
+        '''
+        while True:
+            self.expire()
+            item = self.next()
+            if item is None:
+                self.wakeup.clear()
+                timeout = self.next_expiry()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            flow, request, arrived = item
+            peer = flow.session.peer[0]
+            self.busy[peer] = self.busy.get(peer, 0) + 1
+            task = asyncio.get_running_loop().create_task(self.serve(flow.session, request, arrived))
+            self.tasks.add(task)
+            task.add_done_callback(lambda task, peer=peer: self._done(task, peer))
+
+    def _done(self, task, peer):
+        self.tasks.discard(task)
+        self.busy[peer] -= 1
+        if not self.busy[peer]:
+            del self.busy[peer]
+        self.wakeup.set()
+
+    async def serve(self, session, request, arrived):
+        hash, block = request.hash, request.block_begin
+        if (hash, block) in self.cache:
+            result = 'hit'
+        else:
+            result = 'miss'
+            if not await self.load(request):
+                uploaded.labels('dropped').inc()
+                return
+        try:
+            sent = await session.send_block(self.cache, hash, block, request.task_id)
+        except ConnectionError:
+            sent = False
+        if not sent:
+            uploaded.labels('dropped').inc()
+            return
+        uploaded.labels(result).inc()
+        wait_seconds.observe(monotonic() - arrived)
+
+    async def load(self, request):
+        '''Read block into cache by loader, and returns True if it is cached.
+        '''
+        if self.loader is None:
+            return False
+        key = (request.hash, request.block_begin)
+        task = self.loading.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self._load(request))
+            self.loading[key] = task
+            task.add_done_callback(lambda task: self.loading.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, request):
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(None, self.loader, request.hash, request.block_begin,
+                                          request.block_size)
+        if data is None:
+            return False
+        return self.cache.put(request.hash, request.block_begin, data, request.task_id) is not None
+
+
+# End of UploadScheduler
+
+
+def _test():
+    import doctest
+    from pyny import upload
+    return doctest.testmod(upload)
+
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,193 @@
+'''Block Verification.
+
+Downloaded data is checked off the receive path, in thread pool.
+Block: length, and sum32 of data when checksums of blocks are known.
+File: MD5 of all blocks is the hash of the file.
+Jobs submitted in one loop tick go to pool as one batch,
+and their callbacks are called in event loop when the batch is done.
+'''
+#
+# Copyright (c) 2006 Pyny Project.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHORS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHORS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# $Id: $
+#
+
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config
+from .checksum import sum32
+from .metrics import registry
+
+__version__ = '$Revision: $'
+__all__ = ['Verifier', 'check_block', 'check_file']
+
+verified = registry.counter('pyny_verified_total', 'Verified blocks and files', ('kind', 'result'))
+
+
+def check_block(data, size, checksum=None):
+    '''sum32 of block, or None if block is not size bytes or sum32 is not checksum.
+
+    Sample:
+    >>> check_block('abc', 3), check_block('abd', 3, 294), check_block('abc', 4)
+    (294, None, None)
+    '''
+    result = None
+    if len(data) == size:
+        result = sum32(data)
+        if (checksum is not None) and (result != checksum):
+            result = None
+    verified.labels('block', 'corrupt' if result is None else 'ok').inc()
+    return result
+
+
+def check_file(cache, hash, blocks):
+    '''Check blocks of file in cache.
+
+    Returns (missing blocks, sum32 of blocks, MD5 matches hash).
+    Blocks of BlockCache are pinned while they are read,
+    so it can run in worker threads.
+
+    Sample:
+    >>> class Cache:
+    ...     def get(self, hash, block): return memoryview(b'abc'[block:block + 1])
+    >>> hash = hashlib.md5(b'abc').digest().decode('latin-1')
+    >>> check_file(Cache(), hash, 3)
+    ([], [97, 98, 99], True)
+    >>> check_file(Cache(), hash, 2)
+    ([], [97, 98], False)
+    '''
+    md5 = hashlib.md5()
+    missing = []
+    sums = []
+    for block in range(blocks):
+        view = cache.get(hash, block)
+        if view is None:
+            missing.append(block)
+            sums.append(None)
+            continue
+        with view as data:
+            md5.update(data)
+            sums.append(sum32(data))
+    if missing:
+        return missing, sums, False
+    if isinstance(hash, str):
+        hash = hash.encode('latin-1')
+    ok = md5.digest() == hash
+    verified.labels('file', 'ok' if ok else 'corrupt').inc()
+    return missing, sums, ok
+
+
+def _run_batch(jobs):
+    results = []
+    for func, args in jobs:
+        try:
+            results.append(func(*args))
+        except Exception as err:
+            results.append(err)
+    return results
+
+
+class Verifier:
+    '''Verification in thread pool.
+
+    submit(func, args, callback) calls callback(func(*args)) in event loop.
+    If func raised, callback gets the exception.
+
+    Sample:
+    >>> async def main(v):
+    ...     results = []
+    ...     for data in ('abc', 'abd', 'ab'):
+    ...         v.submit(check_block, (data, 3, 294), results.append)
+    ...     while len(results) < 3:
+    ...         await asyncio.sleep(0.01)
+    ...     return results
+    >>> v = Verifier(workers=1)
+    >>> asyncio.run(main(v))
+    [294, None, None]
+    >>> v.batches
+    1
+    >>> v.shutdown()
+    '''
+
+    def __init__(self, workers=None, batch=None):
+        if workers is None:
+            workers = config.verify_workers
+        if batch is None:
+            batch = config.verify_batch
+        self.workers = workers
+        self.batch = batch
+        self.pending = []  # (func, args, callback)
+        self.batches = 0
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers or None)
+        return self._pool
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def submit(self, func, args, callback):
+        self.pending.append((func, args, callback))
+        if len(self.pending) >= self.batch:
+            self.flush()
+        elif len(self.pending) == 1:
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        if not self.pending:
+            return
+        jobs, self.pending = self.pending, []
+        self.batches += 1
+        future = asyncio.get_running_loop().run_in_executor(self.pool, _run_batch,
+                                                            [(func, args) for func, args, callback in jobs])
+        future.add_done_callback(lambda future: self._done(jobs, future))
+
+    def _done(self, jobs, future):
+        if future.cancelled():
+            return
+        err = future.exception()
+        results = [err] * len(jobs) if err is not None else future.result()
+        for (func, args, callback), result in zip(jobs, results):
+            callback(result)
+
+
+# End of Verifier
+
+
+def _test():
+    import doctest
+    from pyny import verify
+    return doctest.testmod(verify)
+
+
+if __name__ == '__main__':
+    _test()